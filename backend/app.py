@@ -3,21 +3,34 @@ Serve with waitress: waitress-serve --port=5000 app:app
 Serve with waitress in background (detached from SSH): screen -dm waitress-serve --port=5000 app:app
 '''
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
+from functools import wraps
 from pathlib import Path
-from werkzeug.utils import secure_filename
-from threading import Thread
 from secrets import token_urlsafe
 import json
 import math
-from utilities.csv_parser import parse_election_data_csv
-from utilities.helpers import delete_file, all_keys_present_in_dict, get_vw_and_vl
-
-from audits.Bravo import Bravo
+import os
+import random
+import time
+from utilities.csv_parser import parse_election_data_stream, HashingReader
+from utilities.helpers import all_keys_present_in_dict, get_vw_and_vl
+from utilities.session_store import make_session_store, SessionConflict
+from utilities.upload_cache import ParsedUploadCache
+from utilities.metrics import MetricsRegistry, Counter, Histogram, CallbackMetric
+from utilities.sample_size_tables import load_sample_size_tables, super_simple_sample_size
+from utilities.cvr_store import CVRStore
+from utilities.batch_manifest import parse_batch_manifest
+
+from audits.Bravo import Bravo, average_sample_number
+from audits.MultiBravo import MultiBravo
 from audits.Cast import Cast
 from audits.SuperSimple import SuperSimple
+from audits.Hybrid import Hybrid
 from audits.BayesianPolling import BayesianPolling
+from audits.shared_objects.draws import pull_list
+from audits.simulation import simulate_bravo, simulate_super_simple, DISCREPANCY_KINDS
+from audits.stopping_distribution import bravo_stopping_distribution
 
 app = Flask(__name__)
 
@@ -27,9 +40,34 @@ app = Flask(__name__)
 app.config.update(
     ENV='development',
     DEBUG=True,
-    # Temporary save location. Required to parse uploaded
-    # data since the incoming file is a stream
-    UPLOAD_FOLDER=f'{Path.cwd()}/tmp_uploads'
+    # 'memory' is only correct with a single worker process. Use 'sqlite'
+    # when running several workers (see gunicorn_config.py)
+    SESSION_BACKEND=os.environ.get('RLA_SESSION_BACKEND', 'memory'),
+    SESSION_DB=os.environ.get('RLA_SESSION_DB', f'{Path.cwd()}/audit_sessions.sqlite3'),
+    # Sessions idle for longer than this many seconds are evicted, as are the
+    # least recently used sessions beyond the count and size limits
+    SESSION_IDLE_TTL=float(os.environ.get('RLA_SESSION_IDLE_TTL', 4 * 60 * 60)),
+    SESSION_MAX_COUNT=int(os.environ.get('RLA_SESSION_MAX_COUNT', 10000)),
+    SESSION_MAX_BYTES=int(os.environ.get('RLA_SESSION_MAX_BYTES', 256 * 1024 * 1024)),
+    # Attempts at a request whose audit session another request changed
+    # in the meantime (sqlite backend only)
+    SESSION_CONFLICT_ATTEMPTS=int(os.environ.get('RLA_SESSION_CONFLICT_ATTEMPTS', 5)),
+    # Directory where each worker process writes its metrics, so /metrics
+    # reports the totals of all workers (see gunicorn_config.py)
+    METRICS_DIR=os.environ.get('PROMETHEUS_MULTIPROC_DIR'),
+    # Largest max_draws of /get_bravo_stopping_distribution, which takes about
+    # a second and 50 MB per million draws
+    STOPPING_DISTRIBUTION_MAX_DRAWS=int(os.environ.get('RLA_STOPPING_DISTRIBUTION_MAX_DRAWS', 1 << 21)),
+    # Number of distinct OpenElection uploads whose parsed totals are kept
+    UPLOAD_CACHE_SIZE=int(os.environ.get('RLA_UPLOAD_CACHE_SIZE', 32)),
+    # Worker processes used by /simulate_workload, 0 for one per core and 1 to
+    # simulate in the server process (see gunicorn_config.py)
+    SIMULATION_PROCESSES=int(os.environ.get('RLA_SIMULATION_PROCESSES', 0)),
+    SIMULATION_MAX_TRIALS=int(os.environ.get('RLA_SIMULATION_MAX_TRIALS', 100000)),
+    # Built with `python -m utilities.sample_size_tables`
+    SAMPLE_SIZE_TABLES=os.environ.get('RLA_SAMPLE_SIZE_TABLES', f'{Path.cwd()}/sample_size_tables'),
+    # Uploaded CVR exports for super-simple audits, shared by all workers
+    CVR_STORE_DIR=os.environ.get('RLA_CVR_STORE_DIR', f'{Path.cwd()}/cvr_store')
 )
 
 '''
@@ -43,9 +81,97 @@ CORS(app)
 '''
 Tracks current running audits
 Key: session_id
-Value: Audit object with a running thread
+Value: Audit object, resumed through CURRENT_RUNNING_AUDITS.checkout(session_id)
+'''
+CURRENT_RUNNING_AUDITS = make_session_store(app.config['SESSION_BACKEND'],
+                                            app.config['SESSION_DB'],
+                                            idle_ttl=app.config['SESSION_IDLE_TTL'],
+                                            max_sessions=app.config['SESSION_MAX_COUNT'],
+                                            max_bytes=app.config['SESSION_MAX_BYTES'])
+
+'''
+Per-office vote totals of OpenElection uploads, keyed by file content hash
+'''
+PARSED_UPLOADS = ParsedUploadCache(app.config['UPLOAD_CACHE_SIZE'])
+
+'''
+Precomputed sample size tables, memory-mapped so all workers share them.
+None if they have not been built.
+'''
+SAMPLE_SIZES = load_sample_size_tables(app.config['SAMPLE_SIZE_TABLES'])
+
+'''
+Uploaded CVR exports, keyed by file content hash, see /upload_cvrs
+'''
+CVR_STORE = CVRStore(app.config['CVR_STORE_DIR'])
+
+'''
+Metrics served at /metrics. Request latencies, engine steps and checkouts
+are counted per worker process and summed over the workers through the files
+in PROMETHEUS_MULTIPROC_DIR if it is set, session occupancy is read from the
+session store.
 '''
-CURRENT_RUNNING_AUDITS = {}
+METRICS = MetricsRegistry(app.config['METRICS_DIR'])
+
+def session_stats_snapshot():
+    '''
+    Session store stats, read once per request so all session gauges of a
+    scrape come from the same snapshot.
+    '''
+    if 'session_stats' not in g:
+        g.session_stats = CURRENT_RUNNING_AUDITS.stats()
+    return g.session_stats
+
+REQUEST_LATENCY = METRICS.register(Histogram('rla_request_duration_seconds',
+                                             'Time spent handling a request.',
+                                             ['route', 'method']))
+ENGINE_STEPS = METRICS.register(Counter('rla_engine_steps_total',
+                                        'Ballots (or batches) applied to audit engines.',
+                                        ['audit_type']))
+SESSION_CONFLICTS = METRICS.register(Counter('rla_session_conflicts_total',
+                                             'Requests retried because another request changed their audit session.',
+                                             ['route']))
+METRICS.register(CallbackMetric('rla_active_sessions',
+                                'Audit sessions in the session store.',
+                                ['audit_type'],
+                                lambda: {(audit_type,): count for audit_type, count
+                                         in session_stats_snapshot()['sessions_by_type'].items()}))
+METRICS.register(CallbackMetric('rla_session_bytes',
+                                'Serialized size of the audit sessions in the session store.',
+                                [],
+                                lambda: {(): session_stats_snapshot()['bytes']}))
+METRICS.register(CallbackMetric('rla_session_evictions_total',
+                                'Audit sessions evicted from the session store.',
+                                ['reason'],
+                                lambda: {(reason,): count for reason, count
+                                         in session_stats_snapshot()['evictions'].items()},
+                                metric_type='counter'))
+METRICS.register(CallbackMetric('rla_session_lock_wait_seconds_total',
+                                'Time requests waited to check out an audit session or write it back.',
+                                [],
+                                lambda: {(): CURRENT_RUNNING_AUDITS.checkout_stats()['lock_wait_seconds']},
+                                metric_type='counter', per_process=True))
+METRICS.register(CallbackMetric('rla_session_checkouts_total',
+                                'Audit sessions checked out to apply ballots.',
+                                [],
+                                lambda: {(): CURRENT_RUNNING_AUDITS.checkout_stats()['checkouts']},
+                                metric_type='counter', per_process=True))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.observe(time.perf_counter() - g.request_start, route=route, method=request.method)
+        METRICS.write_process_values()
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/perform_audit', methods=['POST'])
 def perform_audit():
@@ -74,22 +200,53 @@ def perform_audit():
             # votes_array num_ballots num_winners risk_limit seed max_tests
             params_list = [candidate_data, num_ballots_cast, num_winners, risk_limit, random_seed, max_tests]
             bravo_object = Bravo(*params_list)
-            bravo_thread = Thread(target=bravo_object.bravo)
-            bravo_thread.start()
 
-            # get sample size
-            estimated_sample_size = bravo_object.get_sample_size()
+            # get sample size, from the precomputed tables if they cover this
+            # contest (an expectation without a limit on the number of draws,
+            # capped at max_tests), or from the exact stopping distribution
+            estimated_sample_size = None
+            if SAMPLE_SIZES is not None:
+                v_w, v_l = get_vw_and_vl(candidate_data, num_winners)
+                estimated_sample_size = SAMPLE_SIZES.bravo_sample_size(v_w, v_l, num_ballots_cast, risk_limit)
+            if estimated_sample_size is None:
+                estimated_sample_size = bravo_object.get_sample_size()
+            estimated_sample_size = min(estimated_sample_size, bravo_object.max_tests)
+
+            # In rounds mode the first round is drawn up front, see /send_round_votes
+            if form_data.get('audit_mode') == 'rounds':
+                stopping_probability = float(form_data.get('stopping_probability', 90)) / 100
+                res = {'sequence_numbers_to_draw': bravo_object.start_round(stopping_probability)}
+            else:
+                res = {'sequence_number_to_draw': bravo_object.get_sequence_number()}
 
             # Save object to retrieve audit status for a particular user
             # in subsequent requests
             session_id = token_urlsafe(32)
-            global CURRENT_RUNNING_AUDITS
-            CURRENT_RUNNING_AUDITS[session_id] = bravo_object
+            CURRENT_RUNNING_AUDITS.add(session_id, audit_type, bravo_object)
+
+            res['estimated_sample_size'] = estimated_sample_size
+            res['session_id'] = session_id
+            return jsonify(res)
+        elif audit_type == 'multi_bravo':
+            form_params = ['contests', 'num_ballots_cast', 'risk_limit', 'random_seed']
+            if not all_keys_present_in_dict(form_params, form_data):
+                return 'Not all required multi-contest BRAVO parameters were provided.', 500
+
+            # JSON list of {"candidate_votes": [...], "num_winners": n}, one per contest
+            contests = [([int(val) for val in contest['candidate_votes']], int(contest['num_winners']))
+                        for contest in json.loads(form_data['contests'])]
+            num_ballots_cast = int(form_data['num_ballots_cast'])
+            risk_limit = float(form_data['risk_limit']) / 100
+            random_seed = float(form_data['random_seed'])
+            max_tests = int(form_data.get('max_tests', 0))
+
+            multi_bravo = MultiBravo(contests, num_ballots_cast, risk_limit, random_seed, max_tests)
+            first_sequence = multi_bravo.get_sequence_number()
+            session_id = token_urlsafe(32)
+            CURRENT_RUNNING_AUDITS.add(session_id, audit_type, multi_bravo)
 
-            first_sequence = bravo_object.get_sequence_number()
             res = {
                 'sequence_number_to_draw': first_sequence,
-                'estimated_sample_size': estimated_sample_size,
                 'session_id': session_id
             }
             return jsonify(res)
@@ -107,25 +264,60 @@ def perform_audit():
             inflation_rate = float(form_data['inflation_rate']) / 100
             tolerance = float(form_data['tolerance']) / 100
             random_seed = int(form_data['random_seed'])
-
-            # votes_array, num_ballots, num_winners, risk_limit, seed, inflation_rate, tolerance
-            params_list = [candidate_data, num_ballots_cast, num_winners, risk_limit, random_seed,  inflation_rate, tolerance]
+            # CVRs uploaded with /upload_cvrs, if they are not entered with each ballot
+            cvr_id = form_data.get('cvr_id')
+            if cvr_id is not None:
+                try:
+                    cvr_records = CVR_STORE.open(cvr_id)
+                except KeyError as error:
+                    return error.args[0], 404
+                if cvr_records.num_candidates != len(candidate_data):
+                    return 'The CVR export does not have one column per candidate.', 500
+
+            # votes_array, num_ballots, num_winners, risk_limit, seed, inflation_rate, tolerance, cvr_id
+            params_list = [candidate_data, num_ballots_cast, num_winners, risk_limit, random_seed,  inflation_rate, tolerance, cvr_id]
             ss_obj = SuperSimple(*params_list)
             sample_size = ss_obj.sample_size()
-            session_id = token_urlsafe(32)
-            CURRENT_RUNNING_AUDITS[session_id] = ss_obj
-            ss_thread = Thread(target=ss_obj.run_audit)
-            ss_thread.start()
             first_sequence = ss_obj.get_sequence_number()
+            session_id = token_urlsafe(32)
+            CURRENT_RUNNING_AUDITS.add(session_id, audit_type, ss_obj)
             res = {
                 'sequence_number_to_draw': first_sequence,
                 'session_id': session_id,
                 'estimated_sample_size': math.ceil(sample_size)
             }
             return jsonify(res)
+        elif audit_type == 'hybrid':
+            form_params = ['cvr_candidate_votes', 'no_cvr_candidate_votes', 'num_cvr_ballots', 'num_no_cvr_ballots',
+                           'num_winners', 'risk_limit', 'inflation_rate', 'random_seed']
+            if not all_keys_present_in_dict(form_params, form_data):
+                return 'Not all required hybrid parameters were provided.', 500
+
+            # Reported votes per candidate on CVR and on no-CVR equipment
+            cvr_candidate_data = [int(val) for val in json.loads(form_data['cvr_candidate_votes'])]
+            no_cvr_candidate_data = [int(val) for val in json.loads(form_data['no_cvr_candidate_votes'])]
+            num_cvr_ballots = int(form_data['num_cvr_ballots'])
+            num_no_cvr_ballots = int(form_data['num_no_cvr_ballots'])
+            num_winners = int(form_data['num_winners'])
+            risk_limit = float(form_data['risk_limit']) / 100
+            inflation_rate = float(form_data['inflation_rate']) / 100
+            random_seed = int(form_data['random_seed'])
+            max_tests = int(form_data.get('max_tests', 0))
+
+            hybrid = Hybrid(cvr_candidate_data, no_cvr_candidate_data, num_cvr_ballots, num_no_cvr_ballots,
+                            num_winners, risk_limit, random_seed, inflation_rate, max_tests)
+            first_sequence = hybrid.get_sequence_number()
+            session_id = token_urlsafe(32)
+            CURRENT_RUNNING_AUDITS.add(session_id, audit_type, hybrid)
+
+            res = {
+                'sequence_number_to_draw': first_sequence,
+                'session_id': session_id,
+                'num_cvr_ballots': num_cvr_ballots
+            }
+            return jsonify(res)
         elif audit_type == 'cast':
-            form_params = ['initial_cvr_data',
-                            'num_winners',
+            form_params = ['num_winners',
                             'risk_limit',
                             'random_seed',
                             'threshold',
@@ -136,10 +328,6 @@ def perform_audit():
             if not all_keys_present_in_dict(form_params, form_data):
                 return 'Not all required CAST parameters were provided.', 500
 
-            # Parse candidate name and vote JSON data
-            initial_cvr_data = json.loads(form_data['initial_cvr_data'])
-            print(initial_cvr_data)
-            print(initial_cvr_data)
             num_winners = int(form_data['num_winners'])
             risk_limit = float(form_data['risk_limit']) / 100
             random_seed = int(form_data['random_seed'])
@@ -148,19 +336,29 @@ def perform_audit():
             num_batches = int(form_data['num_batches'])
             num_stages = int(form_data['num_stages'])
             num_candidates = int(form_data['num_candidates'])
+
+            # Reported votes per batch, either uploaded as a CSV or .npy batch
+            # manifest, which is streamed into an array, or as JSON
+            if 'batch_manifest' in request.files:
+                try:
+                    initial_cvr_data = parse_batch_manifest(request.files['batch_manifest'].stream,
+                                                            num_batches, num_candidates)
+                except ValueError as error:
+                    return str(error), 500
+            elif 'initial_cvr_data' in form_data:
+                initial_cvr_data = json.loads(form_data['initial_cvr_data'])
+            else:
+                return 'Not all required CAST parameters were provided.', 500
             params_list = [initial_cvr_data, num_candidates, num_winners, num_stages, batch_size, num_batches, risk_limit, threshold, random_seed]
 
             cast_object = Cast(*params_list)
-            cast_thread = Thread(target=cast_object.run_audit)
-            cast_thread.start()
+            first_sequence = cast_object.get_sequence_number()
 
             session_id = token_urlsafe(32)
-            CURRENT_RUNNING_AUDITS[session_id] = cast_object
+            CURRENT_RUNNING_AUDITS.add(session_id, audit_type, cast_object)
 
-            first_sequence = cast_object.get_sequence_number()
-            print("first_sequence", first_sequence)
             res = {
-                'sequence_number_to_draw': int(first_sequence),
+                'sequence_number_to_draw': first_sequence,
                 'session_id': session_id
             }
             return jsonify(res)
@@ -192,10 +390,25 @@ def perform_audit():
     except:
         return "Exception raised"
 
+def retry_on_session_conflict(view):
+    '''
+    Runs `view` again, from the start, when the audit session it checked
+    out was changed by another request before it could write it back.
+    '''
+    @wraps(view)
+    def retrying_view(*args, **kwargs):
+        for _ in range(app.config['SESSION_CONFLICT_ATTEMPTS']):
+            try:
+                return view(*args, **kwargs)
+            except SessionConflict:
+                SESSION_CONFLICTS.inc(route=request.url_rule.rule)
+        return 'The audit was changed by another request, please try again.', 409
+    return retrying_view
+
 @app.route('/send_ballot_votes', methods=['POST'])
+@retry_on_session_conflict
 def send_ballot_votes():
     try:
-        global CURRENT_RUNNING_AUDITS
         form_data = request.form
 
         if 'audit_type' not in form_data:
@@ -208,20 +421,45 @@ def send_ballot_votes():
         audit_type = form_data['audit_type']
 
         if audit_type == 'bravo':
-            bravo = CURRENT_RUNNING_AUDITS[session_id]
-            if bravo.IS_DONE:
-                # return status code 204
-                return 'BRAVO audit complete!', 204
-
             form_params = ['latest_ballot_votes', 'num_ballots_cast']
             if not all_keys_present_in_dict(form_params, form_data):
                 return 'Not all required BRAVO parameters were provided.', 500
 
             ballot_votes_json = json.loads(form_data['latest_ballot_votes'])
             ballot_votes_list = [int(vote) for vote in ballot_votes_json]
-            bravo.append_votes_buffer(ballot_votes_list)
 
-            sequence = bravo.get_sequence_number()
+            with CURRENT_RUNNING_AUDITS.checkout(session_id) as bravo:
+                if bravo.IS_DONE:
+                    # return status code 204
+                    return 'BRAVO audit complete!', 204
+
+                sequence = bravo.submit(ballot_votes_list)
+            ENGINE_STEPS.inc(audit_type=audit_type)
+
+            if sequence is None:
+                return 'BRAVO audit complete!', 204
+
+            res = {'sequence_number_to_draw': sequence}
+            return jsonify(res)
+        elif audit_type == 'multi_bravo':
+            if 'latest_ballot_votes' not in form_data:
+                return 'Not all required multi-contest BRAVO parameters were provided.', 500
+
+            # One list of candidate indices per contest
+            ballot_votes_json = json.loads(form_data['latest_ballot_votes'])
+            ballot_votes_list = [[int(vote) for vote in contest_votes] for contest_votes in ballot_votes_json]
+
+            with CURRENT_RUNNING_AUDITS.checkout(session_id) as multi_bravo:
+                if multi_bravo.IS_DONE:
+                    # return status code 204
+                    return 'BRAVO audit complete!', 204
+
+                sequence = multi_bravo.submit(ballot_votes_list)
+            ENGINE_STEPS.inc(audit_type=audit_type)
+
+            if sequence is None:
+                return 'BRAVO audit complete!', 204
+
             res = {'sequence_number_to_draw': sequence}
             return jsonify(res)
         elif audit_type == 'super_simple':
@@ -231,37 +469,207 @@ def send_ballot_votes():
                 return 'Not all required SuperSimple parameters were provided.', 500
 
             paper_record_and_cvr = json.loads(form_data['paper_record_and_cvr'])
-            ballot_votes = [int(vote) for vote in paper_record_and_cvr['paper_record']]
-            cvr_votes = [int(vote) for vote in paper_record_and_cvr['cvr']]
+            observation = parse_super_simple_observation(paper_record_and_cvr)
+
+            with CURRENT_RUNNING_AUDITS.checkout(session_id) as supersimple:
+                if supersimple.IS_DONE:
+                    # return status code 204
+                    return 'SuperSimple audit complete!', 204
 
-            CURRENT_RUNNING_AUDITS[session_id].append_votes_buffer([ballot_votes, cvr_votes])
-            supersimple = CURRENT_RUNNING_AUDITS[session_id]
+                try:
+                    look_up_cvrs(supersimple, [observation])
+                except KeyError as error:
+                    return error.args[0], 400
+                sequence = supersimple.submit(observation)
+            ENGINE_STEPS.inc(audit_type=audit_type)
+
+            if sequence is None:
+                return 'SuperSimple audit complete!', 204
 
-            sequence = supersimple.get_sequence_number()
             res = {'sequence_number_to_draw': sequence}
 
             return jsonify(res)
-        elif audit_type == 'cast':
-            cast = CURRENT_RUNNING_AUDITS[session_id]
-            if cast.IS_DONE:
-                # return status code 204
-                return 'Cast audit complete!', 204
+        elif audit_type == 'hybrid':
+            form_params = ['paper_record_and_cvr']
+            if not all_keys_present_in_dict(form_params, form_data):
+                return 'Not all required hybrid parameters were provided.', 500
+
+            # "cvr" is only sent for ballots numbered up to num_cvr_ballots
+            paper_record_and_cvr = json.loads(form_data['paper_record_and_cvr'])
+            observation = parse_super_simple_observation(paper_record_and_cvr)
+
+            with CURRENT_RUNNING_AUDITS.checkout(session_id) as hybrid:
+                if hybrid.IS_DONE:
+                    return 'Hybrid audit complete!', 204
+
+                sequence = hybrid.submit(observation)
+            ENGINE_STEPS.inc(audit_type=audit_type)
 
+            if sequence is None:
+                return 'Hybrid audit complete!', 204
+
+            res = {'sequence_number_to_draw': sequence}
+            return jsonify(res)
+        elif audit_type == 'cast':
             form_params = ['batch_votes']
             if not all_keys_present_in_dict(form_params, form_data):
                 print("error 500")
                 return 'Not all required CAST parameters were provided.', 500
 
-            batch = form_data['batch_votes']
-            cast.append_votes_buffer(batch)
+            batch_votes_json = json.loads(form_data['batch_votes'])
+            batch_votes = [int(vote) for vote in batch_votes_json]
+
+            with CURRENT_RUNNING_AUDITS.checkout(session_id) as cast:
+                if cast.IS_DONE:
+                    # return status code 204
+                    return 'Cast audit complete!', 204
+
+                sequence = cast.submit(batch_votes)
+            ENGINE_STEPS.inc(audit_type=audit_type)
 
-            sequence = cast.get_sequence_number()
-            res = {'sequence_number_to_draw': int(sequence)}
+            if sequence is None:
+                return 'Cast audit complete!', 204
+
+            res = {'sequence_number_to_draw': sequence}
             return jsonify(res)
         elif audit_type == 'negexp':
             pass
         else:
             return f'{audit_type} is an invalid audit type!', 500
+    except SessionConflict:
+        raise
+    except:
+        return "Exception Raised"
+
+@app.route('/send_ballot_votes_batch', methods=['POST'])
+@retry_on_session_conflict
+def send_ballot_votes_batch():
+    '''
+    Applies the interpretations of several drawn ballots in one request and
+    returns the next `num_draws` sequence numbers to draw.
+    `ballot_votes_batch` is a JSON array with one entry per drawn ballot, in
+    the order they were drawn:
+        bravo: list of candidate indices marked on the ballot
+        multi_bravo: one list of candidate indices per contest
+        super_simple: {"paper_record": [...], "cvr": [...]}, where "cvr" may be
+            left out if the audit was started with a cvr_id
+        hybrid: {"paper_record": [...], "cvr": [...]}, with "cvr" only for
+            ballots of the CVR stratum
+        cast: list of votes per candidate in the batch
+    An empty batch only draws the next `num_draws` sequence numbers.
+    '''
+    try:
+        form_data = request.form
+
+        form_params = ['audit_type', 'session_id', 'ballot_votes_batch']
+        if not all_keys_present_in_dict(form_params, form_data):
+            return 'Not all required batch submission parameters were provided.', 500
+
+        session_id = form_data['session_id']
+        audit_type = form_data['audit_type']
+        ballot_votes_batch = json.loads(form_data['ballot_votes_batch'])
+        num_draws = int(form_data.get('num_draws', len(ballot_votes_batch)))
+
+        if audit_type == 'bravo' or audit_type == 'cast':
+            observations = [[int(vote) for vote in ballot_votes] for ballot_votes in ballot_votes_batch]
+        elif audit_type == 'multi_bravo':
+            observations = [[[int(vote) for vote in contest_votes] for contest_votes in ballot_votes]
+                            for ballot_votes in ballot_votes_batch]
+        elif audit_type == 'super_simple' or audit_type == 'hybrid':
+            observations = [parse_super_simple_observation(paper_record_and_cvr)
+                            for paper_record_and_cvr in ballot_votes_batch]
+        else:
+            return f'{audit_type} is an invalid audit type!', 500
+
+        with CURRENT_RUNNING_AUDITS.checkout(session_id) as current_audit:
+            if audit_type == 'super_simple':
+                try:
+                    look_up_cvrs(current_audit, observations)
+                except KeyError as error:
+                    return error.args[0], 400
+            num_applied, sequence_numbers = current_audit.submit_batch(observations, num_draws)
+            audit_complete = current_audit.IS_DONE
+        ENGINE_STEPS.inc(num_applied, audit_type=audit_type)
+
+        res = {
+            'ballots_applied': num_applied,
+            'sequence_numbers_to_draw': sequence_numbers,
+            'audit_complete': audit_complete
+        }
+        return jsonify(res)
+    except SessionConflict:
+        raise
+    except:
+        return "Exception Raised"
+
+def parse_super_simple_observation(paper_record_and_cvr):
+    '''
+    Returns the [paper record, CVR] observation of a super-simple ballot,
+    with None for the CVR if it was not sent.
+    '''
+    ballot_votes = [int(vote) for vote in paper_record_and_cvr['paper_record']]
+    if 'cvr' not in paper_record_and_cvr:
+        return [ballot_votes, None]
+    return [ballot_votes, [int(vote) for vote in paper_record_and_cvr['cvr']]]
+
+def look_up_cvrs(supersimple, observations):
+    '''
+    Fills in the CVRs of observations sent without one from the audit's CVR
+    export, by the sequence numbers the ballots were drawn as. Raises
+    KeyError if the export or the CVR of a ballot is missing.
+    '''
+    missing = [index for index, (_, cvr_votes) in enumerate(observations) if cvr_votes is None]
+    if not missing:
+        return
+    if supersimple.cvr_id is None:
+        raise KeyError('No CVR was sent and the audit has no CVR export.')
+    pending = supersimple.pending_sequence_numbers
+    cvrs = CVR_STORE.open(supersimple.cvr_id).lookup([pending[index] for index in missing])
+    for index, cvr_votes in zip(missing, cvrs):
+        observations[index][1] = cvr_votes
+
+@app.route('/send_round_votes', methods=['POST'])
+@retry_on_session_conflict
+def send_round_votes():
+    '''
+    Rounds mode for BRAVO audits started with audit_mode=rounds.
+    `round_ballot_votes` is a JSON array with the candidate indices marked on
+    every ballot of the current round, in draw order. The stopping rule is
+    checked once for the whole round. If the audit is not complete, the next
+    round is sized so it finishes the audit with probability
+    `stopping_probability` (percent, 90 by default) and its sequence numbers
+    are returned.
+    '''
+    try:
+        form_data = request.form
+
+        form_params = ['session_id', 'round_ballot_votes']
+        if not all_keys_present_in_dict(form_params, form_data):
+            return 'Not all required round submission parameters were provided.', 500
+
+        session_id = form_data['session_id']
+        round_ballots = [[int(vote) for vote in ballot_votes]
+                         for ballot_votes in json.loads(form_data['round_ballot_votes'])]
+        stopping_probability = float(form_data.get('stopping_probability', 90)) / 100
+
+        with CURRENT_RUNNING_AUDITS.checkout(session_id) as bravo:
+            if bravo.IS_DONE:
+                # return status code 204
+                return 'BRAVO audit complete!', 204
+            if len(round_ballots) != bravo.current_round_size:
+                return f'Expected votes for {bravo.current_round_size} ballots in this round.', 500
+
+            bravo.submit_round(round_ballots)
+            sequence_numbers = None if bravo.IS_DONE else bravo.start_round(stopping_probability)
+        ENGINE_STEPS.inc(len(round_ballots), audit_type='bravo')
+
+        if sequence_numbers is None:
+            return 'BRAVO audit complete!', 204
+
+        res = {'sequence_numbers_to_draw': sequence_numbers}
+        return jsonify(res)
+    except SessionConflict:
+        raise
     except:
         return "Exception Raised"
 
@@ -276,21 +684,29 @@ def check_audit_status():
 
         session_id = form_data['session_id']
 
-        global CURRENT_RUNNING_AUDITS
-        if session_id not in CURRENT_RUNNING_AUDITS:
+        current_audit = CURRENT_RUNNING_AUDITS.get(session_id)
+        if current_audit is None:
             print(f'Session ID invalid. No running audit can be found for th session ID: {session_id}.')
             return f'Session ID invalid. No running audit can be found for th session ID: {session_id}.', 500
-        current_audit = CURRENT_RUNNING_AUDITS[session_id]
 
-        # Remove the current running audit from the CURRENT_RUNNING_AUDITS dict
+        # Remove the current running audit from the CURRENT_RUNNING_AUDITS store
         if current_audit.IS_DONE:
-            CURRENT_RUNNING_AUDITS.pop(session_id, None)
+            CURRENT_RUNNING_AUDITS.pop(session_id)
 
         res = {
             'audit_complete': current_audit.IS_DONE,
             'completion_message': current_audit.IS_DONE_MESSAGE,
             'flag': current_audit.IS_DONE_FLAG
         }
+        if isinstance(current_audit, Bravo):
+            res['measured_risks'] = current_audit.measured_risks()
+        elif isinstance(current_audit, MultiBravo):
+            res['measured_risks'] = current_audit.measured_risks()
+            res['contests_confirmed'] = current_audit.contests_confirmed().tolist()
+        elif isinstance(current_audit, SuperSimple):
+            res['measured_risk'] = current_audit.kaplan_markov.measured_risk()
+        elif isinstance(current_audit, Hybrid):
+            res['measured_risk'] = current_audit.measured_risk()
         return jsonify(res)
     except:
         return "Exception Raised"
@@ -305,64 +721,298 @@ def end_audit():
 
         session_id = form_data['session_id']
 
-        global CURRENT_RUNNING_AUDITS
-        if session_id in CURRENT_RUNNING_AUDITS:
-            CURRENT_RUNNING_AUDITS.pop(session_id, None)
+        CURRENT_RUNNING_AUDITS.pop(session_id)
 
         return "Successfully ended audit session and revoked session ID.", 200
     except:
         return "Exception raised"
 
-@app.route('/get_sample_sizes_for_open_election_data', methods=['POST'])
-def get_sample_sizes():
+@app.route('/get_draw_list', methods=['POST'])
+def get_draw_list():
+    '''
+    Streams the pull list for the first `num_draws` draws of a ballot-polling
+    or ballot-comparison audit as CSV: one row per distinct ballot, sorted by
+    sequence number, with the number of times it was drawn and the draw at
+    which it was first drawn.
+    The seed is interpreted the same way as in /perform_audit, so the list
+    matches the sequence numbers handed out during the audit.
+    '''
     try:
-        if 'election-data-spreadsheet' not in request.files:
-            'OpenElection data not uploaded.', 500
+        form_data = request.form
+        form_params = ['audit_type', 'random_seed', 'num_ballots_cast', 'num_draws']
+        if not all_keys_present_in_dict(form_params, form_data):
+            return 'Not all required draw list parameters were provided.', 500
+
+        audit_type = form_data['audit_type']
+        num_ballots_cast = int(form_data['num_ballots_cast'])
+        num_draws = int(form_data['num_draws'])
 
+        random_gen = random.Random()
+        if audit_type == 'bravo' or audit_type == 'multi_bravo':
+            random_gen.seed(float(form_data['random_seed']))
+        elif audit_type == 'super_simple':
+            random_gen.seed(int(form_data['random_seed']))
+        else:
+            return f'{audit_type} is an invalid audit type!', 500
+
+        sequence_numbers, times_drawn, first_draw = pull_list(random_gen, num_ballots_cast, num_draws)
+
+        def generate_rows(chunk_size=10000):
+            yield 'sequence_number,times_drawn,first_draw\n'
+            for start in range(0, len(sequence_numbers), chunk_size):
+                rows = zip(sequence_numbers[start:start + chunk_size].tolist(),
+                           times_drawn[start:start + chunk_size].tolist(),
+                           first_draw[start:start + chunk_size].tolist())
+                yield ''.join(f'{row[0]},{row[1]},{row[2]}\n' for row in rows)
+
+        headers = {'Content-Disposition': 'attachment; filename=draw_list.csv'}
+        return Response(generate_rows(), mimetype='text/csv', headers=headers)
+    except:
+        return "Exception raised"
+
+@app.route('/simulate_workload', methods=['POST'])
+def simulate_workload():
+    '''
+    Projects how many ballots an audit of the reported tally will need from
+    `num_trials` simulated audits: the number of ballots within which 50%,
+    90% and 99% of audits finish, and the probability of escalating to a
+    full hand count.
+    Super-simple audits are simulated with the CVR discrepancy rates
+    o1_rate, o2_rate, u1_rate and u2_rate (percent of ballots with a 1- or
+    2-vote overstatement or understatement, 0 by default).
+    '''
+    try:
         form_data = request.form
-        num_winners = int(form_data['num_winners'])
-        file_data = request.files['election-data-spreadsheet']
+        if 'audit_type' not in form_data:
+            return 'Audit type not specified.', 500
 
-        # Check if file is valid and if the extension is allowed
-        # if file_data and allowed_file(file_data.filename):
-        if file_data:
-            filename = secure_filename(file_data.filename)
-            data_path = str(Path(app.config['UPLOAD_FOLDER']).joinpath(filename))
+        audit_type = form_data['audit_type']
+        num_trials = int(form_data.get('num_trials', 10000))
+        if not 0 < num_trials <= app.config['SIMULATION_MAX_TRIALS']:
+            return f'The number of trials must be between 1 and {app.config["SIMULATION_MAX_TRIALS"]}.', 500
+        seed = int(form_data['random_seed']) if 'random_seed' in form_data else None
+        processes = app.config['SIMULATION_PROCESSES'] or None
+
+        if audit_type == 'bravo':
+            form_params = ['candidate_votes', 'num_ballots_cast', 'num_winners', 'risk_limit']
+            if not all_keys_present_in_dict(form_params, form_data):
+                return 'Not all required BRAVO parameters were provided.', 500
 
-            v_w = 0
-            v_l = 0
-            total_votes = 0
+            candidate_data = [int(val) for val in json.loads(form_data['candidate_votes'])]
+            num_ballots_cast = int(form_data['num_ballots_cast'])
+            num_winners = int(form_data['num_winners'])
+            risk_limit = float(form_data['risk_limit']) / 100
+            max_tests = int(form_data.get('max_tests', 0))
 
-            try:
-                file_data.save(data_path)
+            res = simulate_bravo(candidate_data, num_ballots_cast, num_winners, risk_limit, max_tests,
+                                 num_trials, seed, processes)
+        elif audit_type == 'super_simple':
+            form_params = ['candidate_votes', 'num_ballots_cast', 'num_winners', 'risk_limit', 'inflation_rate', 'tolerance']
+            if not all_keys_present_in_dict(form_params, form_data):
+                return 'Not all required super-simple parameters were provided.', 500
 
+            candidate_data = [int(val) for val in json.loads(form_data['candidate_votes'])]
+            num_ballots_cast = int(form_data['num_ballots_cast'])
+            num_winners = int(form_data['num_winners'])
+            risk_limit = float(form_data['risk_limit']) / 100
+            inflation_rate = float(form_data['inflation_rate']) / 100
+            tolerance = float(form_data['tolerance']) / 100
+            error_rates = {kind: float(form_data.get(f'{kind}_rate', 0)) / 100 for kind in DISCREPANCY_KINDS}
+
+            res = simulate_super_simple(candidate_data, num_ballots_cast, num_winners, risk_limit, inflation_rate,
+                                        tolerance, error_rates, num_trials, seed, processes)
+        else:
+            return f'{audit_type} is an invalid audit type!', 500
+
+        return jsonify(res)
+    except:
+        return "Exception raised"
+
+@app.route('/get_sample_size', methods=['POST'])
+def get_sample_size():
+    '''
+    Returns the expected BRAVO sample size and the initial super-simple
+    sample size for a winner with `v_w` votes and a loser with `v_l` votes
+    among `total_votes` ballots. Answered from the precomputed tables when
+    they cover the inputs, and computed otherwise.
+    '''
+    try:
+        form_data = request.form
+        form_params = ['v_w', 'v_l', 'total_votes', 'risk_limit', 'inflation_rate', 'tolerance']
+        if not all_keys_present_in_dict(form_params, form_data):
+            return 'Not all required sample size parameters were provided.', 500
+
+        v_w = int(form_data['v_w'])
+        v_l = int(form_data['v_l'])
+        total_votes = int(form_data['total_votes'])
+        risk_limit = float(form_data['risk_limit']) / 100
+        inflation_rate = float(form_data['inflation_rate']) / 100
+        tolerance = float(form_data['tolerance']) / 100
+        if v_w <= v_l:
+            return 'The winner must have more votes than the loser.', 500
+
+        bravo_sample_size = None
+        if SAMPLE_SIZES is not None:
+            bravo_sample_size = SAMPLE_SIZES.bravo_sample_size(v_w, v_l, total_votes, risk_limit)
+        if bravo_sample_size is None:
+            bravo_sample_size = math.ceil(average_sample_number(v_w, v_l, total_votes, risk_limit))
+
+        res = {
+            'bravo': bravo_sample_size,
+            'super_simple': super_simple_sample_size(v_w, v_l, total_votes, risk_limit, inflation_rate, tolerance)
+        }
+        return jsonify(res)
+    except:
+        return "Exception raised"
+
+@app.route('/get_bravo_stopping_distribution', methods=['POST'])
+def get_bravo_stopping_distribution():
+    '''
+    Returns the exact distribution of the number of ballots a BRAVO audit
+    draws for a winner with `v_w` votes and a loser with `v_l` votes among
+    `total_votes` ballots: the number of draws within which 50%, 90% and 99%
+    of audits stop, the expected number of draws and the probability of
+    stopping within `max_draws` draws (v_w + v_l by default, as in BRAVO, and
+    at most total_votes).
+    '''
+    try:
+        form_data = request.form
+        form_params = ['v_w', 'v_l', 'total_votes', 'risk_limit']
+        if not all_keys_present_in_dict(form_params, form_data):
+            return 'Not all required stopping distribution parameters were provided.', 500
+
+        v_w = int(form_data['v_w'])
+        v_l = int(form_data['v_l'])
+        total_votes = int(form_data['total_votes'])
+        risk_limit = float(form_data['risk_limit']) / 100
+        # A BRAVO audit escalates once it has drawn as many ballots as were cast
+        max_draws = min(int(form_data.get('max_draws', v_w + v_l)), total_votes)
+        if v_w <= v_l:
+            return 'The winner must have more votes than the loser.', 500
+        if not 0 < max_draws <= app.config['STOPPING_DISTRIBUTION_MAX_DRAWS']:
+            return f"max_draws must be between 1 and {app.config['STOPPING_DISTRIBUTION_MAX_DRAWS']}.", 500
+
+        res = bravo_stopping_distribution(v_w, v_l, total_votes, risk_limit, max_draws)
+        return jsonify(res)
+    except:
+        return "Exception raised"
+
+@app.route('/session_stats', methods=['GET'])
+def session_stats():
+    '''
+    Reports the number and size of stored audit sessions and how many
+    sessions have been evicted for each reason.
+    '''
+    try:
+        return jsonify(CURRENT_RUNNING_AUDITS.stats())
+    except:
+        return "Exception raised"
+
+@app.route('/upload_cvrs', methods=['POST'])
+def upload_cvrs():
+    '''
+    Saves a CVR export for super-simple audits (see utilities/cvr_store.py
+    for the format). The CSV is either uploaded as the 'cvr-file' file of a
+    multipart form, or sent as the raw request body with a text/csv content
+    type. Returns the cvr_id to start audits with, after which ballots only
+    need their paper record.
+    '''
+    try:
+        if request.mimetype == 'text/csv':
+            stream = request.stream
+        else:
+            if 'cvr-file' not in request.files:
+                return 'CVR export not uploaded.', 500
+            stream = request.files['cvr-file'].stream
+        cvr_id, num_ballots, num_candidates = CVR_STORE.add(stream)
+    except ValueError as e:
+        return str(e), 500
+    except Exception as e:
+        print(e)
+        return 'An error occurred while saving the CVR export.', 500
+
+    res = {
+        'cvr_id': cvr_id,
+        'num_ballots': num_ballots,
+        'num_candidates': num_candidates
+    }
+    return jsonify(res)
+
+@app.route('/get_sample_sizes_for_open_election_data', methods=['POST'])
+def get_sample_sizes():
+    '''
+    Returns the vote totals and v_w/v_l of every office in an OpenElection
+    CSV, plus one office chosen at random for the sample size demo.
+    The CSV is either uploaded as the 'election-data-spreadsheet' file of a
+    multipart form, or sent as the raw request body with a text/csv content
+    type and num_winners in the query string. A multipart upload parsed
+    before (same content hash) is not parsed again. A raw body is parsed as
+    it is received, unless the client sends its SHA-256 as content_sha256 in
+    the query string and a file with that hash was parsed before.
+    '''
+    try:
+        if request.mimetype == 'text/csv':
+            num_winners = int(request.args['num_winners'])
+            claimed_hash = request.args.get('content_sha256', '').lower()
+            offices = PARSED_UPLOADS.get(claimed_hash) if claimed_hash else None
+            if offices is None:
+                # Hashed as it is parsed, the body is only read once
+                stream = HashingReader(request.stream)
+                offices = parse_election_data_stream(stream)
+                upload_hash = stream.hexdigest()
+                if claimed_hash and claimed_hash != upload_hash:
+                    return 'content_sha256 does not match the uploaded data.', 400
+                PARSED_UPLOADS.put(upload_hash, offices)
+        else:
+            if 'election-data-spreadsheet' not in request.files:
+                return 'OpenElection data not uploaded.', 500
+
+            num_winners = int(request.form['num_winners'])
+            file_data = request.files['election-data-spreadsheet']
+
+            # Check if file is valid and if the extension is allowed
+            # if file_data and allowed_file(file_data.filename):
+            if not file_data:
+                return 'Invalid file uploaded. Please upload a spreadsheet in CSV format.', 500
+            stream = file_data.stream
+
+            upload_hash = ParsedUploadCache.content_hash(stream)
+            offices = PARSED_UPLOADS.get(upload_hash)
+            if offices is None:
                 # TODO: need some way to determine if we are processing OpenElection data and not a random CSV
-                vote_dict, total_votes, office = parse_election_data_csv(data_path)
+                offices = parse_election_data_stream(stream)
+                PARSED_UPLOADS.put(upload_hash, offices)
+    except Exception as e:
+        print(e)
+        return "An error occurred while parsing the OpenElection data.", 500
 
-                # Convert dictionary of candidate/num_votes to list of num_votes
-                votes_array = []
-                for value in vote_dict.values():
-                    votes_array.append(value)
+    if not offices:
+        return 'The OpenElection data has no offices.', 500
 
+    try:
+        office_results = []
+        for office_name, (vote_dict, total_votes) in sorted(offices.items()):
+            # Convert dictionary of candidate/num_votes to list of num_votes
+            votes_array = list(vote_dict.values())
+            v_w, v_l = None, None
+            if len(votes_array) > num_winners:
                 v_w, v_l = get_vw_and_vl(votes_array, num_winners)
-            except Exception as e:
-                # Delete saved CSV on error
-                delete_file(data_path)
-                print(e)
-                return "An error occurred while parsing the OpenElection data.", 500
-
-            res = {
+            office_results.append({
+                'office': office_name,
                 'v_w': v_w,
                 'v_l': v_l,
-                'total_votes': total_votes,
-                'office_chosen': office
-            }
+                'total_votes': total_votes
+            })
 
-            # Delete saved CSV
-            delete_file(data_path)
-            return jsonify(res)
-        else:
-            return 'Invalid file uploaded. Please upload a spreadsheet in CSV format.', 500
+        office_chosen = random.choice(office_results)
+        res = {
+            'v_w': office_chosen['v_w'],
+            'v_l': office_chosen['v_l'],
+            'total_votes': office_chosen['total_votes'],
+            'office_chosen': office_chosen['office'],
+            'offices': office_results
+        }
+        return jsonify(res)
     except:
         return "Exception Raised"
 
@@ -0,0 +1,23 @@
+'''
+ASGI entry point.
+
+Serve with uvicorn: uvicorn asgi:asgi_app --port=5000
+Serve with gunicorn and uvicorn workers: RLA_ASGI=1 gunicorn --config=python:gunicorn_config asgi:asgi_app
+
+Audits never wait on one another (see BaseAudit.submit), so a request only
+needs a thread while its handler runs. Under an ASGI server idle and
+keep-alive connections are held by the event loop, and requests run the
+Flask app concurrently on a pool of RLA_ASGI_THREADS threads per worker
+(2 * cores + 1 by default, like the gthread workers).
+
+Requires the a2wsgi and uvicorn packages.
+'''
+
+import os
+from multiprocessing import cpu_count
+
+from a2wsgi import WSGIMiddleware
+
+from app import app
+
+asgi_app = WSGIMiddleware(app, workers=int(os.environ.get('RLA_ASGI_THREADS', cpu_count() * 2 + 1)))
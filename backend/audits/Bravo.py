@@ -4,6 +4,33 @@ import numpy as np
 from .shared_objects.arrange_candidates import arrange_candidates
 from .shared_objects.BaseAudit import BaseAudit
 from .shared_objects.Hypotheses import Hypotheses
+from .shared_objects.binomial import binomial_sf, log_factorials
+from .stopping_distribution import bravo_stopping_distribution
+
+# Largest max_tests for which get_sample_size computes the exact stopping
+# distribution, which takes about a second per million draws
+EXACT_SAMPLE_SIZE_MAX_DRAWS = 1 << 21
+
+def average_sample_number(v_w, v_l, num_ballots, risk_limit):
+    """
+    Return the closed-form average sample number (from the BRAVO paper) of an
+    audit of a winner with `v_w` votes and a loser with `v_l` votes among
+    `num_ballots` ballots, without a limit on the number of draws. It takes
+    microseconds, unlike the exact `bravo_stopping_distribution`.
+    """
+    s_w = v_w / (v_w + v_l)
+
+    z_w = math.log(2.0 * s_w)
+    z_l = math.log(2.0 * (1 - s_w)) if 2.0 * (1 - s_w) > 0 else 0
+
+    n_wl = v_w + v_l
+
+    p_w = v_w / n_wl
+    p_l = v_l / n_wl
+
+    p = n_wl / num_ballots
+
+    return math.ceil((math.log(1.0 / risk_limit) + (z_w / 2.0)) / (p * ((p_w * z_w) + (p_l * z_l))))
 
 class Bravo(BaseAudit):
     """ Ballot-polling audit in Python
@@ -39,44 +66,68 @@ class Bravo(BaseAudit):
 
         self.candidates = arrange_candidates(votes_array, num_winners)
         self.margins = self.get_margins()
-        self.hypotheses = None
-
-
-
-    def get_sample_size(self):
+        self.num_null_hypotheses = len(self.candidates.winners) * len(self.candidates.losers)
+
+        # Test statistics are kept as a len(winners) x len(losers) matrix.
+        # `winner_rows[c]` (`loser_columns[c]`) is the row (column) of
+        # candidate c, or -1 if c is not a winner (loser).
+        self.winners = np.array(sorted(self.candidates.winners), dtype=np.intp)
+        self.losers = np.array(sorted(self.candidates.losers), dtype=np.intp)
+        self.winner_rows = np.full(self.num_candidates, -1, dtype=np.intp)
+        self.winner_rows[self.winners] = np.arange(len(self.winners))
+        self.loser_columns = np.full(self.num_candidates, -1, dtype=np.intp)
+        self.loser_columns[self.losers] = np.arange(len(self.losers))
+        self.log_threshold = math.log(1/risk_limit)
+        self.winner_increments, self.loser_increments = self.get_increments()
+        self.hypotheses = Hypotheses(len(self.winners), len(self.losers))
+        self.ballots_tested = 0
+        # Number of ballots drawn for the round in progress, in rounds mode
+        self.current_round_size = None
+
+    def get_closest_pair_votes(self):
         """
-        Return the expected sample size of the audit.
+        Return the reported votes of the smallest winner and of the largest
+        loser.
         """
         votes_array = self.votes_array
         winners = self.candidates.winners
         losers = self.candidates.losers
-        risk_limit = self.risk_limit
-        num_ballots = self.num_ballots
 
         # find the smallest margin of victory min(winner_votes) - max(loser_votes)
         smallest_winner = min(winners, key=lambda winner_idx: votes_array[winner_idx])
         largest_loser = max(losers, key=lambda winner_idx: votes_array[winner_idx])
 
-        v_w = votes_array[smallest_winner]
-        v_l = votes_array[largest_loser]
+        return votes_array[smallest_winner], votes_array[largest_loser]
+
+    def get_stopping_distribution(self):
+        """
+        Return the exact stopping-time distribution of the audit for the
+        closest winner and loser pair (see `bravo_stopping_distribution`), or
+        None if the reported results are tied.
+        """
+        v_w, v_l = self.get_closest_pair_votes()
+        if v_w <= v_l:
+            return None
+        return bravo_stopping_distribution(v_w, v_l, self.num_ballots, self.risk_limit, self.max_tests)
+
+    def get_sample_size(self):
+        """
+        Return the expected sample size of the audit for the closest winner
+        and loser pair, counting audits that escalate as `max_tests` draws,
+        from its exact stopping distribution. Audits allowed more than
+        EXACT_SAMPLE_SIZE_MAX_DRAWS draws use the closed-form average sample
+        number instead, without a limit on the number of draws.
+        """
+        v_w, v_l = self.get_closest_pair_votes()
 
         asn = 0
 
         if v_w > v_l:
+            if self.max_tests <= EXACT_SAMPLE_SIZE_MAX_DRAWS:
+                return bravo_stopping_distribution(v_w, v_l, self.num_ballots, self.risk_limit,
+                                                   self.max_tests)['expected_sample_size']
             try:
-                s_w = v_w / (v_w + v_l)
-
-                z_w = math.log(2.0 * s_w)
-                z_l = math.log(2.0 * (1 - s_w)) if 2.0 * (1 - s_w) > 0 else 0
-
-                n_wl = v_w + v_l
-
-                p_w = v_w / n_wl
-                p_l = v_l / n_wl
-
-                p = n_wl / num_ballots
-
-                asn = math.ceil((math.log(1.0 / risk_limit) + (z_w / 2.0)) / (p * ((p_w * z_w) + (p_l * z_l))))
+                asn = average_sample_number(v_w, v_l, self.num_ballots, self.risk_limit)
             except ValueError as e:
                 asn = 0
                 print("Sample size could not be calculated due to an error:", e)
@@ -99,82 +150,210 @@ class Bravo(BaseAudit):
 
         return margins
 
+    def get_increments(self):
+        """
+        Return the amounts added to the log test statistics for each vote,
+        as two len(winners) x len(losers) matrices. A vote for a winner adds
+        the matching row of `winner_increments` (log(2*margin)) to its row
+        and a vote for a loser adds the matching column of `loser_increments`
+        (log(2*(1-margin))) to its column.
+        A loser with no reported votes has a margin of 1, so a vote for it
+        sends the statistic to -inf and the pair can never be rejected.
+        """
+        margins = self.margins[np.ix_(self.winners, self.losers)]
+        with np.errstate(divide='ignore'):
+            return np.log(2*margins), np.log(2*(1-margins))
 
-    def get_ballot(self):
+    def check_ballot(self, ballot_votes):
         """ Step 2 of the BRAVO algorithm.
-        Randomly picks a ballot to test and returns a list of its votes.
-        The ballot picked is returned to the frontend for the user to input
-        actual votes on the ballot. The ballot should be selected using a
-        random function seeded by a user-generated seed.
-        Note: 'random' should be seeded before this function is called.
+        Validates the votes recorded for the drawn ballot. The ballot is
+        picked with `get_sequence_number` and returned to the frontend for
+        the user to input actual votes on the ballot. Overvoted ballots
+        count as a ballot with no votes.
         """
-        ballot_votes = self.get_votes()
         if len(ballot_votes) > self.num_winners:
             return []
         return ballot_votes
 
-    def update_hypothesis(self, winner, loser):
+    def update_hypotheses(self, index):
         """ Step 5 of the BRAVO algorithm.
-        Rejects the null hypothesis corresponding to the test statistic of
-        the `winner` and `loser` pair. Increments the null hypothesis
-        rejection count.
+        Rejects the null hypotheses at `index` (a row, column or the whole
+        matrix) whose test statistic has reached 1/risk_limit, and records
+        the largest value each statistic has reached.
         """
-        if self.hypotheses.test_stat[winner][loser] >= 1/self.risk_limit:
-            self.hypotheses.test_stat[winner][loser] = 0
-            self.hypotheses.reject_count += 1
+        hypotheses = self.hypotheses
+        log_test_stat = hypotheses.log_test_stat[index]
+        np.maximum(hypotheses.max_log_test_stat[index], log_test_stat,
+                   out=hypotheses.max_log_test_stat[index])
+        newly_rejected = (log_test_stat >= self.log_threshold) & ~hypotheses.rejected[index]
+        hypotheses.rejected[index] |= newly_rejected
+        hypotheses.reject_count += int(np.count_nonzero(newly_rejected))
 
     def update_audit_stats(self, vote):
         """ Steps 3-5 from the BRAVO algorithm.
         Updates the `test_statistic` and rejects the corresponding null
         hypothesis when appropriate.
         """
-        if vote in self.candidates.winners: # Step 3
-            for loser in self.candidates.losers:
-                self.hypotheses.test_stat[vote][loser] \
-                        *= 2*self.margins[vote][loser]
-                self.update_hypothesis(vote, loser)
-        elif vote in self.candidates.losers: # Step 4
-            for winner in self.candidates.winners:
-                self.hypotheses.test_stat[winner][vote] \
-                        *= 2*(1-self.margins[winner][vote])
-                self.update_hypothesis(winner, vote)
-
-    def run_audit(self):
-        """
-        Runs the algorithm given in "BRAVO" (2012) §7.
-        """
-        try:
-            num_winners = len(self.candidates.winners)
-            num_losers = len(self.candidates.losers)
-            num_candidates = self.num_candidates
-            max_tests = self.max_tests
-
-            num_null_hypotheses = num_winners * num_losers
-            self.hypotheses = Hypotheses(np.ones([num_candidates, num_candidates]))
-
-
-            for _ in range(max_tests): # Step 6
-                ballot_votes = self.get_ballot()
-                assert all(0 <= vote < num_candidates for vote in ballot_votes)
-                assert isinstance(ballot_votes, list)
-                for vote in ballot_votes:
-                    self.update_audit_stats(vote)
-                # Step 6
-                if self.hypotheses.reject_count >= num_null_hypotheses:
-                    return True
-
-            return False
-        except:
-            return "Exception Raised"
-
-    def bravo(self):
-        """BRAVO Ballot-Polling Audit Implementation
-        Given an array of votes cast, the number of winners, a risk limit, and a
-        maximum number of ballots to test, `bravo` runs an audit on the election
-        results to confirm with `risk_limit` confidence that the reported
-        `num_winners` winner(s) are indeed the winners.
-        """
-        audit_result = self.run_audit()
+        log_test_stat = self.hypotheses.log_test_stat
+        row = self.winner_rows[vote]
+        if row >= 0: # Step 3
+            log_test_stat[row] += self.winner_increments[row]
+            self.update_hypotheses(np.s_[row])
+        else: # Step 4
+            column = self.loser_columns[vote]
+            log_test_stat[:, column] += self.loser_increments[:, column]
+            self.update_hypotheses(np.s_[:, column])
+
+    def update_audit_stats_block(self, vote_counts):
+        """ Steps 3-5 from the BRAVO algorithm for a block of ballots.
+        `vote_counts[c]` is the number of votes for candidate c in the
+        block. Hypotheses are only checked at the end of the block, which is
+        still risk-limiting but may need a few more ballots than checking
+        after every vote.
+        """
+        vote_counts = np.asarray(vote_counts)
+        winner_counts = vote_counts[self.winners, np.newaxis]
+        loser_counts = vote_counts[np.newaxis, self.losers]
+        # A candidate with no votes in the block adds nothing, even when its
+        # increment is -inf
+        with np.errstate(invalid='ignore'):
+            self.hypotheses.log_test_stat += \
+                    np.where(winner_counts > 0, winner_counts * self.winner_increments, 0) \
+                    + np.where(loser_counts > 0, loser_counts * self.loser_increments, 0)
+        self.update_hypotheses(np.s_[:, :])
+
+    def measured_risks(self):
+        """
+        Return, for each winner and loser pair, the smallest risk limit at
+        which the audit would have confirmed that `winner` beat `loser` with
+        the ballots tested so far.
+        """
+        measured_risk = self.hypotheses.measured_risk()
+        return [{'winner': int(winner), 'loser': int(loser), 'risk': float(measured_risk[row, column])}
+                for row, winner in enumerate(self.winners)
+                for column, loser in enumerate(self.losers)]
+
+    def count_votes(self, ballots):
+        """
+        Return the number of votes for each candidate on `ballots`, a list of
+        the votes recorded on each ballot. Overvoted ballots count as a
+        ballot with no votes.
+        """
+        votes = [vote for ballot_votes in ballots for vote in self.check_ballot(ballot_votes)]
+        vote_counts = np.bincount(np.asarray(votes, dtype=np.intp), minlength=self.num_candidates)
+        assert len(vote_counts) == self.num_candidates
+        return vote_counts
+
+    def check_finished(self):
+        """ Step 6 of the BRAVO algorithm. """
+        if self.hypotheses.reject_count >= self.num_null_hypotheses:
+            self.finish(True)
+        elif self.ballots_tested >= self.max_tests:
+            self.finish(False)
+
+    def apply_observation(self, ballot_votes):
+        """
+        Runs one iteration of the algorithm given in "BRAVO" (2012) §7 for
+        the votes recorded on a single drawn ballot.
+        """
+        num_candidates = self.num_candidates
+        ballot_votes = self.check_ballot(ballot_votes)
+        assert isinstance(ballot_votes, list)
+        assert all(0 <= vote < num_candidates for vote in ballot_votes)
+        for vote in ballot_votes:
+            self.update_audit_stats(vote)
+        self.ballots_tested += 1
+        self.check_finished()
+
+    def apply_observation_block(self, vote_counts, num_ballots):
+        """
+        Applies `num_ballots` drawn ballots at once, given the number of
+        votes for each candidate among them (see `count_votes`).
+        """
+        assert len(vote_counts) == self.num_candidates
+        assert num_ballots >= 0
+        self.update_audit_stats_block(vote_counts)
+        self.ballots_tested += num_ballots
+        self.check_finished()
+
+    def pair_round_size(self, row, column, stopping_probability, max_draws, log_factorial):
+        """
+        Return the smallest number of draws after which the test statistic of
+        the winner and loser pair at `row`, `column` reaches 1/risk_limit with
+        probability at least `stopping_probability` if the reported results
+        are correct, or `max_draws` if more would be needed.
+        Only ballots for the winner or the loser change the statistic, so the
+        number of such ballots needed is found from binomial tails and scaled
+        up by the fraction of ballots reported for either of them. Treating
+        that number as fixed makes the result approximate for small rounds.
+        """
+        winner, loser = self.winners[row], self.losers[column]
+        margin = self.margins[winner][loser]
+        fraction_relevant = (self.votes_array[winner] + self.votes_array[loser]) / self.num_ballots
+        remaining = self.log_threshold - self.hypotheses.log_test_stat[row, column]
+        winner_increment = self.winner_increments[row, column]
+        loser_increment = self.loser_increments[row, column]
+        max_relevant = math.floor(max_draws * fraction_relevant)
+
+        def stopping_probability_after(num_relevant):
+            if loser_increment == -math.inf:
+                # No reported votes for the loser, so every relevant ballot is for the winner
+                return 1. if num_relevant * winner_increment >= remaining else 0.
+            min_winner_votes = math.ceil((remaining - num_relevant*loser_increment)
+                                         / (winner_increment - loser_increment) - 1e-9)
+            return binomial_sf(min_winner_votes, num_relevant, margin, log_factorial)
+
+        if margin <= .5 or remaining == math.inf or max_relevant == 0 \
+                or stopping_probability_after(max_relevant) < stopping_probability:
+            return max_draws
+
+        # Binary search for the smallest number of relevant ballots that is enough
+        low, high = 0, max_relevant
+        while high - low > 1:
+            middle = (low + high) // 2
+            if stopping_probability_after(middle) >= stopping_probability:
+                high = middle
+            else:
+                low = middle
+        return min(max_draws, math.ceil(high / fraction_relevant))
+
+    def get_round_size(self, stopping_probability=.9):
+        """
+        Return the number of ballots to draw in the next round so that, if
+        the reported results are correct, each remaining null hypothesis is
+        rejected at the end of the round with probability at least
+        `stopping_probability`. Capped at the number of tests left.
+        """
+        assert 0. < stopping_probability < 1.
+        max_draws = self.max_tests - self.ballots_tested
+        log_factorial = log_factorials(max_draws)
+        round_sizes = [self.pair_round_size(row, column, stopping_probability, max_draws, log_factorial)
+                       for row, column in zip(*np.nonzero(~self.hypotheses.rejected))]
+        return max(round_sizes, default=1)
+
+    def start_round(self, stopping_probability=.9):
+        """
+        Rounds mode: sizes the next round with `get_round_size` and returns
+        the sequence numbers of all of its ballots, in draw order.
+        """
+        self.current_round_size = self.get_round_size(stopping_probability)
+        return [self.get_sequence_number() for _ in range(self.current_round_size)]
+
+    def submit_round(self, round_ballots):
+        """
+        Rounds mode: applies the votes recorded on every ballot of the round
+        started by `start_round`, in draw order, and checks the stopping rule
+        once for the whole round.
+        """
+        assert len(round_ballots) == self.current_round_size
+        self.current_round_size = None
+        self.apply_observation_block(self.count_votes(round_ballots), len(round_ballots))
+
+    def finish(self, audit_result):
+        """
+        Marks the audit as done. `audit_result` is True when every null
+        hypothesis was rejected within `max_tests` ballots.
+        """
         self.IS_DONE = True
 
         print("Audit has been finished")
@@ -198,4 +377,7 @@ if __name__ == "__main__":
     SEED = 1234567890
     ######################
     bravo = Bravo(VOTES_ARR, TOTAL_VOTES, NUM_WINNERS, ALPHA, SEED, MAX_TESTS)
-    bravo.bravo()
+    sequence = bravo.get_sequence_number()
+    while sequence is not None:
+        sequence = bravo.submit([1])
+    print(bravo.IS_DONE_MESSAGE)
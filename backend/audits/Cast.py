@@ -7,6 +7,10 @@ from .shared_objects.Hypotheses import Hypotheses
 import json
 import copy
 
+# Largest number of batch x winner x loser overstatement bounds held in
+# memory at once by calc_u_ps
+MAX_U_P_CHUNK = 1 << 22
+
 class Cast(BaseAudit):
 
     def __init__(self, initial_cvr_data, num_candidates,
@@ -22,10 +26,15 @@ class Cast(BaseAudit):
         self.num_unaudited = num_batches
         self.threshold = threshold
         self.random_seed = random_seed
-        self.unaudited = np.arange(num_batches)
+        # Batches not audited yet, updated in O(1) as batches are recorded
+        self.is_unaudited = np.ones(num_batches, dtype=bool)
         self.alpha = self.calc_alpha_s(risk_tolerance)
-        self.cvr_batches = initial_cvr_data
-        self.reported_batch_info, self.audited_batch_info, self.winners, self.losers = self.init_info()
+        self.reported_batch_info, self.audited_batch_info, self.winners, self.losers = self.init_info(initial_cvr_data)
+        # Reported votes per candidate summed over the unaudited batches and
+        # audited votes summed over the audited ones, kept up to date as
+        # batches are audited so adjusted margins take O(candidates)
+        self.unaudited_totals = self.reported_batch_info.sum(axis=0)
+        self.audited_totals = self.audited_batch_info.sum(axis=0)
         self.random_gen = random.Random()
         self.random_gen.seed(int(random_seed))
         # this is for getting a random sequence number
@@ -34,14 +43,24 @@ class Cast(BaseAudit):
         self.sequence_order = []
         self.STAGE_MESSAGE = ""
 
+        # Progress of the audit, advanced by apply_observation
+        self.stage = 0
+        self.batches_to_audit = []
+        self.num_batches_recorded = 0
+        self.adj_margins = None
+        self.start_stage()
+
     def get_sequence_number(self):
-        self._CV.acquire()
-        while not self.sequence_order:
-            self._CV.wait()
+        '''
+        Returns the next batch of the current stage to audit, or None if the
+        audit is done.
+        '''
+        if not self.sequence_order:
+            return None
         sequence_number = self.sequence_order.pop(0)
-        self._CV.release()
         print("sequence number", sequence_number)
-        return sequence_number+1
+        # Plain int so it can be sent as JSON
+        return int(sequence_number)+1
 
     def calc_alpha_s(self, risk_tolerance):
         diff = 1 - risk_tolerance
@@ -49,44 +68,29 @@ class Cast(BaseAudit):
         alpha_s = 1 - diff_s
         return alpha_s
 
-    def init_info(self):
-        total_votes = np.zeros(self.num_candidates)
-        reported_batch_info = []
-        get_batch_generator = self.get_batch_first()
-        for batch_info in get_batch_generator:
-            reported_batch_info.append(batch_info)
-            for idx, num_votes in enumerate(batch_info):
-                total_votes[idx] = total_votes[idx] + num_votes
+    def init_info(self, initial_cvr_data):
+        '''
+        `initial_cvr_data` holds the reported votes per candidate of each
+        batch, as nested lists or as a (batches x candidates) integer array,
+        e.g. from utilities.batch_manifest, which is used without a copy.
+        '''
+        reported_batch_info = np.asarray(initial_cvr_data)
+        assert reported_batch_info.shape == (self.num_batches, self.num_candidates)
+        total_votes = np.zeros(self.num_candidates) + reported_batch_info.sum(axis=0)
 
         losers = np.argsort(total_votes)[:(self.num_candidates - self.num_winners)]
         winners = np.argsort(total_votes)[(self.num_candidates - self.num_winners):]
-        reported_batch_info = np.asarray(reported_batch_info)
         audited_batch_info = np.zeros(reported_batch_info.shape)
 
         return reported_batch_info, audited_batch_info, winners, losers
 
-    def get_batch_info(self):
-        '''
-        Get batch info
-        '''
-        return json.loads(self.get_votes())
-
-    def get_batch_first(self):
+    def calc_adj_margin(self, winner, loser):
         '''
-        Get batch info for beginning of audit.
+        Margin of winner over loser with the reported votes of the audited
+        batches replaced by their audited votes.
         '''
-        for batch in self.cvr_batches:
-            yield batch
-
-    def calc_adj_margin(self, winner, loser):
-        reported_margin = 0
-        audited_margin = 0
-        for num in self.unaudited:
-            reported_margin = reported_margin + self.reported_batch_info[num][winner] - self.reported_batch_info[num][loser]
-
-        for batches in self.audited_batch_info:
-            audited_margin = audited_margin + batches[winner] - batches[loser]
-
+        reported_margin = self.unaudited_totals[winner] - self.unaudited_totals[loser]
+        audited_margin = self.audited_totals[winner] - self.audited_totals[loser]
         return reported_margin + audited_margin
 
     '''
@@ -97,22 +101,19 @@ class Cast(BaseAudit):
         u_ps = np.zeros(self.num_batches)
 
         # Matrix containing all the adj margins between any winner and any loser
-        adj_margins = np.zeros([len(self.winners), len(self.losers)])
-
-        for idw, winner in enumerate(self.winners):
-            for idl, loser in enumerate(self.losers):
-                adj_margins[idw][idl] = self.calc_adj_margin(winner, loser)
-
-        for batch_num in self.unaudited:
-            max_u_p = []
-            for idw, winner in enumerate(self.winners):
-                for idl, loser in enumerate(self.losers):
-                    if(adj_margins[idw][idl] == 0):
-                        u_p = 0
-                    else:
-                        u_p = (self.reported_batch_info[batch_num][winner] - self.reported_batch_info[batch_num][loser] + self.batch_size) / adj_margins[idw][idl]
-                    max_u_p.append(u_p)
-            u_ps[batch_num] = np.amax(max_u_p)
+        adj_margins = self.get_adj_margins()
+
+        # Bounds for all pairs of a chunk of batches at once, pairs with no
+        # adjusted margin count as 0
+        chunk_size = max(1, MAX_U_P_CHUNK // max(1, adj_margins.size))
+        unaudited = self.unaudited_batches()
+        for start in range(0, len(unaudited), chunk_size):
+            batch_nums = unaudited[start:start + chunk_size]
+            reported = self.reported_batch_info[batch_nums]
+            margins = reported[:, self.winners, np.newaxis] - reported[:, np.newaxis, self.losers] + self.batch_size
+            with np.errstate(divide='ignore', invalid='ignore'):
+                batch_u_ps = np.where(adj_margins == 0, 0., margins / adj_margins)
+            u_ps[batch_nums] = batch_u_ps.reshape(len(batch_nums), -1).max(axis=1)
         return u_ps
 
 
@@ -121,17 +122,11 @@ class Cast(BaseAudit):
     '''
     def calc_T(self):
         u_ps = self.calc_u_ps()
-        t_ps = []
-        squigglie_u_ps = []
-        for u_p in u_ps:
-            if(u_p < self.threshold):
-                t_ps.append(u_p)
-                squigglie_u_ps.append(0.0)
-            else:
-                t_ps.append(self.threshold)
-                squigglie_u_ps.append(u_p - self.threshold)
-        T = sum(t_ps)
-        squigglie_u_ps = np.asarray(squigglie_u_ps)
+        below_threshold = u_ps < self.threshold
+        t_ps = np.where(below_threshold, u_ps, self.threshold)
+        squigglie_u_ps = np.where(below_threshold, 0.0, u_ps - self.threshold)
+        # Summed in batch order, like adding them up one at a time
+        T = float(np.cumsum(t_ps)[-1]) if len(t_ps) else 0
         print("T", T)
         print("t_ps", t_ps)
         print("u_ps", u_ps)
@@ -139,24 +134,32 @@ class Cast(BaseAudit):
         return T, squigglie_u_ps
 
     '''
-    Returns the number of squigle u_ps needed to add up to 1-T
+    Returns the number of batches to audit in this stage, from the number of
+    squigle u_ps needed to add up to 1-T. More batches than are unaudited
+    means no sample can confirm the outcome, including when T >= 1.
     '''
     def calc_n(self, T, squigglie_u_ps):
         sorted_squigglie_u_ps = np.argsort(squigglie_u_ps)
         sorted_squigglie_u_ps = sorted_squigglie_u_ps[::-1]
         print(squigglie_u_ps)
         print(sorted_squigglie_u_ps)
+        if T >= 1:
+            # Errors below the threshold alone could change the outcome
+            return self.num_unaudited + 1
         sum = 0
         count = 0
         while sum < (1 - T):
-            if count > self.num_unaudited:
-                return count
+            if count >= self.num_unaudited:
+                return self.num_unaudited + 1
             sum += squigglie_u_ps[sorted_squigglie_u_ps[count]]
             count += 1
 
         base = (self.num_unaudited - count) / self.num_unaudited
-        n = math.log(self.alpha, base)
-        n = math.ceil(n)
+        if base == 0:
+            # Every unaudited batch would have to be wrong, one finds it
+            n = 1
+        else:
+            n = math.ceil(math.log(self.alpha, base))
         print("count", count)
         print("N_s", self.num_unaudited)
         print("Base", base)
@@ -164,91 +167,106 @@ class Cast(BaseAudit):
         return n
 
     def calc_t_s(self, batches_to_audit, adj_margins):
-        e_wlp = []
-        for batch_num in batches_to_audit:
-            for idw, w in enumerate(self.winners):
-                for idl, l in enumerate(self.losers):
-                    print("calc_t_s batch_num", batch_num)
-                    reported = self.reported_batch_info[batch_num][w] - self.reported_batch_info[batch_num][l]
-                    audited = self.audited_batch_info[batch_num][w] - self.audited_batch_info[batch_num][l]
-                    print(reported, audited)
-                    e_wlp.append((reported - audited)/ adj_margins[idw][idl])
-        print(e_wlp)
-        return np.amax(e_wlp)
-
-    def run_audit(self):
-        try:
-            random.seed(a = self.random_seed)
-
-            for i in range(self.num_stages):
-                self.STAGE_MESSAGE = "Starting stage {}".format(i)
-                T, squigglie_u_ps = self.calc_T()
-                n = self.calc_n(T, squigglie_u_ps)
-                print("Number of batches to audit: ", n)
-
-                if(len(self.unaudited) < n):
-                    # fills sequence_order list w/ dummy values
-                    # so frontend can check if audit completed
-                    self._CV.acquire()
-                    self.sequence_order = [1, 1, 1, 1, 1]
-                    self._CV.notify()
-                    self._CV.release()
-                    # end of bs code
-                    print('More batches to audit then provided preform a full hand recount')
-                    self.IS_DONE_MESSAGE = "Audit requires more batches than remaining. Perform a full hand-recount of the ballots."
-                    self.IS_DONE_FLAG = "danger"
-                    self.IS_DONE = True
-                    return
-                batches_to_audit = random.sample(list(self.unaudited), n)
-                print(batches_to_audit)
-                self._CV.acquire()
-                self.sequence_order = batches_to_audit
-                self._CV.notify()
-                self._CV.release()
-
-                adj_margins = np.zeros([len(self.winners), len(self.losers)])
-
-                for idw, winner in enumerate(self.winners):
-                    for idl, loser in enumerate(self.losers):
-                        adj_margins[idw][idl] = self.calc_adj_margin(winner, loser)
-
-                print("Batches to audit", batches_to_audit)
-                self.num_unaudited = self.num_unaudited - n
-                self.unaudited = self.unaudited.tolist()
-                self.batches_to_audit = random.sample(list(self.unaudited), n)
-                for batch_num in self.batches_to_audit:
-                    print("batch_nun", batch_num)
-                    print("batch list", self.batches_to_audit)
-                    self.unaudited.remove(batch_num)
-                    self.audited_batch_info[batch_num] = self.get_batch_info()
-                self.unaudited = np.asarray(self.unaudited)
-
-                print("Got all info")
-                t_s = self.calc_t_s(self.batches_to_audit, adj_margins)
-                print("t_s", t_s)
-
-                if t_s < self.threshold:
-                    print('Audit complete')
-                    self.IS_DONE_MESSAGE = "Audit completed: the results stand."
-                    self.IS_DONE_FLAG = "success"
-                    self.IS_DONE = True
-                    return
+        '''
+        Largest overstatement of any winner/loser margin in the audited
+        batches, relative to the adjusted margin of the pair
+        '''
+        reported_info = self.reported_batch_info[batches_to_audit]
+        audited_info = self.audited_batch_info[batches_to_audit]
+        reported = reported_info[:, self.winners, np.newaxis] - reported_info[:, np.newaxis, self.losers]
+        audited = audited_info[:, self.winners, np.newaxis] - audited_info[:, np.newaxis, self.losers]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.amax((reported - audited) / adj_margins)
+
+    def unaudited_batches(self):
+        '''
+        Batch numbers of the unaudited batches, in increasing order
+        '''
+        return np.flatnonzero(self.is_unaudited)
+
+    def get_adj_margins(self):
+        '''
+        Matrix containing all the adj margins between any winner and any loser
+        '''
+        reported_margins = self.unaudited_totals[self.winners, np.newaxis] - self.unaudited_totals[self.losers]
+        audited_margins = self.audited_totals[self.winners, np.newaxis] - self.audited_totals[self.losers]
+        return (reported_margins + audited_margins).astype(float)
 
+    def start_stage(self):
+        '''
+        Picks the batches to audit for the current stage, or ends the audit
+        if no stages are left.
+        '''
+        if self.stage >= self.num_stages:
             print('Audit failed. Full hand recount needed')
             self.IS_DONE_MESSAGE = "Audit cannot verify the election results. Perform a full hand-recount of the ballots."
             self.IS_DONE_FLAG = "danger"
             self.IS_DONE = True
             return
-        except:
-            return "Exception Raised"
 
-# num_candidates, num_winners, num_stages, batch_size
+        self.STAGE_MESSAGE = "Starting stage {}".format(self.stage)
+        T, squigglie_u_ps = self.calc_T()
+        n = self.calc_n(T, squigglie_u_ps)
+        print("Number of batches to audit: ", n)
+
+        if(self.num_unaudited < n):
+            print('More batches to audit then provided preform a full hand recount')
+            self.IS_DONE_MESSAGE = "Audit requires more batches than remaining. Perform a full hand-recount of the ballots."
+            self.IS_DONE_FLAG = "danger"
+            self.IS_DONE = True
+            return
+
+        # Sampling positions is the same draw as sampling the list of
+        # unaudited batches, without building it
+        positions = self.random_gen.sample(range(self.num_unaudited), n)
+        self.batches_to_audit = self.unaudited_batches()[positions].tolist()
+        print("Batches to audit", self.batches_to_audit)
+        self.sequence_order = list(self.batches_to_audit)
+        self.num_batches_recorded = 0
+        self.adj_margins = self.get_adj_margins()
+
+    def apply_observation(self, batch_votes):
+        '''
+        Records the audited votes per candidate for the next batch of the
+        current stage. Once every batch of the stage is recorded, either ends
+        the audit or starts the next stage.
+        '''
+        batch_num = self.batches_to_audit[self.num_batches_recorded]
+        self.audited_batch_info[batch_num] = batch_votes
+        self.unaudited_totals = self.unaudited_totals - self.reported_batch_info[batch_num]
+        self.audited_totals = self.audited_totals + self.audited_batch_info[batch_num]
+        self.is_unaudited[batch_num] = False
+        self.num_unaudited = self.num_unaudited - 1
+        self.num_batches_recorded += 1
+
+        if self.num_batches_recorded < len(self.batches_to_audit):
+            return
+
+        print("Got all info")
+        t_s = self.calc_t_s(self.batches_to_audit, self.adj_margins)
+        print("t_s", t_s)
+
+        if t_s < self.threshold:
+            print('Audit complete')
+            self.IS_DONE_MESSAGE = "Audit completed: the results stand."
+            self.IS_DONE_FLAG = "success"
+            self.IS_DONE = True
+            return
+
+        self.stage += 1
+        self.start_stage()
+
+# initial_cvr_data, num_candidates, num_winners, num_stages, batch_size
 # num_batches, risk_tolerance, threshold, random_seed
 
 if __name__ == "__main__":
     num_candidates, num_winners, num_stages, batch_size = (2, 1, 2, 10)
     num_batches, risk_tolerance, threshold, random_seed = (20, .05, .01, 1234567)
-    params = [num_candidates, num_winners, num_stages, batch_size,
+    initial_cvr_data = [[7, 3] for _ in range(num_batches)]
+    params = [initial_cvr_data, num_candidates, num_winners, num_stages, batch_size,
     num_batches, risk_tolerance, threshold, random_seed]
     cast = Cast(*params)
-    cast.run_audit()
+    sequence = cast.get_sequence_number()
+    while sequence is not None:
+        sequence = cast.submit(initial_cvr_data[sequence - 1])
+    print(cast.IS_DONE_MESSAGE)
@@ -0,0 +1,340 @@
+import random
+import math
+from collections import deque
+import numpy as np
+from .shared_objects.arrange_candidates import arrange_candidates
+from .shared_objects.BaseAudit import BaseAudit
+from .shared_objects.KaplanMarkov import DISCREPANCIES, KaplanMarkov
+
+# Error allocations evaluated before refining the best one
+ALLOCATION_GRID_SIZE = 32
+# Golden-section steps, each shrinks the bracket by a factor of 0.618
+ALLOCATION_SEARCH_STEPS = 40
+GOLDEN_RATIO = (math.sqrt(5) - 1) / 2
+# Ballots of a batch whose risks are evaluated together
+BLOCK_SIZE = 256
+
+class Hybrid(BaseAudit):
+    """ Stratified hybrid audit
+    For contests counted partly on equipment that produces CVRs and partly
+    on equipment that does not. A Kaplan-Markov comparison test runs on the
+    CVR stratum and a ballot-polling test on the no-CVR stratum, combined
+    as in SUITE ("Risk-Limiting Audits by Stratified Union-Intersection
+    Tests of Elections", Ottoboni, Stark, Lindeman and McBurnett 2018).
+
+    A reported winner w only lost to a loser l if the margin of w over l is
+    overstated by at least lambda * V in the CVR stratum and (1 - lambda) * V
+    in the no-CVR stratum for some error allocation lambda, where V is the
+    overall reported margin. For a given lambda the two stratum p-values
+    are combined with Fisher's method, and the p-value of the pair is the
+    largest combined p-value over all allocations. The log stratum p-values
+    are concave in lambda, so the largest one is found with a grid search
+    refined by golden-section search, for all pairs at once.
+
+    Ballots 1..num_cvr_ballots are the CVR stratum and the following
+    num_no_cvr_ballots ballots the no-CVR stratum. Ballots are drawn
+    uniformly from both, so each stratum is sampled in proportion to its
+    size.
+
+    The risk is checked after every ballot. `submit_batch` evaluates it for
+    all the ballots of a block at once, stopping at the same ballot as
+    submitting them one at a time.
+    """
+    def __init__(self, cvr_votes_array, no_cvr_votes_array, num_cvr_ballots, num_no_cvr_ballots,
+                 num_winners, risk_limit, seed, inflation_rate, max_tests):
+        super().__init__()
+        # Set audit variables equal to parameters and sanity check
+        assert len(cvr_votes_array) == len(no_cvr_votes_array)
+        assert all(votes >= 0 for votes in cvr_votes_array + no_cvr_votes_array)
+        assert num_cvr_ballots >= sum(cvr_votes_array) and num_cvr_ballots > 0
+        assert num_no_cvr_ballots >= sum(no_cvr_votes_array) and num_no_cvr_ballots > 0
+        self.votes_array = [cvr + no_cvr for cvr, no_cvr in zip(cvr_votes_array, no_cvr_votes_array)]
+        assert num_winners < len(self.votes_array)
+        self.num_winners = num_winners
+        self.num_candidates = len(self.votes_array)
+        self.num_cvr_ballots = num_cvr_ballots
+        self.num_no_cvr_ballots = num_no_cvr_ballots
+        self.num_ballots = num_cvr_ballots + num_no_cvr_ballots
+        assert 0. < risk_limit <= 1.
+        self.risk_limit = risk_limit
+        assert inflation_rate >= 1.
+        self.inflation_rate = inflation_rate
+
+        self.random_gen = random.Random()
+        self.seed = seed
+        self.random_gen.seed(seed)
+        # Sequence numbers drawn but not yet applied, in draw order
+        self.pending_sequence_numbers = deque()
+
+        if max_tests <= 0:
+            self.max_tests = self.num_ballots
+        else:
+            self.max_tests = min(max_tests, self.num_ballots)
+
+        # Winner/loser pairs of the whole contest, flattened
+        self.candidates = arrange_candidates(self.votes_array, num_winners)
+        winners = np.array(sorted(self.candidates.winners), dtype=np.intp)
+        losers = np.array(sorted(self.candidates.losers), dtype=np.intp)
+        self.pair_winners = np.repeat(winners, len(losers))
+        self.pair_losers = np.tile(losers, len(winners))
+        cvr_votes = np.asarray(cvr_votes_array, dtype=float)
+        no_cvr_votes = np.asarray(no_cvr_votes_array, dtype=float)
+        self.margins = np.asarray(self.votes_array, dtype=float)[self.pair_winners] \
+            - np.asarray(self.votes_array, dtype=float)[self.pair_losers]
+        self.no_cvr_margins = no_cvr_votes[self.pair_winners] - no_cvr_votes[self.pair_losers]
+        # Reported mean of the polling statistic (1 + [w] - [l]) / 2 in the no-CVR stratum
+        self.reported_no_cvr_means = .5 + self.no_cvr_margins / (2*num_no_cvr_ballots)
+
+        self.kaplan_markov = KaplanMarkov(cvr_votes_array, num_cvr_ballots, num_winners, inflation_rate,
+                                          candidates=self.candidates)
+        # Ballots drawn from the no-CVR stratum for the winner, for the loser
+        # and for neither of them, per pair
+        self.polling_counts = np.zeros([len(self.pair_winners), 3], dtype=np.int64)
+        self.ballots_tested = 0
+
+        if (self.margins <= 0).any():
+            # Tied contest, nothing to confirm
+            self.finish(False)
+
+    def allocation_bounds(self):
+        """
+        Returns the smallest and largest error allocation (fraction of the
+        margin overstated in the CVR stratum) of each pair for which the
+        overstatements are possible in both strata.
+        """
+        cvr_bound = 2 * self.inflation_rate * self.num_cvr_ballots / self.margins
+        lowest = 1 - (self.no_cvr_margins + self.num_no_cvr_ballots) / self.margins
+        highest = np.minimum(cvr_bound, 1 - (self.no_cvr_margins - self.num_no_cvr_ballots) / self.margins)
+        return lowest, highest
+
+    def stratum_counts(self):
+        """
+        Returns the counts the stratum p-values depend on, for one audit
+        state: the number of CVR ballots audited (states), the discrepancy
+        counts of each pair (states x pairs x discrepancies) and the polling
+        counts of each pair (states x pairs x 3).
+        """
+        return (np.array([self.kaplan_markov.ballots_audited]),
+                self.kaplan_markov.discrepancy_counts.reshape(1, len(self.margins), -1),
+                self.polling_counts[np.newaxis])
+
+    def log_stratum_p_values(self, allocations, counts):
+        """
+        Returns the log of the product of the CVR stratum and no-CVR stratum
+        p-values of each pair, for the audit states of `counts` (see
+        `stratum_counts`) and error allocations of any shape whose last two
+        axes are the states and the pairs.
+        """
+        ballots_audited, discrepancy_counts, polling_counts = counts
+        # Kaplan-Markov p-value of the null that the CVR stratum overstates
+        # the margin by allocations * margins
+        with np.errstate(invalid='ignore'):
+            log_discrepancy_terms = np.where(discrepancy_counts > 0,
+                                             discrepancy_counts * self.kaplan_markov.log_discrepancy_factors,
+                                             0.).sum(axis=-1)
+        log_cvr_p = ballots_audited[:, np.newaxis] \
+            * np.log1p(-allocations * self.margins / (2 * self.inflation_rate * self.num_cvr_ballots)) \
+            + log_discrepancy_terms
+
+        # Polling test of the null that the mean of (1 + [w] - [l]) / 2 in the
+        # no-CVR stratum is at most null_means, betting on the reported mean
+        null_means = .5 + (self.no_cvr_margins - (1 - allocations) * self.margins) / (2*self.num_no_cvr_ballots)
+        reported = self.reported_no_cvr_means
+        winner, loser, neither = np.moveaxis(polling_counts, -1, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_test_stat = np.where(winner > 0, winner * np.log(reported / null_means), 0.) \
+                + np.where(loser > 0, loser * np.log((1 - reported) / (1 - null_means)), 0.) \
+                + np.where(neither > 0, neither * np.log(reported / (2*null_means)
+                                                         + (1 - reported) / (2*(1 - null_means))), 0.)
+        # Betting against a null mean at or above the reported one is not valid
+        log_no_cvr_p = np.where(reported > null_means, -log_test_stat, 0.)
+
+        return np.minimum(log_cvr_p, 0.) + np.minimum(log_no_cvr_p, 0.)
+
+    def p_values(self):
+        """
+        Returns the p-value of each winner/loser pair: the largest Fisher
+        combination of the stratum p-values over all error allocations.
+        """
+        return self.p_value_path(self.stratum_counts())[0]
+
+    def p_value_path(self, counts):
+        """
+        Returns the p-value of each winner/loser pair (states x pairs) for
+        the audit states of `counts` (see `stratum_counts`).
+        """
+        lowest, highest = self.allocation_bounds()
+        # Grid search on the open interval, then golden-section search
+        # between the neighbours of the best grid point
+        steps = (highest - lowest) / ALLOCATION_GRID_SIZE
+        grid = lowest + steps * np.arange(1, ALLOCATION_GRID_SIZE)[:, np.newaxis]
+        grid_values = self.log_stratum_p_values(grid[:, np.newaxis], counts)
+        best = grid_values.argmax(axis=0)
+        best_log_p = np.take_along_axis(grid_values, best[np.newaxis], axis=0)[0]
+        best_allocations = lowest + steps * (best + 1)
+
+        low, high = best_allocations - steps, best_allocations + steps
+        middle_low = high - GOLDEN_RATIO * (high - low)
+        middle_high = low + GOLDEN_RATIO * (high - low)
+        value_low = self.log_stratum_p_values(middle_low, counts)
+        value_high = self.log_stratum_p_values(middle_high, counts)
+        for _ in range(ALLOCATION_SEARCH_STEPS):
+            # Keep the part of the bracket around the larger value
+            move_up = value_high > value_low
+            low = np.where(move_up, middle_low, low)
+            high = np.where(move_up, high, middle_high)
+            middle_low, middle_high = np.where(move_up, middle_high, high - GOLDEN_RATIO * (high - low)), \
+                np.where(move_up, low + GOLDEN_RATIO * (high - low), middle_low)
+            new_values = self.log_stratum_p_values(np.where(move_up, middle_high, middle_low), counts)
+            value_low, value_high = np.where(move_up, value_high, new_values), np.where(move_up, new_values, value_low)
+        log_q = np.maximum(best_log_p, np.maximum(value_low, value_high))
+
+        # Fisher's combination of two p-values with product q is
+        # P(chi-squared with 4 degrees of freedom >= -2 log q) = q (1 - log q)
+        with np.errstate(invalid='ignore'):
+            return np.where(log_q == -np.inf, 0., np.exp(log_q) * (1 - log_q))
+
+    def measured_risk(self):
+        """ Returns the largest p-value of any winner/loser pair. """
+        if (self.margins <= 0).any():
+            return 1.
+        return float(self.p_values().max())
+
+    def check_ballot(self, ballot_votes):
+        """ Returns the marks of a ballot, with overvotes counting as no votes. """
+        assert all(0 <= vote < self.num_candidates for vote in ballot_votes)
+        marks = np.zeros([1, self.num_candidates], dtype=bool)
+        if len(ballot_votes) <= self.num_winners:
+            marks[0, list(ballot_votes)] = True
+        return marks
+
+    def apply_observation(self, observation):
+        """
+        Advances the audit by one drawn ballot. `observation` holds the list
+        of candidates marked on the paper ballot and, for ballots of the CVR
+        stratum, on its CVR (None in the no-CVR stratum).
+        """
+        sequence_number = self.pending_sequence_numbers.popleft() if self.pending_sequence_numbers else None
+        ballot_votes, CVR_votes = observation
+        if sequence_number is not None:
+            assert (sequence_number <= self.num_cvr_ballots) == (CVR_votes is not None)
+
+        paper = self.check_ballot(ballot_votes)
+        if CVR_votes is not None:
+            self.kaplan_markov.update(paper, self.check_ballot(CVR_votes))
+        else:
+            self.polling_counts += self.polling_increments(paper)[0]
+        self.ballots_tested += 1
+        self.check_finished()
+
+    def polling_increments(self, paper):
+        """
+        Returns the polling counts (ballots x pairs x 3) added by no-CVR
+        ballots with the marks `paper` (ballots x candidates). A ballot
+        marking both the winner and the loser of a pair counts as neither.
+        """
+        for_winner = paper[:, self.pair_winners]
+        for_loser = paper[:, self.pair_losers]
+        one_of_them = for_winner ^ for_loser
+        return np.stack([for_winner & one_of_them, for_loser & one_of_them, ~one_of_them], axis=-1)
+
+    def apply_observation_block(self, observations):
+        """
+        Advances the audit by several drawn ballots, in the format of
+        `apply_observation`, evaluating the risk after each of them at once.
+        Returns the number of ballots applied, which is less than the
+        number of observations if the audit finished part way.
+        """
+        num_observations = len(observations)
+        pending = self.pending_sequence_numbers
+        for sequence_number, (_, CVR_votes) in zip(list(pending)[:num_observations], observations):
+            assert (sequence_number <= self.num_cvr_ballots) == (CVR_votes is not None)
+        has_cvr = np.array([CVR_votes is not None for _, CVR_votes in observations])
+        paper = np.concatenate([self.check_ballot(ballot_votes) for ballot_votes, _ in observations])
+        cvr = np.concatenate([self.check_ballot(CVR_votes) for _, CVR_votes in observations if CVR_votes is not None]
+                             or [np.zeros([0, self.num_candidates], dtype=bool)])
+
+        # Counts after each ballot of the block
+        kaplan_markov = self.kaplan_markov
+        num_pairs = len(self.margins)
+        discrepancies = kaplan_markov.discrepancies(paper[has_cvr], cvr).reshape(-1, num_pairs)
+        discrepancy_increments = np.zeros([num_observations, num_pairs, len(DISCREPANCIES)], dtype=np.int64)
+        discrepancy_increments[has_cvr] = discrepancies[:, :, np.newaxis] == DISCREPANCIES
+        polling_increments = np.zeros([num_observations, num_pairs, 3], dtype=np.int64)
+        polling_increments[~has_cvr] = self.polling_increments(paper[~has_cvr])
+        ballots_audited, discrepancy_counts, polling_counts = self.stratum_counts()
+        counts = (ballots_audited + np.cumsum(has_cvr),
+                  discrepancy_counts + np.cumsum(discrepancy_increments, axis=0),
+                  polling_counts + np.cumsum(polling_increments, axis=0))
+
+        # Stop at the first ballot checked by check_finished that ends the audit
+        risk_limit_met = self.p_value_path(counts).max(axis=1) <= self.risk_limit
+        max_tests_reached = self.ballots_tested + np.arange(1, num_observations + 1) >= self.max_tests
+        stops = np.flatnonzero(risk_limit_met | max_tests_reached)
+        num_applied = int(stops[0]) + 1 if len(stops) else num_observations
+
+        for _ in range(min(num_applied, len(pending))):
+            pending.popleft()
+        num_cvr_applied = int(has_cvr[:num_applied].sum())
+        kaplan_markov.update(paper[has_cvr][:num_cvr_applied], cvr[:num_cvr_applied])
+        self.polling_counts = counts[2][num_applied - 1]
+        self.ballots_tested += num_applied
+        if risk_limit_met[num_applied - 1]:
+            self.finish(True)
+        elif max_tests_reached[num_applied - 1]:
+            self.finish(False)
+        return num_applied
+
+    def submit_batch(self, observations, num_draws):
+        """
+        Same as `BaseAudit.submit_batch`, applying the observations in blocks
+        of BLOCK_SIZE with `apply_observation_block`.
+        """
+        num_applied = 0
+        for start in range(0, len(observations), BLOCK_SIZE):
+            if self.IS_DONE:
+                break
+            num_applied += self.apply_observation_block(observations[start:start + BLOCK_SIZE])
+        _, sequence_numbers = super().submit_batch([], num_draws)
+        return num_applied, sequence_numbers
+
+    def check_finished(self):
+        if self.measured_risk() <= self.risk_limit:
+            self.finish(True)
+        elif self.ballots_tested >= self.max_tests:
+            self.finish(False)
+
+    def get_sequence_number(self):
+        sequence_number = super().get_sequence_number()
+        self.pending_sequence_numbers.append(sequence_number)
+        return sequence_number
+
+    def finish(self, audit_result):
+        """
+        Marks the audit as done. `audit_result` is True when the p-value of
+        every winner/loser pair is within the risk limit.
+        """
+        self.IS_DONE = True
+
+        if audit_result:
+            self.IS_DONE_MESSAGE = "Audit completed: results stand."
+            self.IS_DONE_FLAG = "success"
+        else:
+            self.IS_DONE_MESSAGE = "The audit cannot verify the election results. Please perform a full hand recount."
+            self.IS_DONE_FLAG = "danger"
+
+if __name__ == "__main__":
+    ##### DUMMY DATA ######
+    CVR_VOTES = [3000, 2400, 300]
+    NO_CVR_VOTES = [1100, 1000, 100]
+    ALPHA = .05
+    SEED = 1234567890
+    ######################
+    audit = Hybrid(CVR_VOTES, NO_CVR_VOTES, 6000, 2400, 1, ALPHA, SEED, 1.03, 0)
+    sequence = audit.get_sequence_number()
+    while sequence is not None:
+        if sequence <= audit.num_cvr_ballots:
+            sequence = audit.submit([[0], [0]])
+        else:
+            sequence = audit.submit([[0], None])
+    print(audit.ballots_tested, audit.IS_DONE_MESSAGE)
@@ -0,0 +1,191 @@
+import random
+import math
+import numpy as np
+from .shared_objects.arrange_candidates import arrange_candidates
+from .shared_objects.BaseAudit import BaseAudit
+
+class MultiBravo(BaseAudit):
+    """ Ballot-polling audit of several contests from one sample
+    Runs the BRAVO test of every contest on the same drawn ballots, so each
+    ballot is retrieved once however many contests it carries. The audit
+    stops when every contest is confirmed, i.e. when the contest with the
+    smallest margin is.
+
+    `contests` is a list of (votes_array, num_winners) pairs. Candidates of
+    all contests share one index: candidate i of contest c is
+    `contest_offsets[c] + i`. Every winner/loser pair of every contest is one
+    null hypothesis, and the log test statistics of all of them are updated
+    together for each ballot.
+    """
+    def __init__(self, contests, num_ballots, risk_limit, seed, max_tests):
+        super().__init__()
+        # Set audit variables equal to parameters and sanity check
+        assert len(contests) > 0
+        for votes_array, num_winners in contests:
+            assert all(votes >= 0 for votes in votes_array)
+            assert num_ballots >= sum(votes_array)
+            assert num_winners < len(votes_array)
+        self.contests = contests
+        self.num_contests = len(contests)
+        self.num_ballots = num_ballots
+        assert 0. < risk_limit <= 1.
+        self.risk_limit = risk_limit
+
+        self.random_gen = random.Random()
+        self.seed = seed
+        self.random_gen.seed(seed)
+
+        if max_tests <= 0:
+            self.max_tests = num_ballots
+        else:
+            self.max_tests = min(max_tests, num_ballots)
+
+        # Contest -> candidate index
+        contest_sizes = [len(votes_array) for votes_array, _ in contests]
+        self.contest_offsets = np.concatenate(([0], np.cumsum(contest_sizes)))
+        self.num_candidates = int(self.contest_offsets[-1])
+
+        self.pair_contests, self.increments = self.get_increments()
+        self.num_null_hypotheses = len(self.pair_contests)
+        self.log_threshold = math.log(1/risk_limit)
+        self.log_test_stat = np.zeros(self.num_null_hypotheses)
+        self.max_log_test_stat = np.zeros(self.num_null_hypotheses)
+        self.rejected = np.zeros(self.num_null_hypotheses, dtype=bool)
+        self.ballots_tested = 0
+
+    def get_increments(self):
+        """
+        Return the contest of every winner/loser pair, and a
+        num_candidates x num_pairs array of the amounts a vote for each
+        candidate adds to the log test statistic of each pair:
+        log(2*margin) for the pair's winner, log(2*(1-margin)) for its loser
+        and 0 for everyone else.
+        """
+        pairs = []
+        for contest, (votes_array, num_winners) in enumerate(self.contests):
+            offset = self.contest_offsets[contest]
+            candidates = arrange_candidates(votes_array, num_winners)
+            for winner in sorted(candidates.winners):
+                for loser in sorted(candidates.losers):
+                    margin = votes_array[winner] / (votes_array[winner] + votes_array[loser])
+                    pairs.append((contest, offset + winner, offset + loser, margin))
+
+        pair_contests = np.array([pair[0] for pair in pairs], dtype=np.intp)
+        increments = np.zeros([self.num_candidates, len(pairs)])
+        with np.errstate(divide='ignore'):
+            for index, (_, winner, loser, margin) in enumerate(pairs):
+                increments[winner, index] = np.log(2*margin)
+                increments[loser, index] = np.log(2*(1-margin))
+        return pair_contests, increments
+
+    def check_ballot(self, ballot_votes):
+        """
+        Validates the votes recorded for the drawn ballot, one list of
+        candidate indices per contest, and returns them as shared candidate
+        indices. Overvoted contests count as a contest with no votes, and a
+        candidate listed twice counts as one mark.
+        """
+        assert isinstance(ballot_votes, list) and len(ballot_votes) == self.num_contests
+        votes = []
+        for contest, (contest_votes, (votes_array, num_winners)) in enumerate(zip(ballot_votes, self.contests)):
+            assert all(0 <= vote < len(votes_array) for vote in contest_votes)
+            contest_votes = sorted(set(contest_votes))
+            if len(contest_votes) <= num_winners:
+                votes.extend(self.contest_offsets[contest] + vote for vote in contest_votes)
+        return votes
+
+    def count_votes(self, ballots):
+        """
+        Return the number of votes for each candidate (shared index) on
+        `ballots`, a list of ballots in the format of `check_ballot`.
+        """
+        votes = [vote for ballot_votes in ballots for vote in self.check_ballot(ballot_votes)]
+        return np.bincount(np.asarray(votes, dtype=np.intp), minlength=self.num_candidates)
+
+    def update_audit_stats(self, log_increment):
+        """
+        Adds `log_increment` to the log test statistic of every pair and
+        rejects the null hypotheses that reached 1/risk_limit.
+        """
+        with np.errstate(invalid='ignore'):
+            self.log_test_stat += log_increment
+        np.maximum(self.max_log_test_stat, self.log_test_stat, out=self.max_log_test_stat)
+        self.rejected |= self.log_test_stat >= self.log_threshold
+
+    def contests_confirmed(self):
+        """
+        Return a boolean array which is True for each contest whose null
+        hypotheses have all been rejected.
+        """
+        pending = np.bincount(self.pair_contests[~self.rejected], minlength=self.num_contests)
+        return pending == 0
+
+    def measured_risks(self):
+        """
+        Return the measured risk of each contest: the smallest risk limit at
+        which the ballots tested so far would have confirmed it, which is the
+        largest measured risk of its winner/loser pairs.
+        """
+        risks = np.zeros(self.num_contests)
+        np.maximum.at(risks, self.pair_contests, np.exp(-self.max_log_test_stat))
+        return risks.tolist()
+
+    def check_finished(self):
+        confirmed = self.contests_confirmed()
+        if confirmed.all():
+            self.finish(True)
+        elif self.ballots_tested >= self.max_tests:
+            self.finish(False, np.flatnonzero(~confirmed).tolist())
+
+    def apply_observation(self, ballot_votes):
+        """
+        Runs one iteration of BRAVO for every contest given the votes
+        recorded on a single drawn ballot.
+        """
+        votes = self.check_ballot(ballot_votes)
+        self.update_audit_stats(self.increments[votes].sum(axis=0))
+        self.ballots_tested += 1
+        self.check_finished()
+
+    def apply_observation_block(self, vote_counts, num_ballots):
+        """
+        Applies `num_ballots` drawn ballots at once, given the number of
+        votes for each candidate among them (see `count_votes`). Hypotheses
+        are only checked at the end of the block.
+        """
+        vote_counts = np.asarray(vote_counts)
+        assert len(vote_counts) == self.num_candidates
+        voted = vote_counts > 0
+        self.update_audit_stats(vote_counts[voted] @ self.increments[voted])
+        self.ballots_tested += num_ballots
+        self.check_finished()
+
+    def finish(self, audit_result, unconfirmed_contests=()):
+        """
+        Marks the audit as done. `audit_result` is True when every contest
+        was confirmed within `max_tests` ballots, otherwise
+        `unconfirmed_contests` lists the contests that need a hand count.
+        """
+        self.IS_DONE = True
+
+        if audit_result:
+            self.IS_DONE_MESSAGE = "Audit completed: the results of every contest stand."
+            self.IS_DONE_FLAG = "success"
+        else:
+            contest_numbers = ', '.join(str(contest + 1) for contest in unconfirmed_contests)
+            self.IS_DONE_MESSAGE = f"Too many ballots tested. Perform a full hand-recount of contests {contest_numbers}."
+            self.IS_DONE_FLAG = "danger"
+
+if __name__ == "__main__":
+    ##### DUMMY DATA ######
+    CONTESTS = [([600, 400], 1), ([700, 200, 100], 1)]
+    NUM_BALLOTS = 1000
+    ALPHA = .10
+    MAX_TESTS = 0
+    SEED = 1234567890
+    ######################
+    audit = MultiBravo(CONTESTS, NUM_BALLOTS, ALPHA, SEED, MAX_TESTS)
+    sequence = audit.get_sequence_number()
+    while sequence is not None:
+        sequence = audit.submit([[0], [0]])
+    print(audit.IS_DONE_MESSAGE)
@@ -1,11 +1,15 @@
 from math import log, ceil
+from collections import deque
+from itertools import chain
 import random
+import numpy as np
 from .shared_objects.arrange_candidates import arrange_candidates
 from .shared_objects.Candidates import Candidates
 from .shared_objects.BaseAudit import BaseAudit
+from .shared_objects.KaplanMarkov import KaplanMarkov
 
 class SuperSimple(BaseAudit):
-    def __init__(self, votes_array, num_ballots, num_winners, risk_limit, seed, inflation_rate, tolerance):
+    def __init__(self, votes_array, num_ballots, num_winners, risk_limit, seed, inflation_rate, tolerance, cvr_id=None):
         super().__init__()
         self.votes_array = votes_array
         self.num_ballots = num_ballots
@@ -14,7 +18,11 @@ class SuperSimple(BaseAudit):
         self.seed = seed
         self.inflation_rate = inflation_rate
         self.tolerance = tolerance
-        self.kaplan_p_value = 1.0
+        # Export in the server's CVR store to look up the CVRs of drawn
+        # ballots in, or None if the CVRs are entered with each ballot
+        self.cvr_id = cvr_id
+        # Sequence numbers drawn but not yet applied, in draw order
+        self.pending_sequence_numbers = deque()
         self.ballots_audited = 1
         self.num_candidates = len(votes_array)
 
@@ -23,8 +31,21 @@ class SuperSimple(BaseAudit):
 
         self.multiplier = self.multiplier()
         self.diluted_margin = self.diluted_margin()
-        self.total_error_bound = 2 * self.inflation_rate / self.diluted_margin
         self.candidates = arrange_candidates(votes_array, num_winners)
+        self.winner_mask = np.zeros(self.num_candidates, dtype=bool)
+        self.winner_mask[list(self.candidates.winners)] = True
+        # Kaplan-Markov p-values of every winner/loser pair, checked after every ballot
+        self.kaplan_markov = KaplanMarkov(votes_array, num_ballots, num_winners, inflation_rate)
+
+        # Progress of the audit, advanced by apply_observation
+        self.in_kaplan_phase = False
+        self.initial_sample_size = self.sample_size()
+        # Calculate max number of max one vote overstatements allowed before a hand recount
+        self.max_overstatements = ceil(self.diluted_margin * self.tolerance * self.num_ballots)
+        # Overstatement is +1, understatement is -1
+        self.overstatements = np.zeros(self.num_candidates, dtype=np.int64)
+        if self.initial_sample_size >= self.num_ballots:
+            self.hand_recount()
 
     def multiplier(self):
         return -log(self.risk_limit)/(1/(2*self.inflation_rate) + self.tolerance * log(1 - 1/(2*self.inflation_rate)))
@@ -39,29 +60,6 @@ class SuperSimple(BaseAudit):
     def sample_size(self):
         return self.multiplier/self.diluted_margin
 
-    def get_votes_wrapper(self):
-        """
-        Returns ballot votes and corresponding CVR votes for given ballot number.
-        """
-        votes = self.get_votes()
-        return votes[0], votes[1]
-
-    def get_ballot_and_CVR(self):
-        """
-        Randomly picks a ballot to test and returns a set of its votes and
-        those of the corresponding CVR.
-        (A vote is denoted by a candidate's index's presence in the set.)
-        The ballot picked is returned to the frontend for the user to input
-        actual votes on the ballot and the vote recorded on the corresponding
-        CVR.  The ballot should be selected using a
-        random function seeded by a user-generated seed.
-        Note: 'random' should be seeded before this function is called.
-        """
-        num_winners = self.num_winners
-        ballot_votes, CVR_votes = self.get_votes_wrapper()
-
-        return ballot_votes, CVR_votes
-
     def hand_recount(self):
         # Stop audit and ask user to hand recount everything
         self.IS_DONE_MESSAGE = "The audit cannot verify the election results. Please perform a full hand recount."
@@ -75,101 +73,222 @@ class SuperSimple(BaseAudit):
         self.IS_DONE = True
         return 0
 
-    def update_p_value(self, ballot_votes, CVR_votes):
-        # Update kaplan p-value (not used unless ballot moves past first state)
-        # list of candidate numbers that cvr and human have listed as a vote
-        macro = 0
-        maxwinner = 0
-        maxloser = 0
-        temp = 0
-        for candidate in range(self.num_candidates):
-            in_CVR = candidate in CVR_votes
-            in_ballot = candidate in ballot_votes
-            if candidate in self.candidates.winners:
-                temp = in_CVR - in_ballot
-                maxwinner = max(temp, maxwinner)
-            else:
-                temp = in_ballot - in_CVR
-                maxloser = max(temp, maxloser)
-        macro = (maxwinner + maxloser)/self.ballots_audited
-        # update p-value
-        self.kaplan_p_value *= (1 - 1/self.total_error_bound)/(1 - (macro/(2 * self.inflation_rate / self.ballots_audited)))
-
-    def run_audit(self):
-        try:
-            print("98")
-            sample_size = self.sample_size()
-            if sample_size >= self.num_ballots:
+    def encode_selections(self, selections):
+        """
+        Returns a boolean matrix (ballots x candidates) which is True where
+        a ballot of `selections`, a list of lists of candidate numbers,
+        marks the candidate.
+        """
+        rows = np.repeat(np.arange(len(selections)), [len(ballot) for ballot in selections])
+        columns = np.fromiter(chain.from_iterable(selections), dtype=np.intp, count=len(rows))
+        assert ((0 <= columns) & (columns < self.num_candidates)).all()
+        marked = np.zeros((len(selections), self.num_candidates), dtype=bool)
+        marked[rows, columns] = True
+        return marked
+
+    def classify_discrepancies(self, ballot_votes, CVR_votes):
+        """
+        Records the over- and understatements between a paper ballot and its
+        CVR in `overstatements`.
+        Returns False, without recording anything, if the ballot has more
+        than one discrepancy, in which case the audit cannot continue.
+        """
+        overstatements = self.overstatements
+        # Ballot is an overvote and CVR shows valid vote. Mark everything in CVR as an overstatement.
+        if len(ballot_votes) > self.num_winners and len(CVR_votes) <= self.num_winners:
+            for candidate in CVR_votes:
+                overstatements[candidate] += 1
+        # CVR is an overvote but Ballot is valid, list all candidates on ballot as an understatement
+        elif len(ballot_votes) <= self.num_winners and len(CVR_votes) > self.num_winners:
+            for candidate in ballot_votes:
+                overstatements[candidate] -= 1
+        # Guaranteed neither CVR or Human are overvoted ballots
+        elif len(ballot_votes) <= self.num_winners and len(CVR_votes) <= self.num_winners:
+            mismatches = [candidate for candidate in range(self.num_candidates)
+                          if (candidate in CVR_votes) != (candidate in ballot_votes)]
+            # check if number of errors is greater than 1 on a single ballot
+            if len(mismatches) > 1:
+                return False
+            for candidate in mismatches:
+                # an overstatement if only the CVR has it, an understatement if only the ballot does
+                overstatements[candidate] += 1 if candidate in CVR_votes else -1
+        return True
+
+    def classify_discrepancies_block(self, paper, cvr):
+        """
+        Classifies the discrepancies of a batch of ballots at once, given
+        boolean matrices (ballots x candidates) of the selections on the
+        paper ballots and their CVRs, following `classify_discrepancies`.
+        Returns boolean matrices of the overstatements and understatements
+        of each ballot, and whether each ballot has more than one
+        discrepancy.
+        """
+        paper_overvoted = (paper.sum(axis=1) > self.num_winners)[:, np.newaxis]
+        cvr_overvoted = (cvr.sum(axis=1) > self.num_winners)[:, np.newaxis]
+        # Neither the CVR nor the paper ballot is an overvote: compare candidate by candidate
+        both_valid = ~paper_overvoted & ~cvr_overvoted
+        overstated = np.where(both_valid, cvr & ~paper, paper_overvoted & ~cvr_overvoted & cvr)
+        understated = np.where(both_valid, paper & ~cvr, cvr_overvoted & ~paper_overvoted & paper)
+        too_many_discrepancies = both_valid[:, 0] & ((cvr ^ paper).sum(axis=1) > 1)
+        return overstated, understated, too_many_discrepancies
+
+    def end_initial_sample(self):
+        """
+        Decides whether the audit can stop after the initial sample or has
+        to be continued until the Kaplan-Markov p-value is within the risk
+        limit.
+        """
+        # Check if Audit needs to be continued
+        if not (self.overstatements[self.winner_mask] > self.max_overstatements).any():
+            return self.audit_success()
+
+        # If at this point, no overstatement is above max_overstatements
+        # continue hand recount using Kaplan P-Value, stop if p-value
+        self.in_kaplan_phase = True
+        if self.ballots_audited >= self.num_ballots:
+            return self.hand_recount()
+
+    def apply_observation(self, observation):
+        """
+        Advances the audit by one drawn ballot. `observation` holds the list
+        of candidates marked on the paper ballot and on the corresponding CVR.
+        """
+        if self.pending_sequence_numbers:
+            self.pending_sequence_numbers.popleft()
+        # list of candidate numbers that cvr and human have listed as a vote,
+        # a candidate listed twice is one mark as in encode_selections
+        ballot_votes, CVR_votes = (sorted(set(votes)) for votes in observation)
+        self.kaplan_markov.update(self.encode_selections([ballot_votes]), self.encode_selections([CVR_votes]))
+
+        if not self.in_kaplan_phase:
+            if not self.classify_discrepancies(ballot_votes, CVR_votes):
                 return self.hand_recount()
-            # Calculate max number of max one vote overstatements allowed before a hand recount
-            max_overstatements = ceil(self.diluted_margin * self.tolerance * self.num_ballots)
-            # Overstatement is +1, understatement is -1
-            overstatements = [0 for candidate in range(len(self.votes_array))]
-            while self.ballots_audited <= sample_size:
-                # list of candidate numbers that cvr and human have listed as a vote
-                ballot_votes, CVR_votes = self.get_ballot_and_CVR()
-                self.update_p_value(ballot_votes, CVR_votes)
-                # Ballot is an overvote and CVR shows valid vote. Mark everything in CVR as an overstatement.
-                if len(ballot_votes) > self.num_winners and len(CVR_votes) <= self.num_winners:
-                    for candidate in CVR_votes:
-                        overstatements[candidate] += 1
-                # CVR is an overvote but Ballot is valid, list all candidates on ballot as an understatement
-                elif len(ballot_votes) <= self.num_winners and len(CVR_votes) > self.num_winners:
-                    for candidate in ballot_votes:
-                        overstatements[candidate] -= 1
-                # CVR and Human both show overvote, dont do anything
-                elif len(ballot_votes) > self.num_winners and len(CVR_votes) > self.num_winners:
-                    continue
-                # Guaranteed neither CVR or Human are overvoted ballots
-                else:
-                    num_mismatches = 0
-                    for candidate in range(self.num_candidates):
-                        in_CVR = candidate in CVR_votes
-                        in_ballot = candidate in ballot_votes
-                        if not in_ballot and in_CVR:
-                            num_mismatches += 1
-                            # check if number of errors is greater than 1 on a single ballot
-                            if num_mismatches > 1:
-                                return self.hand_recount()
-                            # an overstatement is found
-                            overstatements[candidate] += 1
-                        if in_ballot and not in_CVR:
-                            num_mismatches += 1
-                            # check if number of errors is greater than 1 on a single ballot
-                            if num_mismatches > 1:
-                                return self.hand_recount()
-                            # an understatement is found
-                            overstatements[candidate] -= 1
-                self.ballots_audited += 1
-            # Check if Audit needs to be continued
-            can_stop = True
-            for candidate in range(self.num_candidates):
-                # if candidate is a winner
-                if candidate in self.candidates.winners:
-                    if overstatements[candidate] > max_overstatements:
-                        can_stop = False
-
-            if can_stop:
+            # The p-value is valid after any ballot, so the initial sample can stop early
+            if self.kaplan_markov.risk_limit_met(self.risk_limit):
                 return self.audit_success()
+            # CVR and Human both show overvote, the ballot is not counted
+            if len(ballot_votes) > self.num_winners and len(CVR_votes) > self.num_winners:
+                return
+            self.ballots_audited += 1
+            if self.ballots_audited > self.initial_sample_size:
+                self.end_initial_sample()
+            return
 
-            # If at this point, no overstatement is above max_overstatements
-            # continue hand recount using Kaplan P-Value, stop if p-value
-            while(self.ballots_audited < self.num_ballots):
-                ballot_votes, CVR_votes = self.get_ballot_and_CVR()
-                self.update_p_value(ballot_votes, CVR_votes)
-                if self.kaplan_p_value <= self.risk_limit:
-                    break
-                self.ballots_audited += 1
-            # Audit is finished
-            if self.ballots_audited < self.num_ballots:
-                return self.audit_success()
-            else:
-                return self.hand_recount()
-        except:
-            return "Exception Raised"
+        # Audit is finished
+        if self.kaplan_markov.risk_limit_met(self.risk_limit):
+            return self.audit_success()
+        self.ballots_audited += 1
+        if self.ballots_audited >= self.num_ballots:
+            return self.hand_recount()
+
+    def apply_observation_block(self, paper, cvr):
+        """
+        Advances the audit by a batch of drawn ballots, given boolean
+        matrices (ballots x candidates) of the selections on the paper
+        ballots and their CVRs (see `encode_selections`). The result is the
+        same as applying the ballots one at a time with `apply_observation`.
+        Returns the number of ballots applied, which is less than the batch
+        size if the audit finished part way.
+        """
+        for _ in range(min(len(paper), len(self.pending_sequence_numbers))):
+            self.pending_sequence_numbers.popleft()
+        # Whether every pair is within the risk limit after each ballot
+        log_p_values = self.kaplan_markov.log_p_value_path(paper, cvr)
+        risk_limit_met = (log_p_values <= log(self.risk_limit)).all(axis=(1, 2))
+        num_applied = self.advance_block(paper, cvr, risk_limit_met)
+        self.kaplan_markov.update(paper[:num_applied], cvr[:num_applied])
+        return num_applied
+
+    def advance_block(self, paper, cvr, risk_limit_met):
+        """
+        Applies the stopping rules of `apply_observation` to a batch of
+        ballots, given whether the Kaplan-Markov p-value is within the risk
+        limit after each of them. Returns the number of ballots applied.
+        """
+        num_observations = len(paper)
+        start = 0
+        if not self.in_kaplan_phase:
+            overstated, understated, too_many_discrepancies = self.classify_discrepancies_block(paper, cvr)
+            # Ballots that are an overvote on both the CVR and the paper are not counted
+            # and a ballot with too many discrepancies ends the audit
+            counted = ~((paper.sum(axis=1) > self.num_winners) & (cvr.sum(axis=1) > self.num_winners)) \
+                & ~too_many_discrepancies
+            ballots_audited = self.ballots_audited + np.cumsum(counted)
+            first_invalid = first_true(too_many_discrepancies)
+            first_within_risk_limit = first_true(risk_limit_met)
+            first_past_initial_sample = first_true(counted & (ballots_audited > self.initial_sample_size))
+
+            # Checked in the order of apply_observation
+            if first_invalid < num_observations and first_invalid <= first_within_risk_limit \
+                    and first_invalid < first_past_initial_sample:
+                self.overstatements += overstated[:first_invalid].sum(axis=0) - understated[:first_invalid].sum(axis=0)
+                self.ballots_audited = int(ballots_audited[first_invalid])
+                self.hand_recount()
+                return first_invalid + 1
+
+            if first_within_risk_limit < num_observations and first_within_risk_limit <= first_past_initial_sample:
+                end = first_within_risk_limit + 1
+                self.overstatements += overstated[:end].sum(axis=0) - understated[:end].sum(axis=0)
+                self.ballots_audited = int(ballots_audited[first_within_risk_limit] - counted[first_within_risk_limit])
+                self.audit_success()
+                return end
+
+            end = min(first_past_initial_sample + 1, num_observations)
+            self.overstatements += overstated[:end].sum(axis=0) - understated[:end].sum(axis=0)
+            if end > 0:
+                self.ballots_audited = int(ballots_audited[end - 1])
+            if first_past_initial_sample == num_observations:
+                return num_observations
+            self.end_initial_sample()
+            if self.IS_DONE:
+                return end
+            start = end
+
+        # Kaplan phase: stop at the first ballot that brings the p-value
+        # within the risk limit or that exhausts the ballots
+        succeeded = risk_limit_met[start:]
+        ballots_audited = self.ballots_audited + np.arange(len(succeeded))
+        exhausted = ballots_audited + 1 >= self.num_ballots
+        stop = first_true(succeeded | exhausted)
+        if stop == len(succeeded):
+            self.ballots_audited += len(succeeded)
+            return num_observations
+
+        if succeeded[stop]:
+            self.ballots_audited = int(ballots_audited[stop])
+            self.audit_success()
+        else:
+            self.ballots_audited = int(ballots_audited[stop]) + 1
+            self.hand_recount()
+        return start + stop + 1
+
+    def submit_batch(self, observations, num_draws):
+        """
+        Same as `BaseAudit.submit_batch`, applying the observations as one
+        block with `apply_observation_block`.
+        """
+        num_applied = 0
+        if observations and not self.IS_DONE:
+            paper = self.encode_selections([ballot_votes for ballot_votes, _ in observations])
+            cvr = self.encode_selections([CVR_votes for _, CVR_votes in observations])
+            num_applied = self.apply_observation_block(paper, cvr)
+        _, sequence_numbers = super().submit_batch([], num_draws)
+        return num_applied, sequence_numbers
+
+    def get_sequence_number(self):
+        sequence_number = super().get_sequence_number()
+        self.pending_sequence_numbers.append(sequence_number)
+        return sequence_number
+
+def first_true(mask):
+    """ Returns the index of the first True entry of `mask`, or its length if there is none. """
+    return int(mask.argmax()) if mask.any() else len(mask)
 
 if __name__ == "__main__":
     #     def __init__(self, votes_array, num_ballots, num_winners, risk_limit, seed, inflation_rate, tolerance):
     params = [[10, 5], 15, 1, .05, 345678765432, 1.1, .5]
     ss = SuperSimple(*params)
-    ss.run_audit()
+    sequence = ss.get_sequence_number()
+    while sequence is not None:
+        sequence = ss.submit([[0], [0]])
+    print(ss.IS_DONE_MESSAGE)
@@ -0,0 +1,111 @@
+"""
+Offline audit runner.
+
+Recomputes the outcome of an audit from its parameters and the recorded
+interpretation of every drawn ballot (or batch), without a server. Each
+recorded ballot may carry the sequence number it was drawn as, which is
+checked against the seeded draws so observers can verify that the right
+ballots were pulled.
+
+Usage:
+    python -m audits.replay audit.json observations.jsonl
+
+`audit.json` holds the audit type and the keyword arguments of its class,
+with rates as fractions rather than percentages, e.g.
+    {"audit_type": "bravo",
+     "params": {"votes_array": [600, 400], "num_ballots": 1000, "num_winners": 1,
+                "risk_limit": 0.1, "seed": 1234, "max_tests": 0}}
+
+`observations.jsonl` has one JSON object per drawn ballot, in draw order:
+    bravo:        {"sequence_number": 7, "votes": [0]}
+    multi_bravo:  {"sequence_number": 7, "votes": [[0], [], [2]]}
+    super_simple: {"sequence_number": 7, "paper_record": [0], "cvr": [0]}
+    hybrid:       {"sequence_number": 7, "paper_record": [0], "cvr": [0]},
+                  without "cvr" for ballots of the no-CVR stratum
+    cast:         {"sequence_number": 3, "batch_votes": [51, 40]}
+"""
+import argparse
+import json
+import sys
+
+from .Bravo import Bravo
+from .Cast import Cast
+from .Hybrid import Hybrid
+from .MultiBravo import MultiBravo
+from .SuperSimple import SuperSimple
+
+AUDIT_CLASSES = {
+    'bravo': Bravo,
+    'multi_bravo': MultiBravo,
+    'super_simple': SuperSimple,
+    'hybrid': Hybrid,
+    'cast': Cast
+}
+
+def parse_observation(audit_type, record):
+    """
+    Converts a recorded ballot into the observation passed to `submit`.
+    """
+    if audit_type == 'bravo':
+        return [int(vote) for vote in record['votes']]
+    if audit_type == 'multi_bravo':
+        return [[int(vote) for vote in contest_votes] for contest_votes in record['votes']]
+    if audit_type == 'super_simple':
+        return [[int(vote) for vote in record['paper_record']],
+                [int(vote) for vote in record['cvr']]]
+    if audit_type == 'hybrid':
+        return [[int(vote) for vote in record['paper_record']],
+                [int(vote) for vote in record['cvr']] if 'cvr' in record else None]
+    return [int(vote) for vote in record['batch_votes']]
+
+def replay_audit(audit_type, params, records):
+    """
+    Runs the audit described by `audit_type` and `params` on the recorded
+    ballots `records` (dicts in the format of the observations file).
+    Returns a dict with the completion status and message, the flag and the
+    number of ballots used. Records after the audit finished are ignored.
+    Raises ValueError if a recorded sequence number does not match the draw.
+    """
+    if audit_type not in AUDIT_CLASSES:
+        raise ValueError(f'{audit_type} is an invalid audit type!')
+    audit = AUDIT_CLASSES[audit_type](**params)
+
+    ballots_used = 0
+    sequence_number = audit.get_sequence_number()
+    for record in records:
+        if audit.IS_DONE:
+            break
+        if 'sequence_number' in record and int(record['sequence_number']) != sequence_number:
+            raise ValueError(f'Ballot {ballots_used + 1} was recorded as sequence number '
+                             f'{record["sequence_number"]} but the audit drew {sequence_number}.')
+        sequence_number = audit.submit(parse_observation(audit_type, record))
+        ballots_used += 1
+
+    return {
+        'audit_complete': audit.IS_DONE,
+        'completion_message': audit.IS_DONE_MESSAGE,
+        'flag': audit.IS_DONE_FLAG,
+        'ballots_used': ballots_used
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recompute an audit outcome from recorded ballots.')
+    parser.add_argument('audit', help='JSON file with the audit type and parameters')
+    parser.add_argument('observations', help='JSON lines file with one recorded ballot per line')
+    args = parser.parse_args(argv)
+
+    with open(args.audit) as audit_file:
+        audit = json.load(audit_file)
+
+    try:
+        with open(args.observations) as observations_file:
+            records = (json.loads(line) for line in observations_file if line.strip())
+            result = replay_audit(audit['audit_type'], audit['params'], records)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(json.dumps(result))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
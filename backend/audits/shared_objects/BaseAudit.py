@@ -1,15 +1,19 @@
-import threading
-import queue
+import array
+import pickle
+import random
+import zlib
 
 class BaseAudit:
+    """
+    Audits are step-driven: the caller draws a ballot with
+    `get_sequence_number`, records its interpretation, and passes it to
+    `submit`, which returns the next ballot to draw. No thread is parked
+    between ballots, so an idle audit is just its statistics and the state of
+    its random generator.
+    """
     def __init__(self):
         # Initialized in subclass
         self.num_ballots = None
-
-        # global vars
-        self._VOTES_BUFFER = queue.Queue()
-        self._LOCK = threading.Lock()
-        self._CV = threading.Condition(self._LOCK)
         self.random_gen = None
 
         # status vars
@@ -17,26 +21,69 @@ class BaseAudit:
         self.IS_DONE_MESSAGE = ""
         self.IS_DONE_FLAG = ""
 
-    def append_votes_buffer(self, vote):
-        cv = self._CV
-        buffer = self._VOTES_BUFFER
-        cv.acquire()
-        buffer.put(vote)
-        cv.notify()
-        cv.release()
-
-    def get_votes(self):
-        cv = self._CV
-
-        cv.acquire()
-        buffer = self._VOTES_BUFFER
-        while buffer.empty():
-            print("wait condition")
-            cv.wait()
-        votes = buffer.get()
-        cv.release()
-
-        return votes
+    def __getstate__(self):
+        # Pack the Mersenne Twister state into 32-bit words, which is less
+        # than half the size of the pickled tuple of Python ints
+        state = self.__dict__.copy()
+        if state.get('random_gen') is not None:
+            version, internal_state, gauss_next = state['random_gen'].getstate()
+            state['random_gen'] = (version, array.array('I', internal_state).tobytes(), gauss_next)
+        return state
+
+    def __setstate__(self, state):
+        if state.get('random_gen') is not None:
+            version, internal_state, gauss_next = state['random_gen']
+            state['random_gen'] = random.Random()
+            state['random_gen'].setstate((version, tuple(array.array('I', internal_state)), gauss_next))
+        self.__dict__.update(state)
+
+    def dumps(self):
+        """Serializes the audit state so any worker process can resume it."""
+        return zlib.compress(pickle.dumps(self, pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def loads(data):
+        """Rebuilds an audit object from the output of `dumps`."""
+        return pickle.loads(zlib.decompress(data))
+
+    def apply_observation(self, observation):
+        """Advances the audit by one interpreted ballot (or batch)."""
+        raise NotImplementedError
+
+    def submit(self, observation):
+        """
+        Applies the interpretation of the last drawn ballot (or batch) and
+        returns the sequence number to draw next, or None once the audit is
+        done.
+        """
+        self.apply_observation(observation)
+        if self.IS_DONE:
+            return None
+        return self.get_sequence_number()
+
+    def submit_batch(self, observations, num_draws):
+        """
+        Applies the interpretations of several drawn ballots (or batches), in
+        the order they were drawn, and draws the next `num_draws` sequence
+        numbers.
+        Returns the number of observations applied, which is less than
+        len(observations) if the audit finished part way, and the list of
+        sequence numbers to draw next.
+        """
+        num_applied = 0
+        for observation in observations:
+            if self.IS_DONE:
+                break
+            self.apply_observation(observation)
+            num_applied += 1
+
+        sequence_numbers = []
+        while not self.IS_DONE and len(sequence_numbers) < num_draws:
+            sequence_number = self.get_sequence_number()
+            if sequence_number is None:
+                break
+            sequence_numbers.append(sequence_number)
+        return num_applied, sequence_numbers
 
     def get_sequence_number(self):
         """Returns random sequence number to draw ballot from."""
@@ -1,4 +1,22 @@
+import numpy as np
+
 class Hypotheses:
-    def __init__(self, test_stat_in):
-        self.test_stat = test_stat_in
-        self.reject_count = 0
\ No newline at end of file
+    """
+    BRAVO null hypotheses, one per winner/loser pair, as len(winners) x
+    len(losers) matrices. Test statistics are kept as logs so that long
+    samples neither overflow nor underflow, and each ballot is one addition
+    per pair.
+    """
+    def __init__(self, num_winners, num_losers):
+        self.log_test_stat = np.zeros([num_winners, num_losers])
+        # Largest value each log test statistic has reached so far
+        self.max_log_test_stat = np.zeros([num_winners, num_losers])
+        self.rejected = np.zeros([num_winners, num_losers], dtype=bool)
+        self.reject_count = 0
+
+    def measured_risk(self):
+        """
+        Returns the smallest risk limit at which each null hypothesis would
+        have been rejected so far, 1/max(test statistic) capped at 1.
+        """
+        return np.exp(-self.max_log_test_stat)
@@ -0,0 +1,91 @@
+import math
+import numpy as np
+from .arrange_candidates import arrange_candidates
+
+# Discrepancies, in votes, by which a CVR can overstate the margin between a
+# winner and a loser
+DISCREPANCIES = np.arange(-2, 3)
+
+class KaplanMarkov:
+    """ Kaplan-Markov risk measurement for ballot-level comparison audits
+    Keeps, for every winner/loser pair, the number of audited ballots with
+    each discrepancy and the log of the Kaplan-Markov p-value (Stark 2009,
+    "Risk-limiting post-election audits: P-values from common probability
+    inequalities"). The p-value of a pair with diluted margin m is
+
+        prod over audited ballots of (1 - 1/U) / (1 - e/(2*inflation_rate))
+
+    where U = 2*inflation_rate/m and e is the discrepancy of the ballot for
+    that pair, so each ballot adds one term per pair to the log p-value.
+    The p-value is valid after every ballot, so the audit can stop as soon
+    as all of them are within the risk limit.
+
+    `candidates` may give the winners and losers when they are not those of
+    `votes_array`, e.g. for one stratum of a contest.
+    """
+    def __init__(self, votes_array, num_ballots, num_winners, inflation_rate, candidates=None):
+        if candidates is None:
+            candidates = arrange_candidates(votes_array, num_winners)
+        self.num_winners = num_winners
+        self.winners = np.array(sorted(candidates.winners), dtype=np.intp)
+        self.losers = np.array(sorted(candidates.losers), dtype=np.intp)
+        votes = np.asarray(votes_array, dtype=float)
+        self.diluted_margins = (votes[self.winners, np.newaxis] - votes[self.losers]) / num_ballots
+
+        # log(1 - 1/U) for each pair and -log(1 - e/(2*inflation_rate)) for
+        # each discrepancy, which is +inf for 2-vote overstatements when
+        # inflation_rate is 1
+        self.log_ballot_factors = np.log1p(-self.diluted_margins / (2*inflation_rate))
+        with np.errstate(divide='ignore'):
+            self.log_discrepancy_factors = -np.log1p(-DISCREPANCIES / (2*inflation_rate))
+
+        self.discrepancy_counts = np.zeros([len(self.winners), len(self.losers), len(DISCREPANCIES)], dtype=np.int64)
+        self.log_p_values = np.zeros([len(self.winners), len(self.losers)])
+        self.ballots_audited = 0
+
+    def discrepancies(self, paper, cvr):
+        """
+        Returns a ballots x winners x losers array of the number of votes by
+        which each CVR overstates the margin of each pair, given boolean
+        matrices (ballots x candidates) of the selections on the paper
+        ballots and their CVRs. Overvotes count as ballots with no votes.
+        """
+        paper = paper & (paper.sum(axis=1) <= self.num_winners)[:, np.newaxis]
+        cvr = cvr & (cvr.sum(axis=1) <= self.num_winners)[:, np.newaxis]
+        overstated = cvr.astype(np.int8) - paper.astype(np.int8)
+        return overstated[:, self.winners, np.newaxis] - overstated[:, np.newaxis, self.losers]
+
+    def accumulate(self, discrepancies):
+        log_factors = self.log_ballot_factors + self.log_discrepancy_factors[discrepancies + 2]
+        # Accumulated in the same order as one ballot at a time
+        return np.cumsum(np.concatenate((self.log_p_values[np.newaxis], log_factors)), axis=0)[1:]
+
+    def log_p_value_path(self, paper, cvr):
+        """
+        Returns the log p-value of every pair after each ballot of a batch
+        (ballots x winners x losers), without applying the batch.
+        """
+        return self.accumulate(self.discrepancies(paper, cvr))
+
+    def update(self, paper, cvr):
+        """
+        Applies a batch of audited ballots, given boolean matrices
+        (ballots x candidates) of their paper and CVR selections.
+        """
+        if len(paper) == 0:
+            return
+        discrepancies = self.discrepancies(paper, cvr)
+        for index, discrepancy in enumerate(DISCREPANCIES):
+            self.discrepancy_counts[:, :, index] += (discrepancies == discrepancy).sum(axis=0)
+        self.log_p_values = self.accumulate(discrepancies)[-1]
+        self.ballots_audited += len(paper)
+
+    def risk_limit_met(self, risk_limit):
+        """ Whether the p-value of every pair is within `risk_limit`. """
+        return bool((self.log_p_values <= math.log(risk_limit)).all())
+
+    def measured_risk(self):
+        """ Returns the largest p-value of any pair, capped at 1. """
+        if self.log_p_values.size == 0:
+            return 0.
+        return math.exp(min(0., self.log_p_values.max()))
@@ -0,0 +1,42 @@
+"""
+Binomial distribution tails from a table of log factorials, for round size
+and stopping probability calculations without scipy.
+"""
+import math
+import numpy as np
+
+def log_factorials(n):
+    """Returns an array of log(k!) for k = 0, ..., n."""
+    table = np.zeros(n + 1)
+    np.cumsum(np.log(np.arange(1, n + 1)), out=table[1:])
+    return table
+
+def binomial_log_pmf(n, p, log_factorial=None):
+    """
+    Returns an array of log P(X = k) for k = 0, ..., n where X ~ Bin(n, p).
+    `log_factorial` may be a precomputed table of at least n + 1 entries.
+    """
+    if log_factorial is None:
+        log_factorial = log_factorials(n)
+    k = np.arange(n + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_pmf = log_factorial[n] - log_factorial[k] - log_factorial[n - k] \
+                + k * np.log(p) + (n - k) * np.log1p(-p)
+    # 0 * log(0) is 0 at the edges
+    if p == 0:
+        log_pmf = np.where(k == 0, 0., -np.inf)
+    elif p == 1:
+        log_pmf = np.where(k == n, 0., -np.inf)
+    return log_pmf
+
+def binomial_sf(k, n, p, log_factorial=None):
+    """Returns P(X >= k) where X ~ Bin(n, p)."""
+    if k <= 0:
+        return 1.
+    if k > n:
+        return 0.
+    log_pmf = binomial_log_pmf(n, p, log_factorial)[k:]
+    largest = log_pmf.max()
+    if largest == -math.inf:
+        return 0.
+    return min(1., math.exp(largest) * float(np.exp(log_pmf - largest).sum()))
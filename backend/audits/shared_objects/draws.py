@@ -0,0 +1,56 @@
+"""
+Vectorized ballot draws.
+
+`BaseAudit.get_sequence_number` draws one ballot at a time with
+`random_gen.randint(1, num_ballots)`. Python's `random.Random` and NumPy's
+`MT19937` are the same Mersenne Twister, so loading the state of `random_gen`
+into NumPy reproduces exactly the same sequence numbers, many at a time.
+"""
+import numpy as np
+
+def mt19937_from_random(random_gen):
+    """
+    Returns a NumPy MT19937 bit generator in the same state as the
+    `random.Random` instance `random_gen`. `random_gen` is not advanced.
+    """
+    internal_state = random_gen.getstate()[1]
+    bit_generator = np.random.MT19937()
+    bit_generator.state = {
+        'bit_generator': 'MT19937',
+        'state': {'key': np.array(internal_state[:-1], dtype=np.uint32), 'pos': internal_state[-1]}
+    }
+    return bit_generator
+
+def draw_sequence_numbers(random_gen, num_ballots, num_draws):
+    """
+    Returns an array of the next `num_draws` values of
+    `random_gen.randint(1, num_ballots)`, without advancing `random_gen`.
+    Like `randint`, draws are made by rejection sampling on the top
+    `num_ballots.bit_length()` bits of each 32-bit output.
+    """
+    assert 0 < num_ballots < 2**32
+    bit_generator = mt19937_from_random(random_gen)
+    num_bits = num_ballots.bit_length()
+    acceptance_rate = num_ballots / 2**num_bits
+
+    draws = np.empty(num_draws, dtype=np.int64)
+    num_drawn = 0
+    while num_drawn < num_draws:
+        # Over-draw slightly so that one pass is almost always enough
+        remaining = num_draws - num_drawn
+        num_words = int(remaining / acceptance_rate * 1.05) + 16
+        candidates = bit_generator.random_raw(num_words) >> np.uint64(32 - num_bits)
+        accepted = candidates[candidates < num_ballots][:remaining]
+        draws[num_drawn:num_drawn + len(accepted)] = accepted
+        num_drawn += len(accepted)
+    return draws + 1
+
+def pull_list(random_gen, num_ballots, num_draws):
+    """
+    Returns the distinct ballots among the next `num_draws` draws, sorted by
+    sequence number for retrieval, along with how many times each ballot was
+    drawn and the (1-based) draw at which it was first drawn.
+    """
+    draws = draw_sequence_numbers(random_gen, num_ballots, num_draws)
+    sequence_numbers, first_draw, times_drawn = np.unique(draws, return_index=True, return_counts=True)
+    return sequence_numbers, times_drawn, first_draw + 1
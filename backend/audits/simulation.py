@@ -0,0 +1,296 @@
+"""
+Monte Carlo workload projections.
+
+An average sample number says little about how many ballots an audit board
+should be ready to pull on a close contest. These functions run many
+simulated audits of a reported tally, assuming the reported results are
+correct, and report quantiles of the number of ballots drawn and how often
+the audit escalates to a full hand count.
+
+Trials are split into fixed chunks so results only depend on the seed, not on
+the number of processes. Simulations run in this process, or on a process
+pool started on first use with the spawn method, so it does not inherit the
+threads of a server worker, and shut down when the process exits. Within a chunk, BRAVO trials are simulated together
+as NumPy arrays, and super-simple trials run the audit engine itself on
+blocks of simulated ballots.
+"""
+import atexit
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from .shared_objects.arrange_candidates import arrange_candidates
+from .SuperSimple import SuperSimple
+
+QUANTILES = (50, 90, 99)
+TRIALS_PER_CHUNK = 2000
+# Number of draws simulated at once for every trial in a chunk
+DRAWS_PER_BLOCK = 256
+# Largest number of trial x draw x pair values held in one array by a BRAVO
+# chunk, contests with many winner/loser pairs get chunks of fewer trials
+MAX_BRAVO_BLOCK_VALUES = 1 << 20
+# Super-simple trials draw blocks that double in size up to this many ballots
+MAX_DRAWS_PER_BLOCK = 1 << 16
+# Kinds of discrepancy between a paper ballot and its CVR, for the closest
+# winner w and loser l:
+#   1-vote overstatement: CVR w, paper blank
+#   2-vote overstatement: CVR w, paper l
+#   1-vote understatement: CVR l, paper blank
+#   2-vote understatement: CVR l, paper w
+DISCREPANCY_KINDS = ('o1', 'o2', 'u1', 'u2')
+
+# Process pool kept for the life of the (server worker) process, with the pid
+# that started it and its number of processes
+_executor = None
+_executor_key = None
+_executor_lock = threading.Lock()
+
+def bravo_increments(votes_array, num_winners):
+    """
+    Return a (num_candidates + 1) x num_pairs array of the amounts each drawn
+    ballot adds to the log test statistic of each winner/loser pair. The last
+    row is a ballot with no vote for any candidate.
+    """
+    candidates = arrange_candidates(votes_array, num_winners)
+    pairs = [(winner, loser) for winner in sorted(candidates.winners) for loser in sorted(candidates.losers)]
+    increments = np.zeros([len(votes_array) + 1, len(pairs)])
+    with np.errstate(divide='ignore'):
+        for pair, (winner, loser) in enumerate(pairs):
+            margin = votes_array[winner] / (votes_array[winner] + votes_array[loser])
+            increments[winner, pair] = np.log(2*margin)
+            increments[loser, pair] = np.log(2*(1-margin))
+    return increments
+
+def simulate_bravo_chunk(votes_array, num_ballots, num_winners, risk_limit, max_tests, num_trials, seed):
+    """
+    Simulates `num_trials` BRAVO audits drawing ballots with replacement from
+    an electorate matching the reported tally. Returns the number of ballots
+    each audit drew before every null hypothesis was rejected, or -1 for
+    audits that reached `max_tests` and escalated to a full hand count.
+    """
+    rng = np.random.default_rng(seed)
+    probabilities = np.append(votes_array, num_ballots - sum(votes_array)) / num_ballots
+    increments = bravo_increments(votes_array, num_winners)
+    num_pairs = increments.shape[1]
+    log_threshold = math.log(1/risk_limit)
+
+    log_test_stat = np.zeros([num_trials, num_pairs])
+    # Draw at which each pair was rejected, 0 while it has not been
+    rejected_at = np.zeros([num_trials, num_pairs], dtype=np.int64)
+    num_drawn = 0
+    active = np.arange(num_trials)
+    while len(active) and num_drawn < max_tests:
+        num_draws = min(DRAWS_PER_BLOCK, max_tests - num_drawn)
+        draws = rng.choice(len(probabilities), size=(len(active), num_draws), p=probabilities)
+        with np.errstate(invalid='ignore'):
+            paths = log_test_stat[active, np.newaxis, :] + np.cumsum(increments[draws], axis=1)
+        crossed = paths >= log_threshold
+        first_crossing = np.where(crossed.any(axis=1), crossed.argmax(axis=1) + num_drawn + 1, 0)
+
+        pending = rejected_at[active] == 0
+        rejected_at[active] = np.where(pending, first_crossing, rejected_at[active])
+        log_test_stat[active] = paths[:, -1, :]
+        num_drawn += num_draws
+        active = active[(rejected_at[active] == 0).any(axis=1)]
+
+    stopping_sizes = rejected_at.max(axis=1)
+    stopping_sizes[(rejected_at == 0).any(axis=1)] = -1
+    return stopping_sizes
+
+def simulate_bravo(votes_array, num_ballots, num_winners, risk_limit, max_tests=0,
+                   num_trials=10000, seed=None, processes=None):
+    """
+    Projects the workload of a BRAVO audit of the reported tally
+    `votes_array` from `num_trials` simulated audits run on `processes`
+    worker processes (all cores by default). `max_tests` has the same meaning
+    as for `Bravo`.
+
+    Returns a dict with:
+    - 'quantiles': {50: n, 90: n, 99: n}, the number of ballots to pull for
+      that percentage of audits to finish, where audits that escalate count
+      as a full hand count of `num_ballots`
+    - 'escalation_probability': the fraction of audits that reached
+      `max_tests` without confirming the outcome
+    """
+    assert num_ballots >= sum(votes_array) > 0
+    assert num_winners < len(votes_array)
+    assert 0. < risk_limit <= 1.
+    if max_tests <= 0:
+        max_tests = sum(votes_array)
+    else:
+        max_tests = min(max_tests, sum(votes_array))
+
+    num_pairs = bravo_increments(votes_array, num_winners).shape[1]
+    trials_per_chunk = max(1, min(TRIALS_PER_CHUNK, MAX_BRAVO_BLOCK_VALUES // (DRAWS_PER_BLOCK * num_pairs)))
+    chunks = run_chunks(simulate_bravo_chunk, (votes_array, num_ballots, num_winners, risk_limit, max_tests),
+                        num_trials, seed, processes, trials_per_chunk)
+    return summarize_workloads(np.concatenate(chunks), num_ballots)
+
+def super_simple_ballots(votes_array, num_ballots, num_winners, error_rates):
+    """
+    Return the kinds of ballot a simulated super-simple audit draws, as
+    boolean matrices (kinds x candidates) of the paper and CVR selections,
+    and the probability of drawing each kind. Ballots without a discrepancy
+    follow the reported tally (ballots without a reported vote are blank),
+    the rest are the discrepancies of
+    `error_rates` (a dict from DISCREPANCY_KINDS to the fraction of ballots
+    with that discrepancy) between the closest winner and loser.
+    """
+    num_candidates = len(votes_array)
+    candidates = arrange_candidates(votes_array, num_winners)
+    winner = min(candidates.winners, key=lambda candidate: votes_array[candidate])
+    loser = max(candidates.losers, key=lambda candidate: votes_array[candidate])
+    rates = [error_rates.get(kind, 0.) for kind in DISCREPANCY_KINDS]
+    assert all(rate >= 0 for rate in rates) and sum(rates) <= 1
+
+    # One correct ballot per candidate plus a blank one, then the discrepancies
+    paper = np.zeros([num_candidates + 1 + len(DISCREPANCY_KINDS), num_candidates], dtype=bool)
+    cvr = np.zeros_like(paper)
+    paper[np.arange(num_candidates), np.arange(num_candidates)] = True
+    cvr[np.arange(num_candidates), np.arange(num_candidates)] = True
+    o1, o2, u1, u2 = num_candidates + 1 + np.arange(len(DISCREPANCY_KINDS))
+    cvr[[o1, o2], winner] = True
+    paper[o2, loser] = True
+    cvr[[u1, u2], loser] = True
+    paper[u2, winner] = True
+
+    shares = np.append(votes_array, num_ballots - sum(votes_array)) / num_ballots
+    probabilities = np.concatenate(((1 - sum(rates)) * shares, rates))
+    return paper, cvr, probabilities
+
+def simulate_super_simple_chunk(votes_array, num_ballots, num_winners, risk_limit, inflation_rate,
+                                tolerance, error_rates, num_trials, seed):
+    """
+    Simulates `num_trials` super-simple audits of ballots with the
+    discrepancies of `error_rates` (see `super_simple_ballots`), running
+    each through `SuperSimple.apply_observation_block`. Returns the number
+    of ballots each audit drew before it confirmed the outcome, or -1 for
+    audits that ended in a full hand count. Also returns whether each audit
+    went on to the Kaplan-Markov phase.
+    """
+    rng = np.random.default_rng(seed)
+    paper, cvr, probabilities = super_simple_ballots(votes_array, num_ballots, num_winners, error_rates)
+
+    stopping_sizes = np.zeros(num_trials, dtype=np.int64)
+    continued = np.zeros(num_trials, dtype=bool)
+    for trial in range(num_trials):
+        # The seed only matters for drawing sequence numbers, which are not simulated
+        audit = SuperSimple(votes_array, num_ballots, num_winners, risk_limit, 0, inflation_rate, tolerance)
+        num_drawn = 0
+        num_draws = DRAWS_PER_BLOCK
+        while not audit.IS_DONE:
+            draws = rng.choice(len(probabilities), size=num_draws, p=probabilities)
+            num_drawn += audit.apply_observation_block(paper[draws], cvr[draws])
+            num_draws = min(2 * num_draws, MAX_DRAWS_PER_BLOCK)
+        stopping_sizes[trial] = num_drawn if audit.IS_DONE_FLAG == 'success' else -1
+        continued[trial] = audit.in_kaplan_phase
+    return stopping_sizes, continued
+
+def simulate_super_simple(votes_array, num_ballots, num_winners, risk_limit, inflation_rate, tolerance,
+                          error_rates, num_trials=10000, seed=None, processes=None):
+    """
+    Projects the workload of a super-simple audit of the reported tally
+    `votes_array` when the CVRs have discrepancies at `error_rates`, a dict
+    from 'o1', 'o2', 'u1' and 'u2' to the fraction of ballots with a 1- or
+    2-vote overstatement or understatement of the closest margin. Runs
+    `num_trials` simulated audits on `processes` worker processes (all cores
+    by default).
+
+    Returns a dict with the same 'quantiles', 'escalation_probability' and
+    'num_trials' as `simulate_bravo`, plus:
+    - 'initial_sample_size': the sample size before the Kaplan-Markov phase
+    - 'continuation_probability': the fraction of audits that needed the
+      Kaplan-Markov phase
+    Under SuperSimple's rules a ballot with two discrepancies in the initial
+    sample, i.e. any 2-vote over- or understatement, ends in a hand count.
+    """
+    assert num_ballots >= sum(votes_array) > 0
+    assert num_winners < len(votes_array)
+    assert 0. < risk_limit <= 1.
+    assert all(kind in DISCREPANCY_KINDS for kind in error_rates)
+
+    chunks = run_chunks(simulate_super_simple_chunk,
+                        (votes_array, num_ballots, num_winners, risk_limit, inflation_rate, tolerance, error_rates),
+                        num_trials, seed, processes)
+    stopping_sizes, continued = zip(*chunks)
+    results = summarize_workloads(np.concatenate(stopping_sizes), num_ballots)
+    results['initial_sample_size'] = math.ceil(
+        SuperSimple(votes_array, num_ballots, num_winners, risk_limit, 0, inflation_rate, tolerance).sample_size())
+    results['continuation_probability'] = float(np.concatenate(continued).mean())
+    return results
+
+def run_chunks(simulate_chunk, args, num_trials, seed, processes, trials_per_chunk=TRIALS_PER_CHUNK):
+    """
+    Runs `simulate_chunk(*args, chunk_size, chunk_seed)` for chunks of
+    `trials_per_chunk` trials on `processes` worker processes, with seeds
+    spawned from `seed`. Returns the list of the results of each chunk.
+    """
+    chunk_sizes = [trials_per_chunk] * (num_trials // trials_per_chunk)
+    if num_trials % trials_per_chunk:
+        chunk_sizes.append(num_trials % trials_per_chunk)
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    chunk_args = [args + (size, chunk_seed) for size, chunk_seed in zip(chunk_sizes, seeds)]
+
+    # A single chunk is not worth the round trip to another process
+    if len(chunk_args) == 1 or processes == 1:
+        return [simulate_chunk(*arguments) for arguments in chunk_args]
+    executor = get_executor(processes)
+    try:
+        return list(executor.map(simulate_chunk, *zip(*chunk_args)))
+    except BrokenProcessPool:
+        # A worker died, the next simulation starts a new pool
+        global _executor
+        with _executor_lock:
+            if _executor is executor:
+                _executor = None
+        raise
+
+def get_executor(processes):
+    """
+    Returns the process pool of this process, with `processes` workers (one
+    per core if None), started on first use and reused by later simulations.
+    A pool inherited through fork or of another size is replaced.
+    """
+    global _executor, _executor_key
+    key = (os.getpid(), processes)
+    with _executor_lock:
+        if _executor is not None and _executor_key != key:
+            if _executor_key[0] == os.getpid():
+                _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=processes,
+                                            mp_context=multiprocessing.get_context('spawn'))
+            _executor_key = key
+        return _executor
+
+@atexit.register
+def shutdown_executor():
+    """
+    Stops the process pool of this process, if it started one.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not None and _executor_key[0] == os.getpid():
+            _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+def summarize_workloads(stopping_sizes, num_ballots):
+    """
+    Return the workload quantiles and escalation probability of simulated
+    audits that stopped after `stopping_sizes` ballots, -1 for escalation.
+    """
+    num_trials = len(stopping_sizes)
+    escalated = stopping_sizes < 0
+    workloads = np.sort(np.where(escalated, num_ballots, stopping_sizes))
+    return {
+        # Smallest workload that at least q% of the audits finish within
+        'quantiles': {q: int(workloads[math.ceil(q / 100 * num_trials) - 1]) for q in QUANTILES},
+        'escalation_probability': float(escalated.mean()),
+        'num_trials': num_trials
+    }
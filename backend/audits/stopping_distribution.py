@@ -0,0 +1,220 @@
+"""
+Exact stopping-time distribution of a BRAVO audit of one winner/loser pair.
+
+Only ballots for the winner or the loser ("relevant" ballots) change the test
+statistic. After m relevant ballots of which k are for the winner, the log
+test statistic is k*log(2s) + (m-k)*log(2(1-s)), so the audit stops as soon
+as k reaches a threshold that grows linearly with m, by 0 or 1 per ballot.
+The distribution of the number of relevant ballots T drawn before stopping is
+found by dynamic programming over the distance d between k and the threshold,
+keeping only the mass of sample paths that have not stopped yet.
+
+The distance falls by at most 1 per ballot, so within a block of B ballots
+only paths that start within B of the threshold can stop. The rest of the
+mass moves by one convolution with Bin(B, s). The paths near the threshold
+go through a linear map that gives how much of their mass stops at each
+ballot of the block and where the rest ends up. The map only depends on how
+the threshold rises over the block, so it is built once for each of the few
+ways it can rise, by solving for the probability that a path first reaches
+the threshold at each ballot.
+
+The number of draws N follows from T: the audit has stopped within n draws
+exactly when T <= R_n, the number of relevant ballots among the first n
+draws, and R_n ~ Bin(n, q) where q is the fraction of ballots reported for
+the winner or the loser.
+"""
+import math
+import numpy as np
+
+from .shared_objects.binomial import binomial_log_pmf, log_factorials
+
+QUANTILES = (50, 90, 99)
+# Sample paths whose probability falls below this are dropped
+NEGLIGIBLE_MASS = 1e-18
+# Number of relevant ballots handled at once by the dynamic program
+BLOCK_SIZE = 64
+
+def binomial_tables(p, block_size):
+    """
+    Returns the tables pmf[n, x] = P(Bin(n, p) = x) and tail[n, x] =
+    P(Bin(n, p) >= x) for n = 0, ..., block_size and x = 0, ..., block_size + 1.
+    """
+    log_factorial = log_factorials(block_size)
+    pmf = np.zeros([block_size + 1, block_size + 2])
+    for n in range(block_size + 1):
+        pmf[n, :n + 1] = np.exp(binomial_log_pmf(n, p, log_factorial))
+    tail = np.cumsum(pmf[:, ::-1], axis=1)[:, ::-1]
+    return pmf, tail
+
+def threshold_block_maps(rises, pmf, tail, block_size):
+    """
+    Returns the maps of a block of len(rises) - 1 relevant ballots over which
+    the threshold rises by rises[i] after i ballots, for paths that start at
+    distances 1, ..., block_size from it:
+    - stopped[i - 1, d - 1], the probability that a path from distance d
+      stops at ballot i
+    - survivors[e - 1, d - 1], the probability that it has not stopped and
+      ends at distance e
+    """
+    num_steps = len(rises) - 1
+    steps = np.arange(1, num_steps + 1)[:, np.newaxis]
+    distances = np.arange(1, block_size + 1)
+    last = num_steps + 1
+
+    # Without stopping, a path from distance d is at or past the threshold
+    # after i ballots with at least d + rises[i] winner votes among them
+    crossed = tail[steps, np.minimum(distances + rises[steps], last)]
+    # A path that first reaches the threshold after t ballots is at or past
+    # it again after i with at least rises[i] - rises[t] winner votes in between
+    lags = steps - steps.T
+    recrossed = np.where(lags > 0, tail[np.maximum(lags, 0), np.clip(rises[steps] - rises[steps.T], 0, last)], 0.)
+    stopped = np.linalg.solve(np.eye(num_steps) + recrossed, crossed)
+
+    # Paths that end at distance e without stopping are those that end there
+    # without the threshold, less those that reached it on the way
+    ends = np.arange(1, block_size + rises[-1] + 1)[:, np.newaxis]
+    winner_votes = distances + rises[-1] - ends
+    ends_at = np.where((winner_votes >= 0) & (winner_votes <= num_steps),
+                       pmf[num_steps, np.clip(winner_votes, 0, last)], 0.)
+    winner_votes = rises[-1] - rises[steps.T] - ends
+    remaining = num_steps - steps.T
+    returns_to = np.where((winner_votes >= 0) & (winner_votes <= remaining),
+                          pmf[remaining, np.clip(winner_votes, 0, last)], 0.)
+    survivors = ends_at - returns_to @ stopped
+    return np.maximum(stopped, 0.), np.maximum(survivors, 0.)
+
+def relevant_stopping_cdf(margin, risk_limit, max_relevant):
+    """
+    Returns an array whose m-th entry is the probability that a BRAVO test
+    with reported winner share `margin` of the relevant ballots rejects its
+    null hypothesis within m relevant ballots, for m = 0, ..., max_relevant,
+    if the reported results are correct.
+    """
+    log_threshold = math.log(1/risk_limit)
+    winner_increment = math.log(2*margin)
+    cdf = np.zeros(max_relevant + 1)
+    if margin == 1:
+        # Every relevant ballot is for the winner
+        cdf[min(max_relevant + 1, math.ceil(log_threshold/winner_increment - 1e-9)):] = 1.
+        return cdf
+    if max_relevant == 0:
+        return cdf
+    loser_increment = math.log(2*(1-margin))
+    # Paths with at least thresholds[m] winner votes among m relevant
+    # ballots reach 1/risk_limit
+    relevant = np.arange(max_relevant + 1)
+    thresholds = np.ceil((log_threshold - relevant*loser_increment)
+                         / (winner_increment - loser_increment) - 1e-9).astype(np.int64)
+
+    # After the first ballot, survivors[i] is the probability of being at
+    # distance lowest + i from the threshold without having stopped
+    if thresholds[1] > 1:
+        survivors, lowest = np.array([margin, 1-margin]), thresholds[1] - 1
+    else:
+        survivors, lowest = np.array([1-margin]), thresholds[1]
+        cdf[1] = margin
+    stopped = cdf[1]
+
+    pmf, tail = binomial_tables(margin, BLOCK_SIZE)
+    block_maps = {}
+    m = 1
+    while m < max_relevant:
+        if not len(survivors):
+            cdf[m:] = stopped
+            break
+        num_steps = min(BLOCK_SIZE, max_relevant - m)
+        rises = thresholds[m:m + num_steps + 1] - thresholds[m]
+
+        # Mass beyond BLOCK_SIZE from the threshold cannot stop in this block
+        num_near = max(0, BLOCK_SIZE + 1 - lowest)
+        far = survivors[num_near:]
+        if num_near:
+            key = rises.tobytes()
+            if key not in block_maps:
+                block_maps[key] = threshold_block_maps(rises, pmf, tail, BLOCK_SIZE)
+            stopped_map, survivors_map = block_maps[key]
+            near = np.zeros(BLOCK_SIZE)
+            near[lowest - 1:lowest - 1 + min(num_near, len(survivors))] = survivors[:num_near]
+            cdf[m + 1:m + num_steps + 1] = stopped + np.cumsum(stopped_map @ near)
+            new_lowest = 1
+            new_survivors = np.zeros(BLOCK_SIZE + rises[-1] + len(far))
+            new_survivors[:BLOCK_SIZE + rises[-1]] = survivors_map @ near
+        else:
+            cdf[m + 1:m + num_steps + 1] = stopped
+            new_lowest = lowest + rises[-1] - num_steps
+            new_survivors = np.zeros(len(far) + num_steps)
+        stopped = cdf[m + num_steps]
+
+        if len(far):
+            # Each winner vote brings a path one closer to the threshold
+            offset = lowest + num_near + rises[-1] - num_steps - new_lowest
+            new_survivors[offset:offset + len(far) + num_steps] += np.convolve(far, pmf[num_steps, num_steps::-1])
+
+        # Drop negligible mass at the far end
+        kept = np.flatnonzero(new_survivors >= NEGLIGIBLE_MASS)
+        survivors = new_survivors[:kept[-1] + 1] if len(kept) else new_survivors[:0]
+        lowest = new_lowest
+        m += num_steps
+    return cdf
+
+def bravo_stopping_distribution(v_w, v_l, num_ballots, risk_limit, max_draws):
+    """
+    Returns the exact distribution of the number of ballots a BRAVO audit
+    draws before confirming that a winner with `v_w` reported votes beat a
+    loser with `v_l`, among `num_ballots` ballots, if the reported results
+    are correct. The audit escalates to a full hand count after `max_draws`
+    draws.
+
+    Returns a dict with:
+    - 'quantiles': {50: n, 90: n, 99: n}, the fewest draws within which that
+      percentage of audits stop, or None if more than max_draws are needed
+    - 'expected_sample_size': expected number of draws, counting audits that
+      escalate as max_draws
+    - 'stopping_probability': probability of stopping within max_draws draws
+    """
+    assert v_w > v_l >= 0
+    assert num_ballots >= v_w + v_l
+    q = (v_w + v_l) / num_ballots
+    log_factorial = log_factorials(max_draws)
+    # Bin(max_draws, q) is negligible beyond this many relevant ballots
+    max_relevant = min(max_draws, math.ceil(max_draws*q + 10*math.sqrt(max_draws*q*(1-q)) + 10))
+    relevant_cdf = relevant_stopping_cdf(v_w / (v_w + v_l), risk_limit, max_relevant)
+
+    def stopping_probability(num_draws):
+        # P(T <= R_n), with R_n ~ Bin(num_draws, q)
+        if q == 1:
+            return float(relevant_cdf[min(num_draws, max_relevant)])
+        pmf = np.exp(binomial_log_pmf(num_draws, q, log_factorial))
+        return float(pmf[:max_relevant + 1] @ relevant_cdf[:num_draws + 1])
+
+    final_stopping_probability = stopping_probability(max_draws)
+    quantiles = {}
+    for quantile in QUANTILES:
+        if final_stopping_probability < quantile / 100:
+            quantiles[quantile] = None
+            continue
+        # Binary search, the stopping probability grows with the number of draws
+        low, high = 0, max_draws
+        while high - low > 1:
+            middle = (low + high) // 2
+            if stopping_probability(middle) >= quantile / 100:
+                high = middle
+            else:
+                low = middle
+        quantiles[quantile] = high
+
+    # E[min(N, max_draws)] = sum over n < max_draws of P(T > R_n). Summed
+    # over n first, P(R_n = m) adds up to P(Bin(max_draws, q) > m) / q.
+    relevant = np.arange(max_relevant + 1)
+    if q == 1:
+        draws_beyond = (relevant < max_draws).astype(float)
+    else:
+        tail = np.cumsum(np.exp(binomial_log_pmf(max_draws, q, log_factorial))[::-1])[::-1]
+        draws_beyond = np.append(tail[1:], 0.)[:max_relevant + 1]
+    expected_sample_size = float((1 - relevant_cdf) @ draws_beyond / q)
+
+    return {
+        'quantiles': quantiles,
+        'expected_sample_size': expected_sample_size,
+        'stopping_probability': final_stopping_probability
+    }
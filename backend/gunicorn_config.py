@@ -1,14 +1,47 @@
 '''
 Run the server with this command:
 gunicorn --config=python:gunicorn_config app:app
+
+Or run the async server mode (see asgi.py) with this command:
+RLA_ASGI=1 gunicorn --config=python:gunicorn_config asgi:asgi_app
 '''
 
+import glob
+import os
+import tempfile
 from multiprocessing import cpu_count
 
 bind = '127.0.0.1:5000'
 
 workers = cpu_count() * 2 + 1
-worker_class = 'gthread'
-threads = cpu_count() * 2 + 1
+if os.environ.get('RLA_ASGI'):
+    # Connections are handled on each worker's event loop
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    worker_class = 'gthread'
+    threads = cpu_count() * 2 + 1
+
+# Audits must be resumable from any worker, so keep them in the shared
+# SQLite session store instead of per-process memory, unless the operator
+# picked a backend
+raw_env = []
+if 'RLA_SESSION_BACKEND' not in os.environ:
+    raw_env.append('RLA_SESSION_BACKEND=sqlite' if workers > 1 else 'RLA_SESSION_BACKEND=memory')
+
+# Requests are already spread over all cores by the workers, so each one runs
+# workload simulations itself instead of starting a process pool of its own
+if 'RLA_SIMULATION_PROCESSES' not in os.environ and workers > 1:
+    raw_env.append('RLA_SIMULATION_PROCESSES=1')
+
+# Each worker writes its metrics to this directory so any of them can report
+# the totals of all workers at /metrics
+metrics_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'rla_metrics'))
+raw_env.append(f'PROMETHEUS_MULTIPROC_DIR={metrics_dir}')
+
+def on_starting(server):
+    # Values left by the workers of a previous run would be counted again
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+        os.remove(path)
 
 reload = True
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+# Tests import the backend packages (audits, utilities) the way app.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def run_single_and_batch(make_audit, observations, block_size):
+    '''
+    Replays `observations` on two audits from `make_audit`, one ballot at a
+    time with submit and in blocks of `block_size` with submit_batch,
+    drawing sequence numbers as a client would, so the n-th observation is
+    for the n-th ballot drawn in both. Returns both audits and the number
+    of observations each applied.
+    '''
+    single = make_audit()
+    single.get_sequence_number()
+    num_single = 0
+    for observation in observations:
+        if single.IS_DONE:
+            break
+        single.submit(observation)
+        num_single += 1
+
+    batch = make_audit()
+    blocks = [observations[start:start + block_size] for start in range(0, len(observations), block_size)]
+    batch.submit_batch([], len(blocks[0]) if blocks else 0)
+    num_batch = 0
+    for index, block in enumerate(blocks):
+        if batch.IS_DONE:
+            break
+        num_next = len(blocks[index + 1]) if index + 1 < len(blocks) else 0
+        num_applied, _ = batch.submit_batch(block, num_next)
+        num_batch += num_applied
+    return single, batch, num_single, num_batch
+
+@pytest.fixture
+def replay():
+    '''
+    Compares an audit submitted one ballot at a time with the same audit
+    submitted in batches: `replay(make_audit, observations, block_size,
+    audit_state)` checks both apply the same ballots and end with the same
+    `audit_state(audit)`, and returns the two audits for engine-specific
+    checks.
+    '''
+    def check(make_audit, observations, block_size, audit_state):
+        single, batch, num_single, num_batch = run_single_and_batch(make_audit, observations, block_size)
+        assert num_batch == num_single
+        assert audit_state(batch) == audit_state(single)
+        return single, batch
+    return check
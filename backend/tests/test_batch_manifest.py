@@ -0,0 +1,54 @@
+import io
+
+import numpy as np
+import pytest
+
+from utilities.batch_manifest import parse_batch_manifest
+
+VOTES = np.array([[51, 40, 9], [0, 7, 3], [12, 12, 1]])
+
+@pytest.mark.parametrize('data', [
+    b'a,b,c\n51,40,9\n0,7,3\n12,12,1\n',
+    b'\xef\xbb\xbfa,b,c\r\n51,40,9\r\n0,7,3\r\n12,12,1',
+    b'51,40,9\n0,7,3\n12,12,1\n',
+    b'+51, 40, 9\n0,7,3\n12,12,1\n',
+])
+def test_parse_csv(data):
+    for chunk_size in (1, 5, 1 << 20):
+        np.testing.assert_array_equal(parse_batch_manifest(io.BytesIO(data), 3, 3, chunk_size=chunk_size), VOTES)
+
+@pytest.mark.parametrize('dtype', [np.int64, np.int16, np.uint8])
+def test_parse_npy(dtype):
+    stream = io.BytesIO()
+    np.save(stream, VOTES.astype(dtype))
+    stream.seek(0)
+    np.testing.assert_array_equal(parse_batch_manifest(stream, 3, 3, chunk_size=8), VOTES)
+
+@pytest.mark.parametrize('data, message', [
+    (b'a,b,c\n51,40,9\n0,7\n12,12,1\n', 'Malformed row'),
+    (b'a,b,c\n51,40,9\n0,7,x\n12,12,1\n', 'Malformed row'),
+    (b'a,b,c\n51,40,9\n\n0,7,3\n12,12,1\n', 'Malformed row'),
+    (b'a,b,c\n51,40,9\n0,99999999999999999999,3\n12,12,1\n', 'Malformed row'),
+    (b'a,b,c\n51,40,9\n0,7,3\n', 'has 2 batches'),
+    (b'a,b,c\n51,40,9\n0,7,3\n12,12,1\n1,1,1\n', 'more than 3 batches'),
+    (b'a,b,c\n51,40,9\n0,-7,3\n12,12,1\n', 'must not be negative'),
+    # A first row with a negative count is data, not a header
+    (b'-51,40,9\n0,7,3\n12,12,1\n', 'must not be negative'),
+])
+def test_parse_csv_rejects(data, message):
+    with pytest.raises(ValueError, match=message):
+        parse_batch_manifest(io.BytesIO(data), 3, 3)
+
+def test_parse_npy_rejects_counts_that_do_not_fit():
+    stream = io.BytesIO()
+    np.save(stream, np.array([[2**63, 0]], dtype=np.uint64))
+    stream.seek(0)
+    with pytest.raises(ValueError, match='does not fit'):
+        parse_batch_manifest(stream, 1, 2)
+
+def test_parse_npy_rejects_wrong_shape():
+    stream = io.BytesIO()
+    np.save(stream, VOTES[:2])
+    stream.seek(0)
+    with pytest.raises(ValueError, match='shape'):
+        parse_batch_manifest(stream, 3, 3)
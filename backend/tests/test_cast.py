@@ -0,0 +1,127 @@
+import random
+
+import numpy as np
+import pytest
+
+import audits.Cast
+from audits.Cast import Cast
+
+class LoopCast(Cast):
+    '''
+    Cast with the adjusted margins and overstatement bounds computed one
+    batch and one pair at a time, as before they were vectorized.
+    '''
+    def calc_adj_margin(self, winner, loser):
+        reported_margin = 0
+        audited_margin = 0
+        for num in self.unaudited_batches():
+            reported_margin = reported_margin + self.reported_batch_info[num][winner] - self.reported_batch_info[num][loser]
+        for batches in self.audited_batch_info:
+            audited_margin = audited_margin + batches[winner] - batches[loser]
+        return reported_margin + audited_margin
+
+    def get_adj_margins(self):
+        adj_margins = np.zeros([len(self.winners), len(self.losers)])
+        for idw, winner in enumerate(self.winners):
+            for idl, loser in enumerate(self.losers):
+                adj_margins[idw][idl] = self.calc_adj_margin(winner, loser)
+        return adj_margins
+
+    def calc_u_ps(self):
+        u_ps = np.zeros(self.num_batches)
+        adj_margins = self.get_adj_margins()
+        for batch_num in self.unaudited_batches():
+            max_u_p = []
+            for idw, winner in enumerate(self.winners):
+                for idl, loser in enumerate(self.losers):
+                    if adj_margins[idw][idl] == 0:
+                        u_p = 0
+                    else:
+                        u_p = (self.reported_batch_info[batch_num][winner] - self.reported_batch_info[batch_num][loser]
+                               + self.batch_size) / adj_margins[idw][idl]
+                    max_u_p.append(u_p)
+            u_ps[batch_num] = np.amax(max_u_p)
+        return u_ps
+
+    def calc_T(self):
+        u_ps = self.calc_u_ps()
+        t_ps = []
+        squigglie_u_ps = []
+        for u_p in u_ps:
+            if u_p < self.threshold:
+                t_ps.append(u_p)
+                squigglie_u_ps.append(0.0)
+            else:
+                t_ps.append(self.threshold)
+                squigglie_u_ps.append(u_p - self.threshold)
+        return sum(t_ps), np.asarray(squigglie_u_ps)
+
+def run_audit(audit_class, params, audited_votes):
+    '''
+    Runs a Cast audit to the end, returning the batches drawn in each stage
+    and the outcome.
+    '''
+    audit = audit_class(*params)
+    stages = []
+    sequence = audit.get_sequence_number()
+    while sequence is not None:
+        if audit.num_batches_recorded == 0:
+            stages.append(list(audit.batches_to_audit))
+        assert isinstance(sequence, int)
+        sequence = audit.submit(audited_votes[sequence - 1])
+    assert audit.IS_DONE
+    return stages, audit.IS_DONE_FLAG, audit.unaudited_totals.tolist(), audit.audited_totals.tolist()
+
+def random_audit(seed):
+    rng = random.Random(seed)
+    num_candidates = rng.randint(2, 4)
+    num_winners = rng.randint(1, num_candidates - 1)
+    num_batches = rng.randint(100, 300)
+    batch_size = 100
+    shares = sorted((rng.random() for _ in range(num_candidates)), reverse=True)
+    reported = [[int(batch_size * share / sum(shares) * rng.uniform(.8, 1)) for share in shares]
+                for _ in range(num_batches)]
+    # Mostly correct counts, some batches with votes moved between candidates
+    audited = [list(votes) for votes in reported]
+    error_rate = rng.choice([.05, .2])
+    for votes in audited:
+        if rng.random() < error_rate:
+            moved = rng.randint(0, votes[0])
+            votes[0] -= moved
+            votes[-1] += moved
+    params = [reported, num_candidates, num_winners, rng.randint(1, 3), batch_size,
+              num_batches, rng.choice([.05, .1]), rng.choice([.001, .002]), seed]
+    return params, audited
+
+@pytest.mark.parametrize('seed', range(40))
+def test_stages_match_loops(seed, monkeypatch):
+    params, audited = random_audit(seed)
+    expected = run_audit(LoopCast, params, audited)
+    assert run_audit(Cast, params, audited) == expected
+    # Overstatement bounds computed a few batches at a time
+    monkeypatch.setattr(audits.Cast, 'MAX_U_P_CHUNK', 7)
+    assert run_audit(Cast, params, audited) == expected
+
+def test_seeded_stages_are_pinned():
+    params, audited = random_audit(1)
+    stages, flag = run_audit(Cast, params, audited)[:2]
+    assert stages == [[34, 145, 16, 65, 30, 126, 115, 120], [101, 56, 25, 131, 7, 103, 114]]
+    assert flag == 'success'
+
+def test_calc_n_edge_cases():
+    params, _ = random_audit(1)
+    audit = Cast(*params)
+    squigglie_u_ps = np.zeros(audit.num_batches)
+    # Errors below the threshold could change the outcome, no sample confirms it
+    assert audit.calc_n(1., squigglie_u_ps) > audit.num_unaudited
+    assert audit.calc_n(.5, squigglie_u_ps) > audit.num_unaudited
+    # Only if every unaudited batch is wrong, which any one batch shows
+    squigglie_u_ps[audit.unaudited_batches()] = .5 / audit.num_unaudited
+    assert audit.calc_n(.5 + 1e-9, squigglie_u_ps) == 1
+
+def test_threshold_too_large_escalates():
+    params, _ = random_audit(1)
+    params[7] = .1
+    audit = Cast(*params)
+    assert audit.IS_DONE and audit.IS_DONE_FLAG == 'danger'
+    assert audit.get_sequence_number() is None
@@ -0,0 +1,19 @@
+import hashlib
+import io
+
+from utilities.csv_parser import parse_election_data_stream, HashingReader
+
+def election_csv(num_rows):
+    lines = ['office,name_raw,votes']
+    for row in range(num_rows):
+        lines.append(f'Office {row % 3},Candidate {row % 7},{row % 50}')
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def test_parse_hashes_whole_stream():
+    content = election_csv(50000)
+    stream = HashingReader(io.BytesIO(content))
+    offices = parse_election_data_stream(stream)
+    # The digest is complete once parsing is done, without reading again
+    assert stream.hexdigest() == hashlib.sha256(content).hexdigest()
+    assert sorted(offices) == ['Office 0', 'Office 1', 'Office 2']
+    assert sum(total for _, total in offices.values()) == sum(row % 50 for row in range(50000))
@@ -0,0 +1,36 @@
+import io
+
+import pytest
+
+from utilities.cvr_store import CVRStore, parse_cvr_stream
+
+def test_parse_cvr_stream():
+    ballot_ids, packed_marks, candidates = parse_cvr_stream(io.BytesIO(b'ballot_id,a,b\r\n2,0,1\r\n1,1,0\r\n'),
+                                                            chunk_size=7)
+    assert ballot_ids.tolist() == [2, 1]
+    assert packed_marks.tolist() == [[64], [128]]
+    assert candidates == ['a', 'b']
+
+@pytest.mark.parametrize('data', [
+    b'ballot_id,a,b\n1,0\n',
+    b'ballot_id,a,b\n1,0,1,1\n',
+    b'ballot_id,a,b\n1,0,x\n',
+    b'ballot_id,a,b\n1,,1\n',
+    b'ballot_id,a,b\n1,2,0\n',
+    b'ballot_id,a,b\n99999999999999999999,0,1\n',
+    b'a,b\n1,0\n',
+])
+def test_parse_cvr_stream_rejects_malformed(data):
+    with pytest.raises(ValueError):
+        parse_cvr_stream(io.BytesIO(data))
+
+def test_unknown_ballot_and_export(tmp_path):
+    store = CVRStore(str(tmp_path))
+    cvr_id, num_ballots, num_candidates = store.add(io.BytesIO(b'ballot_id,a,b\n1,0,1\n2,1,1\n'))
+    assert (num_ballots, num_candidates) == (2, 2)
+    records = store.open(cvr_id)
+    assert records.lookup([2, 1]) == [[0, 1], [1]]
+    with pytest.raises(KeyError, match='No CVR for ballot 3'):
+        records.lookup([1, 3])
+    with pytest.raises(KeyError, match='No CVR export'):
+        store.open('0' * 64)
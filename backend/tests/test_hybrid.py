@@ -0,0 +1,49 @@
+import random
+
+import numpy as np
+import pytest
+
+from audits.Hybrid import Hybrid
+
+def hybrid_params(seed):
+    return [[3000, 2400, 300], [1100, 1000, 100], 6000, 2400, 1, .1, seed, 1.03, 0]
+
+def random_observations(audit, rng, num_observations):
+    observations = []
+    for _ in range(num_observations):
+        sequence_number = audit.get_sequence_number()
+        paper = rng.choices([[0], [1], [2], [], [0, 1]], weights=[50, 40, 5, 4, 1])[0]
+        if sequence_number <= audit.num_cvr_ballots:
+            cvr = paper if rng.random() < .97 else rng.choice([[0], [1], []])
+            observations.append([paper, cvr])
+        else:
+            observations.append([paper, None])
+    return observations
+
+def audit_state(audit):
+    return (audit.IS_DONE, audit.IS_DONE_FLAG, audit.ballots_tested, audit.polling_counts.tolist(),
+            audit.kaplan_markov.ballots_audited, audit.kaplan_markov.discrepancy_counts.tolist())
+
+@pytest.mark.parametrize('seed', range(6))
+def test_batch_matches_single_ballots(seed, replay):
+    observations = random_observations(Hybrid(*hybrid_params(seed)), random.Random(seed), 600)
+    single, batch = replay(lambda: Hybrid(*hybrid_params(seed)), observations, 300, audit_state)
+    assert batch.p_values().tolist() == single.p_values().tolist()
+
+def test_ballot_for_winner_and_loser_counts_as_neither():
+    audit = Hybrid([3000, 2400, 300], [1100, 1000, 100], 6000, 2400, 2, .05, 1, 1.03, 0)
+    audit.apply_observation([[0, 2], None])
+    # Pairs (0, 2) and (1, 2): a vote for both, then for neither
+    assert audit.polling_counts.tolist() == [[0, 0, 1], [0, 1, 0]]
+
+def test_p_values_match_brute_force():
+    audit = Hybrid(*hybrid_params(1))
+    observations = random_observations(Hybrid(*hybrid_params(1)), random.Random(1), 150)
+    for observation in observations:
+        audit.apply_observation(observation)
+        if audit.IS_DONE:
+            break
+    lowest, highest = audit.allocation_bounds()
+    allocations = lowest + (highest - lowest) * np.linspace(0, 1, 200001)[1:-1, np.newaxis]
+    log_q = audit.log_stratum_p_values(allocations[:, np.newaxis], audit.stratum_counts())[:, 0].max(axis=0)
+    np.testing.assert_allclose(audit.p_values(), np.exp(log_q) * (1 - log_q), rtol=1e-6)
@@ -0,0 +1,55 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+from audits.shared_objects.KaplanMarkov import KaplanMarkov
+
+def brute_force_p_values(votes_array, num_ballots, winners, losers, inflation_rate, ballots):
+    p_values = np.ones([len(winners), len(losers)])
+    for row, winner in enumerate(winners):
+        for column, loser in enumerate(losers):
+            u = 2 * inflation_rate / ((votes_array[winner] - votes_array[loser]) / num_ballots)
+            for paper, cvr in ballots:
+                # Overvotes count as no votes
+                paper = set(paper) if len(set(paper)) <= 1 else set()
+                cvr = set(cvr) if len(set(cvr)) <= 1 else set()
+                overstatement = ((winner in cvr) - (winner in paper)) - ((loser in cvr) - (loser in paper))
+                p_values[row, column] *= (1 - 1/u) / (1 - overstatement / (2 * inflation_rate))
+    return p_values
+
+def encode(selections, num_candidates):
+    marked = np.zeros((len(selections), num_candidates), dtype=bool)
+    for row, ballot in enumerate(selections):
+        marked[row, ballot] = True
+    return marked
+
+@pytest.mark.parametrize('seed', range(20))
+def test_p_values_match_brute_force(seed):
+    rng = random.Random(seed)
+    votes_array = [600, 300, 100]
+    inflation_rate = rng.choice([1.01, 1.1, 1.5])
+    ballots = [([rng.randrange(3) for _ in range(rng.randrange(3))],
+                [rng.randrange(3) for _ in range(rng.randrange(3))]) for _ in range(rng.randrange(1, 60))]
+    kaplan_markov = KaplanMarkov(votes_array, 1000, 1, inflation_rate)
+
+    # Half one at a time, half as a batch
+    split = len(ballots) // 2
+    for paper, cvr in ballots[:split]:
+        kaplan_markov.update(encode([paper], 3), encode([cvr], 3))
+    rest = ballots[split:]
+    kaplan_markov.update(encode([paper for paper, _ in rest], 3), encode([cvr for _, cvr in rest], 3))
+
+    expected = brute_force_p_values(votes_array, 1000, kaplan_markov.winners, kaplan_markov.losers,
+                                    inflation_rate, ballots)
+    assert kaplan_markov.ballots_audited == len(ballots)
+    np.testing.assert_allclose(np.exp(kaplan_markov.log_p_values), expected, rtol=1e-9)
+    assert kaplan_markov.measured_risk() == pytest.approx(min(1., expected.max()), rel=1e-9)
+
+def test_p_value_path_does_not_apply():
+    kaplan_markov = KaplanMarkov([600, 400], 1000, 1, 1.1)
+    paper = encode([[0], [0], [1]], 2)
+    path = kaplan_markov.log_p_value_path(paper, paper)
+    assert kaplan_markov.ballots_audited == 0
+    np.testing.assert_allclose(path[:, 0, 0], np.arange(1, 4) * math.log(1 - .2 / 2.2))
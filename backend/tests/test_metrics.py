@@ -0,0 +1,43 @@
+from utilities import metrics
+from utilities.metrics import MetricsRegistry, Counter, Histogram, CallbackMetric
+
+def make_registry(directory, checkouts):
+    registry = MetricsRegistry(directory)
+    steps = registry.register(Counter('steps_total', 'Steps.', ['audit_type']))
+    latency = registry.register(Histogram('latency_seconds', 'Latency.', [], buckets=(.1, 1)))
+    registry.register(CallbackMetric('checkouts_total', 'Checkouts.', [], lambda: {(): checkouts},
+                                     metric_type='counter', per_process=True))
+    registry.register(CallbackMetric('sessions', 'Sessions.', [], lambda: {(): 7}))
+    return registry, steps, latency
+
+def test_render_sums_worker_processes(tmp_path, monkeypatch):
+    # Two workers sharing a directory, told apart by their pid
+    monkeypatch.setattr(metrics.os, 'getpid', lambda: 1)
+    first, steps, latency = make_registry(str(tmp_path), 2)
+    steps.inc(3, audit_type='bravo')
+    latency.observe(.05)
+    first.write_process_values(force=True)
+
+    monkeypatch.setattr(metrics.os, 'getpid', lambda: 2)
+    second, steps, latency = make_registry(str(tmp_path), 5)
+    steps.inc(audit_type='bravo')
+    steps.inc(audit_type='cast')
+    latency.observe(.5)
+
+    lines = second.render().splitlines()
+    assert 'steps_total{audit_type="bravo"} 4' in lines
+    assert 'steps_total{audit_type="cast"} 1' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'latency_seconds_count 2' in lines
+    assert 'checkouts_total 7' in lines
+    # Shared gauges are not summed
+    assert 'sessions 7' in lines
+    assert lines.count('# TYPE steps_total counter') == 1
+
+def test_render_without_directory_is_per_process():
+    registry, steps, _ = make_registry(None, 2)
+    steps.inc(audit_type='bravo')
+    lines = registry.render().splitlines()
+    assert 'steps_total{audit_type="bravo"} 1' in lines
+    assert 'checkouts_total 2' in lines
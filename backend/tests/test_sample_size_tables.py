@@ -0,0 +1,36 @@
+import math
+
+import numpy as np
+import pytest
+
+from audits.SuperSimple import SuperSimple
+from utilities.sample_size_tables import HALF_MARGINS, RISK_LIMITS, expected_relevant_sample_size, \
+    interpolate, super_simple_sample_size
+
+@pytest.mark.parametrize('votes_array, num_ballots, risk_limit, inflation_rate, tolerance', [
+    ([600, 400], 1000, .05, 1.1, .5),
+    ([5100, 4900], 12000, .01, 1.03, .2),
+    ([10, 5], 15, .1, 1.5, .5),
+])
+def test_super_simple_sample_size_matches_audit(votes_array, num_ballots, risk_limit, inflation_rate, tolerance):
+    audit = SuperSimple(votes_array, num_ballots, 1, risk_limit, 1, inflation_rate, tolerance)
+    assert super_simple_sample_size(votes_array[0], votes_array[1], num_ballots, risk_limit,
+                                    inflation_rate, tolerance) == math.ceil(audit.sample_size())
+
+def test_super_simple_sample_size_undefined():
+    assert super_simple_sample_size(500, 500, 1000, .05, 1.1, .5) is None
+    # Tolerance so large the multiplier has no positive denominator
+    assert super_simple_sample_size(600, 400, 1000, .05, 1.01, 100) is None
+
+@pytest.mark.parametrize('half_margin, risk_limit', [(.1, .05), (.03, .1)])
+def test_bravo_table_interpolation_matches_direct(half_margin, risk_limit):
+    # The neighbourhood of the point in the full grid
+    i = int(np.searchsorted(HALF_MARGINS, half_margin)) - 1
+    j = int(np.searchsorted(RISK_LIMITS, risk_limit)) - 1
+    margins, risk_limits = HALF_MARGINS[i:i + 2], RISK_LIMITS[j:j + 2]
+    table = np.log([[expected_relevant_sample_size(m, r) for r in risk_limits] for m in margins])
+
+    interpolated = math.exp(interpolate(table, (np.log(margins), np.log(risk_limits)),
+                                        (math.log(half_margin), math.log(risk_limit))))
+    direct = expected_relevant_sample_size(half_margin, risk_limit)
+    assert abs(interpolated - direct) < .02 * direct
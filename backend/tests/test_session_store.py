@@ -0,0 +1,110 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from audits.Bravo import Bravo
+from utilities.session_store import make_session_store, SessionConflict
+
+def make_audit():
+    return Bravo([600, 400], 1000, 1, .1, 12345, 0)
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    return make_session_store(request.param, str(tmp_path / 'sessions.db'))
+
+def test_checkout_writes_back(store):
+    store.add('a', 'bravo', make_audit())
+    with store.checkout('a') as audit:
+        audit.submit([0])
+    assert store.get('a').ballots_tested == 1
+    assert store.stats()['checkouts'] == 1
+
+def test_checkout_rolls_back_on_exception(store):
+    store.add('a', 'bravo', make_audit())
+    with pytest.raises(RuntimeError):
+        with store.checkout('a') as audit:
+            audit.submit([0])
+            raise RuntimeError
+    assert store.get('a').ballots_tested == 0
+    with store.checkout('a') as audit:
+        audit.submit([0])
+    assert store.get('a').ballots_tested == 1
+
+def test_unknown_session(store):
+    assert store.get('missing') is None
+    with pytest.raises(KeyError):
+        with store.checkout('missing'):
+            pass
+
+def test_sessions_check_out_independently():
+    store = make_session_store('memory')
+    store.add('a', 'bravo', make_audit())
+    store.add('b', 'bravo', make_audit())
+    other_done = threading.Event()
+
+    def check_out_other():
+        with store.checkout('b') as audit:
+            audit.submit([1])
+        other_done.set()
+
+    with store.checkout('a'):
+        thread = threading.Thread(target=check_out_other)
+        thread.start()
+        assert other_done.wait(5)
+    thread.join()
+    assert store.get('b').ballots_tested == 1
+
+def test_memory_store_tracks_growing_sessions():
+    store = make_session_store('memory', max_bytes=None)
+    store.add('a', 'bravo', make_audit())
+    size = store.stats()['bytes']
+    with store.checkout('a') as audit:
+        audit.padding = list(range(10000))
+    assert store.stats()['bytes'] > size
+
+def test_sqlite_checkout_conflicts_with_other_worker(tmp_path):
+    # Two stores on one file, as in two worker processes
+    path = str(tmp_path / 'sessions.db')
+    first, second = make_session_store('sqlite', path), make_session_store('sqlite', path)
+    first.add('a', 'bravo', make_audit())
+    with pytest.raises(SessionConflict):
+        with first.checkout('a') as audit:
+            audit.submit([0])
+            with second.checkout('a') as other:
+                other.submit([1])
+    assert first.get('a').ballots_tested == 1
+    with first.checkout('a') as audit:
+        audit.submit([0])
+    assert second.get('a').ballots_tested == 2
+
+def test_sqlite_checkout_reuses_audit_until_changed(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    first, second = make_session_store('sqlite', path), make_session_store('sqlite', path)
+    first.add('a', 'bravo', make_audit())
+    with first.checkout('a') as audit:
+        audit.submit([0])
+    with first.checkout('a') as cached:
+        assert cached is audit
+    with second.checkout('a') as other:
+        other.submit([0])
+    with first.checkout('a') as reloaded:
+        assert reloaded is not audit
+        assert reloaded.ballots_tested == 2
+
+def test_sqlite_migrates_version_1_sessions(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE sessions (session_id TEXT PRIMARY KEY, audit_type TEXT NOT NULL,
+                                          state BLOB NOT NULL, updated REAL NOT NULL,
+                                          size INTEGER NOT NULL DEFAULT 0)''')
+    state = make_audit().dumps()
+    conn.execute('INSERT INTO sessions VALUES (?, ?, ?, ?, ?)', ('a', 'bravo', state, time.time(), len(state)))
+    conn.execute('PRAGMA user_version = 1')
+    conn.commit()
+    conn.close()
+    store = make_session_store('sqlite', path)
+    with store.checkout('a') as audit:
+        audit.submit([0])
+    assert store.get('a').ballots_tested == 1
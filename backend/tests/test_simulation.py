@@ -0,0 +1,22 @@
+from audits import simulation
+from audits.simulation import simulate_bravo
+
+def test_results_do_not_depend_on_processes():
+    in_process = simulate_bravo([600, 400], 1000, 1, .1, num_trials=5000, seed=3, processes=1)
+    on_pool = simulate_bravo([600, 400], 1000, 1, .1, num_trials=5000, seed=3, processes=2)
+    assert on_pool == in_process
+    simulation.shutdown_executor()
+
+def test_bravo_chunks_fit_block_budget(monkeypatch):
+    chunk_sizes = []
+    simulate_chunk = simulation.simulate_bravo_chunk
+
+    def record_chunk(*args):
+        chunk_sizes.append(args[-2])
+        return simulate_chunk(*args)
+
+    monkeypatch.setattr(simulation, 'simulate_bravo_chunk', record_chunk)
+    # 2 winners x 3 losers
+    simulate_bravo([300, 250, 200, 150, 100], 1000, 2, .1, num_trials=1000, seed=1, processes=1)
+    assert max(chunk_sizes) * simulation.DRAWS_PER_BLOCK * 6 <= simulation.MAX_BRAVO_BLOCK_VALUES
+    assert sum(chunk_sizes) == 1000
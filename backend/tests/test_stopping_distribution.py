@@ -0,0 +1,79 @@
+import math
+import time
+
+import numpy as np
+import pytest
+
+from audits import Bravo as bravo_module
+from audits.Bravo import Bravo, average_sample_number
+from audits.simulation import simulate_bravo_chunk
+from audits.stopping_distribution import bravo_stopping_distribution, relevant_stopping_cdf
+
+def loop_stopping_cdf(margin, risk_limit, max_relevant):
+    """
+    Reference dynamic program, one relevant ballot at a time over the number
+    of winner votes k, stopping paths once k reaches the threshold.
+    """
+    log_threshold = math.log(1/risk_limit)
+    winner_increment, loser_increment = math.log(2*margin), math.log(2*(1-margin))
+    cdf = np.zeros(max_relevant + 1)
+    survivors = np.zeros(max_relevant + 2)
+    survivors[0] = 1.
+    for m in range(1, max_relevant + 1):
+        survivors[1:m + 1] = margin*survivors[:m] + (1-margin)*survivors[1:m + 1]
+        survivors[0] *= 1-margin
+        threshold = math.ceil((log_threshold - m*loser_increment) / (winner_increment - loser_increment) - 1e-9)
+        threshold = max(threshold, 0)
+        cdf[m] = cdf[m - 1] + survivors[threshold:].sum()
+        survivors[threshold:] = 0.
+    return cdf
+
+@pytest.mark.parametrize('margin, risk_limit, max_relevant', [
+    (.6, .1, 1000),
+    (.55, .05, 3000),
+    (.7, 1., 300),
+    (.51, .001, 2000),
+    (.9, .1, 3),
+    (.6, .1, 64),
+    (.6, .1, 0),
+])
+def test_cdf_matches_loop(margin, risk_limit, max_relevant):
+    np.testing.assert_allclose(relevant_stopping_cdf(margin, risk_limit, max_relevant),
+                               loop_stopping_cdf(margin, risk_limit, max_relevant), atol=1e-12)
+
+@pytest.mark.parametrize('votes_array, num_ballots, risk_limit, max_tests', [
+    ([600, 400], 1000, .1, 1000),
+    ([550, 450], 1200, .05, 600),
+])
+def test_exact_distribution_matches_simulation(votes_array, num_ballots, risk_limit, max_tests):
+    num_trials = 20000
+    stopping_sizes = simulate_bravo_chunk(votes_array, num_ballots, 1, risk_limit, max_tests, num_trials,
+                                          np.random.SeedSequence(20201))
+    escalated = stopping_sizes < 0
+    workloads = np.where(escalated, max_tests, stopping_sizes)
+
+    distribution = bravo_stopping_distribution(votes_array[0], votes_array[1], num_ballots, risk_limit, max_tests)
+
+    standard_error = workloads.std() / math.sqrt(num_trials)
+    assert abs(distribution['expected_sample_size'] - workloads.mean()) < 4 * standard_error
+    assert abs(distribution['stopping_probability'] - (1 - escalated.mean())) \
+        < 4 * math.sqrt(escalated.mean() * (1 - escalated.mean()) / num_trials) + 1e-3
+    for quantile, size in distribution['quantiles'].items():
+        if size is not None:
+            simulated = np.sort(workloads)[math.ceil(quantile / 100 * num_trials) - 1]
+            assert abs(size - simulated) <= .05 * size + 2
+
+def test_sample_size_is_exact_expectation():
+    bravo = Bravo([51000, 49000], 100000, 1, .1, 1, 0)
+    start = time.perf_counter()
+    sample_size = bravo.get_sample_size()
+    assert time.perf_counter() - start < 1
+    assert sample_size == bravo_stopping_distribution(51000, 49000, 100000, .1, 100000)['expected_sample_size']
+
+def test_sample_size_of_large_audit_is_closed_form(monkeypatch):
+    monkeypatch.setattr(bravo_module, 'EXACT_SAMPLE_SIZE_MAX_DRAWS', 1000)
+    bravo = Bravo([505000, 495000], 1000000, 1, .1, 1, 0)
+    assert bravo.get_sample_size() == average_sample_number(505000, 495000, 1000000, .1)
+
+def test_sample_size_of_tied_contest_is_zero():
+    assert Bravo([500, 500], 1000, 1, .1, 1, 0).get_sample_size() == 0
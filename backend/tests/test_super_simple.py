@@ -0,0 +1,29 @@
+import random
+
+import pytest
+
+from audits.SuperSimple import SuperSimple
+
+def random_observations(rng, num_candidates, num_observations):
+    observations = []
+    for _ in range(num_observations):
+        cvr = [rng.randrange(num_candidates) for _ in range(rng.choice([0, 1, 1, 1, 2]))]
+        # Mostly matching, sometimes with discrepancies or a repeated mark
+        paper = list(cvr) if rng.random() < .9 else [rng.randrange(num_candidates) for _ in range(rng.randrange(3))]
+        observations.append([paper, cvr])
+    return observations
+
+def audit_state(audit):
+    return (audit.IS_DONE, audit.IS_DONE_FLAG, audit.ballots_audited, audit.in_kaplan_phase,
+            audit.overstatements.tolist(), audit.kaplan_markov.ballots_audited,
+            audit.kaplan_markov.discrepancy_counts.tolist())
+
+@pytest.mark.parametrize('seed', range(40))
+def test_batch_matches_single_ballots(seed, replay):
+    rng = random.Random(seed)
+    votes_array = rng.choice([[600, 400], [500, 300, 200], [10, 5]])
+    num_ballots = sum(votes_array) + rng.randrange(50)
+    params = [votes_array, num_ballots, 1, rng.choice([.05, .1]), seed, rng.choice([1.01, 1.1]), .5]
+    observations = random_observations(rng, len(votes_array), rng.randrange(1, 120))
+    single, batch = replay(lambda: SuperSimple(*params), observations, 25, audit_state)
+    assert batch.kaplan_markov.log_p_values.tolist() == single.kaplan_markov.log_p_values.tolist()
@@ -0,0 +1,134 @@
+'''
+Parsing of uploaded batch manifests for batch-level (CAST) audits.
+
+A batch manifest gives the reported votes of each candidate in each batch,
+one row per batch, either as a CSV:
+    <candidate 0>,<candidate 1>,...
+    51,40,...
+where the header row of candidate names is optional, or as a .npy file of
+an integer (batches x candidates) array.
+
+Both are read from the upload stream in chunks straight into a preallocated
+integer array, without building a Python object per batch or per vote.
+'''
+
+import io
+
+import numpy as np
+
+NPY_MAGIC = b'\x93NUMPY'
+
+def parse_batch_manifest(stream, num_batches, num_candidates, out=None, chunk_size=1 << 22):
+    '''
+    Reads a CSV or .npy batch manifest from the binary `stream` into `out`,
+    a (num_batches x num_candidates) integer array, by default a new int64
+    array.
+    Returns `out`. Raises ValueError if the manifest is malformed, has a
+    count that does not fit in `out`, or does not have num_batches rows of
+    num_candidates votes.
+    '''
+    if out is None:
+        out = np.empty((num_batches, num_candidates), dtype=np.int64)
+    assert out.shape == (num_batches, num_candidates) and out.flags.c_contiguous
+    reader = io.BufferedReader(stream) if isinstance(stream, io.RawIOBase) else stream
+    if peek(reader, len(NPY_MAGIC)) == NPY_MAGIC:
+        parse_npy(reader, out, chunk_size)
+    else:
+        parse_csv(reader, out, chunk_size)
+    if (out < 0).any():
+        raise ValueError('Batch manifest vote counts must not be negative.')
+    return out
+
+def peek(reader, size):
+    '''
+    Returns the first `size` bytes of `reader` without consuming them, or
+    fewer if the stream is shorter.
+    '''
+    if hasattr(reader, 'peek'):
+        return reader.peek(size)[:size]
+    position = reader.tell()
+    data = reader.read(size)
+    reader.seek(position)
+    return data
+
+def read_exactly(reader, buffer):
+    '''
+    Fills the writable `buffer` from `reader`. Raises ValueError if the
+    stream ends first.
+    '''
+    view = memoryview(buffer).cast('B')
+    filled = 0
+    while filled < len(view):
+        num_read = reader.readinto(view[filled:])
+        if not num_read:
+            raise ValueError('The batch manifest ended before all batches were read.')
+        filled += num_read
+
+def parse_npy(reader, out, chunk_size):
+    version = np.lib.format.read_magic(reader)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(reader)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(reader)
+    else:
+        raise ValueError(f'Unsupported .npy format version {version}.')
+    if dtype.kind not in 'iu' or fortran_order:
+        raise ValueError('The batch manifest must be a C-ordered integer array.')
+    if shape != out.shape:
+        raise ValueError(f'The batch manifest has shape {shape}, expected {out.shape}.')
+
+    if dtype == out.dtype:
+        read_exactly(reader, out)
+        return
+    # Converted to the dtype of `out` a chunk of rows at a time, checking
+    # the counts fit where the conversion could wrap them
+    limits = None if np.can_cast(dtype, out.dtype) else np.iinfo(out.dtype)
+    rows_per_chunk = max(1, chunk_size // max(1, dtype.itemsize * out.shape[1]))
+    for start in range(0, len(out), rows_per_chunk):
+        chunk = np.empty((min(rows_per_chunk, len(out) - start), out.shape[1]), dtype=dtype)
+        read_exactly(reader, chunk)
+        if limits is not None and chunk.size and (chunk.min() < limits.min or chunk.max() > limits.max):
+            raise ValueError(f'A vote count in the batch manifest does not fit in {out.dtype}.')
+        out[start:start + len(chunk)] = chunk
+
+def parse_csv(reader, out, chunk_size):
+    num_batches, num_candidates = out.shape
+    num_rows = 0
+
+    def parse_rows(data):
+        nonlocal num_rows
+        data = data.replace(b'\r', b'').strip()
+        if not data:
+            return
+        rows_in_chunk = data.count(b'\n') + 1
+        malformed = f'Malformed row in the batch manifest, expected {num_candidates} integers per row.'
+        # Fields that are not integers or do not fit in out.dtype are
+        # rejected, and so are blank lines, which loadtxt would skip
+        try:
+            values = np.loadtxt(io.BytesIO(data), dtype=out.dtype, delimiter=',', comments=None, ndmin=2)
+        except ValueError:
+            raise ValueError(malformed)
+        if values.shape != (rows_in_chunk, num_candidates):
+            raise ValueError(malformed)
+        if num_rows + rows_in_chunk > num_batches:
+            raise ValueError(f'The batch manifest has more than {num_batches} batches.')
+        out[num_rows:num_rows + rows_in_chunk] = values
+        num_rows += rows_in_chunk
+
+    # The first row is a header if it does not start with a vote count,
+    # signed so a negative count is reported rather than taken for a header
+    first_row = reader.readline().lstrip(b'\xef\xbb\xbf')
+    if first_row.strip()[:1] in (b'-', b'+') or first_row.strip()[:1].isdigit():
+        parse_rows(first_row)
+
+    # Only whole rows are parsed, the rest is carried over to the next chunk
+    leftover = b''
+    for chunk in iter(lambda: reader.read(chunk_size), b''):
+        data = leftover + chunk
+        end = data.rfind(b'\n') + 1
+        parse_rows(data[:end])
+        leftover = data[end:]
+    parse_rows(leftover)
+
+    if num_rows != num_batches:
+        raise ValueError(f'The batch manifest has {num_rows} batches, expected {num_batches}.')
@@ -1,44 +1,60 @@
 import csv
+import hashlib
+import io
 import random
 
-# Returns two things:
-# (1) candidate -> num_votes dictionary
-# (2) num_total_votes for each office
-def parse_election_data_csv(filename):
+class HashingReader(io.RawIOBase):
+    '''
+    Wraps a binary stream and computes the SHA-256 of everything read
+    through it, so a single pass can both parse and hash an upload.
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        self.digest.update(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+# Returns office -> (candidate -> num_votes dictionary, num_total_votes)
+# Reads the binary `stream` once, in chunks, keeping only the per-office and
+# per-candidate totals in memory.
+def parse_election_data_stream(stream, encoding='utf-8'):
     # Need dict of office -> candidate (name_raw) -> votes
     data = {}
-    offices = set()
-    total_votes_per_office = {}
-    with open(filename) as csv_file:
-        reader = list(csv.DictReader(csv_file))
-
-        for row in reader:
-            offices.add(row["office"])
-
-        office_to_return = random.sample(offices, 1)[0]
-
-        data = dict.fromkeys(list(offices))
-
-        # Create a new sub-dictionary for each office
-        for key in data:
-            data[key] = {}
-
-        for row in reader:
-            office = row["office"]
-            name = row["name_raw"]
-            votes = row["votes"]
-            if name not in data[office]:
-                data[office][name] = int(votes)
-            else:
-                data[office][name] += int(votes)
-
-        total_votes_per_office = dict.fromkeys(list(offices), 0)
-
-        for office, office_dict in data.items():
-            for votes in office_dict.values():
-                total_votes_per_office[office] += votes
-
-    return data[office_to_return], total_votes_per_office[office_to_return], office_to_return
+    # Any object with read(size) works, e.g. a socket or spooled upload
+    if not isinstance(stream, HashingReader):
+        stream = HashingReader(stream)
+    text_stream = io.TextIOWrapper(io.BufferedReader(stream), encoding=encoding, newline='')
+    for row in csv.DictReader(text_stream):
+        office_dict = data.setdefault(row["office"], {})
+        name = row["name_raw"]
+        office_dict[name] = office_dict.get(name, 0) + int(row["votes"])
+
+    return {office: (office_dict, sum(office_dict.values())) for office, office_dict in data.items()}
+
+# Returns office -> (candidate -> num_votes dictionary, num_total_votes)
+def parse_election_data_offices(filename):
+    with open(filename, 'rb') as csv_file:
+        return parse_election_data_stream(csv_file)
+
+# Returns three things for a randomly chosen office:
+# (1) candidate -> num_votes dictionary
+# (2) num_total_votes for the office
+# (3) the office
+def parse_election_data_csv(filename):
+    offices = parse_election_data_offices(filename)
+    office_to_return = random.choice(sorted(offices))
+    vote_dict, total_votes = offices[office_to_return]
+    return vote_dict, total_votes, office_to_return
 
 if __name__ == "__main__":
     print(parse_election_data_csv("open_election_test_data.csv"))
@@ -0,0 +1,185 @@
+'''
+Server-side store of cast vote record (CVR) exports for comparison audits.
+
+A CVR export is uploaded once as a CSV with a header row and one row per
+ballot:
+    ballot_id,<candidate 0>,<candidate 1>,...
+    1,0,1,...
+where ballot_id is the ballot's position in the ballot manifest, i.e. the
+sequence number the audit draws it as, and each candidate column is 1 if the
+CVR records a vote for that candidate.
+
+The export is parsed in chunks straight into arrays, sorted by ballot ID and
+saved as .npy files named after the SHA-256 of the upload: one column of
+ballot IDs and one of the candidate marks packed into bits. Every worker
+memory-maps the same files, so looking up the CVR of a drawn ballot only
+touches the pages it needs, however large the export is.
+'''
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from utilities.csv_parser import HashingReader
+
+BALLOT_IDS_FILE = 'ballot_ids.npy'
+MARKS_FILE = 'marks.npy'
+CANDIDATES_FILE = 'candidates.txt'
+
+def parse_cvr_stream(stream, chunk_size=1 << 22):
+    '''
+    Reads a CVR export CSV from the binary `stream`. Returns an array of the
+    ballot IDs, the marks of each ballot packed into bits with np.packbits,
+    and the candidate names from the header row.
+    Raises ValueError if a row is malformed.
+    '''
+    reader = io.BufferedReader(stream) if isinstance(stream, io.RawIOBase) else stream
+    header = reader.readline().decode('utf-8-sig').strip().split(',')
+    if len(header) < 2 or header[0].strip() != 'ballot_id':
+        raise ValueError('The CVR export must start with a ballot_id column followed by one column per candidate.')
+    num_columns = len(header)
+
+    ballot_ids, marks = [], []
+    def parse_rows(data):
+        data = data.replace(b'\r', b'').strip()
+        if not data:
+            return
+        malformed = f'Malformed row in the CVR export, expected {num_columns} integers per row.'
+        try:
+            values = np.loadtxt(io.BytesIO(data), dtype=np.int64, delimiter=',', comments=None, ndmin=2)
+        except ValueError:
+            raise ValueError(malformed)
+        if values.shape[1] != num_columns:
+            raise ValueError(malformed)
+        if ((values[:, 1:] != 0) & (values[:, 1:] != 1)).any():
+            raise ValueError('Candidate columns of the CVR export must be 0 or 1.')
+        ballot_ids.append(values[:, 0])
+        marks.append(np.packbits(values[:, 1:].astype(bool), axis=1))
+
+    # Only whole rows are parsed, the rest is carried over to the next chunk
+    leftover = b''
+    for chunk in iter(lambda: reader.read(chunk_size), b''):
+        data = leftover + chunk
+        end = data.rfind(b'\n') + 1
+        parse_rows(data[:end])
+        leftover = data[end:]
+    parse_rows(leftover)
+
+    num_candidates = num_columns - 1
+    if not ballot_ids:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, (num_candidates + 7) // 8), dtype=np.uint8), header[1:]
+    return np.concatenate(ballot_ids), np.concatenate(marks), header[1:]
+
+class CastVoteRecords:
+    '''
+    Memory-mapped CVRs of one export, looked up by ballot ID.
+    '''
+    def __init__(self, directory):
+        self.ballot_ids = np.load(os.path.join(directory, BALLOT_IDS_FILE), mmap_mode='r')
+        self.packed_marks = np.load(os.path.join(directory, MARKS_FILE), mmap_mode='r')
+        with open(os.path.join(directory, CANDIDATES_FILE), encoding='utf-8') as candidates_file:
+            self.candidates = candidates_file.read().splitlines()
+        self.num_candidates = len(self.candidates)
+        self.num_ballots = len(self.ballot_ids)
+        # IDs 1..n are looked up by position instead of binary search
+        self.consecutive_ids = self.num_ballots == 0 or \
+            (self.ballot_ids[0] == 1 and self.ballot_ids[-1] == self.num_ballots)
+
+    def rows(self, ballot_ids):
+        ballot_ids = np.asarray(ballot_ids, dtype=np.int64)
+        if self.consecutive_ids:
+            rows = ballot_ids - 1
+            found = (0 <= rows) & (rows < self.num_ballots)
+        else:
+            rows = np.searchsorted(self.ballot_ids, ballot_ids)
+            found = rows < self.num_ballots
+            found[found] = self.ballot_ids[rows[found]] == ballot_ids[found]
+        if not found.all():
+            raise KeyError(f'No CVR for ballot {int(ballot_ids[~found][0])}.')
+        return rows
+
+    def marks(self, ballot_ids):
+        '''
+        Returns a boolean matrix (ballots x candidates) of the marks on the
+        CVRs of `ballot_ids`. Raises KeyError if one has no CVR.
+        '''
+        return np.unpackbits(self.packed_marks[self.rows(ballot_ids)], axis=1,
+                             count=self.num_candidates).astype(bool)
+
+    def lookup(self, ballot_ids):
+        '''
+        Returns the list of candidates marked on the CVR of each of
+        `ballot_ids`. Raises KeyError if one has no CVR.
+        '''
+        return [np.flatnonzero(marks).tolist() for marks in self.marks(ballot_ids)]
+
+class CVRStore:
+    '''
+    Directory of uploaded CVR exports, one subdirectory per export named
+    after the SHA-256 of its content. Opened exports are kept in a small LRU
+    cache of memory maps.
+    '''
+    def __init__(self, directory, max_open=8):
+        self.directory = directory
+        self.max_open = max_open
+        self._open = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, stream):
+        '''
+        Parses and saves the CVR export read from the binary `stream`.
+        Returns its ID and the number of ballots and candidates in it.
+        Raises ValueError if the export is malformed or has a ballot ID
+        twice.
+        '''
+        stream = HashingReader(stream)
+        ballot_ids, packed_marks, candidates = parse_cvr_stream(stream)
+        cvr_id = stream.hexdigest()
+
+        if len(ballot_ids) > 1 and (ballot_ids[1:] <= ballot_ids[:-1]).any():
+            order = np.argsort(ballot_ids, kind='stable')
+            ballot_ids, packed_marks = ballot_ids[order], packed_marks[order]
+            if (ballot_ids[1:] == ballot_ids[:-1]).any():
+                raise ValueError('The CVR export lists a ballot ID more than once.')
+
+        if not os.path.isdir(os.path.join(self.directory, cvr_id)):
+            # Written to a temporary directory and renamed, so other workers
+            # never see a partial export
+            staging = tempfile.mkdtemp(dir=self.directory)
+            try:
+                np.save(os.path.join(staging, BALLOT_IDS_FILE), ballot_ids)
+                np.save(os.path.join(staging, MARKS_FILE), packed_marks)
+                with open(os.path.join(staging, CANDIDATES_FILE), 'w', encoding='utf-8') as candidates_file:
+                    candidates_file.write('\n'.join(candidates))
+                os.rename(staging, os.path.join(self.directory, cvr_id))
+            except OSError:
+                # Another worker saved the same export first
+                shutil.rmtree(staging, ignore_errors=True)
+                if not os.path.isdir(os.path.join(self.directory, cvr_id)):
+                    raise
+        return cvr_id, len(ballot_ids), len(candidates)
+
+    def open(self, cvr_id):
+        '''
+        Returns the CastVoteRecords of the export `cvr_id`. Raises KeyError
+        if there is no such export.
+        '''
+        with self._lock:
+            if cvr_id in self._open:
+                self._open.move_to_end(cvr_id)
+                return self._open[cvr_id]
+            # IDs are hex digests, anything else is not a path in the store
+            directory = os.path.join(self.directory, cvr_id)
+            if len(cvr_id) != 64 or not all(c in '0123456789abcdef' for c in cvr_id) or not os.path.isdir(directory):
+                raise KeyError(f'No CVR export with ID {cvr_id}.')
+            records = CastVoteRecords(directory)
+            self._open[cvr_id] = records
+            while len(self._open) > self.max_open:
+                self._open.popitem(last=False)
+            return records
@@ -0,0 +1,204 @@
+'''
+Minimal Prometheus metrics, rendered in the text exposition format.
+
+Counters and histograms are kept per worker process. When the registry is
+given a directory (PROMETHEUS_MULTIPROC_DIR), every process writes its values
+to a file of its own there at most once a second, and rendering sums the
+files of all processes, so whichever worker is scraped reports the totals of
+the whole server. The directory must be emptied when the server starts (see
+gunicorn_config.py).
+
+Gauges are read from a callback when the metrics are rendered, so values that
+live in a shared store (such as the number of active sessions) are the same
+whichever worker is scraped. Callbacks of per-process values are marked
+`per_process` and summed over the processes like counters.
+'''
+
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + '}'
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render_samples(metric, samples):
+    '''
+    Renders `samples`, a list of (sample name, label string, value), under
+    the HELP and TYPE lines of `metric`.
+    '''
+    lines = [f'# HELP {metric.name} {metric.documentation}', f'# TYPE {metric.name} {metric.metric_type}']
+    lines.extend(f'{name}{labels} {format_value(value)}' for name, labels, value in samples)
+    return lines
+
+class Counter:
+    metric_type = 'counter'
+    per_process = True
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, format_labels(self.label_names, key), value)
+                    for key, value in sorted(self._values.items())]
+
+    def render(self):
+        return render_samples(self, self.samples())
+
+class Histogram:
+    metric_type = 'histogram'
+    per_process = True
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [per bucket counts (last is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            entry = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (bucket_counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), bucket_counts):
+                    cumulative += count
+                    labels = format_labels(self.label_names, key, [('le', bound)])
+                    samples.append((f'{self.name}_bucket', labels, cumulative))
+                labels = format_labels(self.label_names, key)
+                samples.append((f'{self.name}_sum', labels, total))
+                samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+    def render(self):
+        return render_samples(self, self.samples())
+
+class CallbackMetric:
+    '''
+    A gauge or counter whose values are read when the metrics are rendered.
+    `callback` returns a dict of label values tuple -> value. If the values
+    are counted by each worker process, `per_process` sums them over the
+    processes and the callback is also read whenever the process writes its
+    values, so it has to be cheap.
+    '''
+    def __init__(self, name, documentation, label_names, callback, metric_type='gauge', per_process=False):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.callback = callback
+        self.metric_type = metric_type
+        self.per_process = per_process
+
+    def samples(self):
+        return [(self.name, format_labels(self.label_names, key), value)
+                for key, value in sorted(self.callback().items())]
+
+    def render(self):
+        return render_samples(self, self.samples())
+
+class MetricsRegistry:
+    def __init__(self, directory=None, write_interval=1.0):
+        self._metrics = []
+        self.directory = directory
+        self.write_interval = write_interval
+        self._write_lock = threading.Lock()
+        self._last_write = 0.0
+        self._pending_write = None
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def write_process_values(self, force=False):
+        '''
+        Writes the per-process values of this process to its file in the
+        directory, replacing the file so readers never see a partial one.
+        Unless `force`, writes at most once every `write_interval` seconds
+        and leaves skipped values to a timer. Does nothing without a
+        directory.
+        '''
+        if self.directory is None:
+            return
+        with self._write_lock:
+            wait = self._last_write + self.write_interval - time.monotonic()
+            if not force and wait > 0:
+                if self._pending_write is None:
+                    self._pending_write = threading.Timer(wait, self.write_process_values, kwargs={'force': True})
+                    self._pending_write.daemon = True
+                    self._pending_write.start()
+                return
+            self._last_write = time.monotonic()
+            values = {metric.name: metric.samples() for metric in self._metrics if metric.per_process}
+            path = os.path.join(self.directory, f'{os.getpid()}.json')
+            with open(path + '.tmp', 'w') as file:
+                json.dump(values, file)
+            os.replace(path + '.tmp', path)
+            if self._pending_write is not None:
+                self._pending_write.cancel()
+                self._pending_write = None
+
+    def read_process_values(self):
+        '''
+        Returns metric name -> sample name and label string -> value summed
+        over the files of all processes, in order of first appearance.
+        '''
+        totals = {}
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.json'))):
+            try:
+                with open(path) as file:
+                    values = json.load(file)
+            except (OSError, ValueError):
+                # Removed or replaced by its process while listing
+                continue
+            for metric_name, samples in values.items():
+                metric_totals = totals.setdefault(metric_name, {})
+                for name, labels, value in samples:
+                    metric_totals[(name, labels)] = metric_totals.get((name, labels), 0) + value
+        return totals
+
+    def render(self):
+        totals = None
+        if self.directory is not None:
+            self.write_process_values(force=True)
+            totals = self.read_process_values()
+        lines = []
+        for metric in self._metrics:
+            if totals is None or not metric.per_process:
+                lines.extend(metric.render())
+            else:
+                samples = [(name, labels, value) for (name, labels), value
+                           in totals.get(metric.name, {}).items()]
+                lines.extend(render_samples(metric, samples))
+        return '\n'.join(lines) + '\n'
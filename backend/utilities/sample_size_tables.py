@@ -0,0 +1,144 @@
+'''
+Precomputed sample size tables.
+
+BRAVO's expected sample size comes from the exact stopping distribution,
+which takes up to seconds per contest on close margins, so it is tabulated
+once over a grid of margins and risk limits. The server memory-maps the
+table at startup, so every worker shares the same pages, and answers sample
+size queries by interpolating in it. Super-simple sample sizes have a
+closed form and are computed directly.
+
+Build the tables with:
+    python -m utilities.sample_size_tables [output directory]
+'''
+
+import argparse
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import numpy as np
+
+from audits.stopping_distribution import relevant_stopping_cdf
+
+# Log of the expected number of ballots for the winner or loser
+BRAVO_TABLE = 'bravo_log_sample_sizes.npy'
+
+# Winner's share of the votes for the winner and loser, minus 1/2
+HALF_MARGINS = np.geomspace(0.005, 0.5, 48)
+RISK_LIMITS = np.geomspace(0.001, 0.5, 24)
+
+def expected_relevant_sample_size(half_margin, risk_limit):
+    '''
+    Returns the exact expected number of ballots for the winner or loser a
+    BRAVO audit draws before stopping, without a limit on the sample size.
+    '''
+    margin = 0.5 + half_margin
+    if margin == 1:
+        return math.ceil(math.log(1/risk_limit) / math.log(2) - 1e-9)
+    winner_increment, loser_increment = math.log(2*margin), math.log(2*(1-margin))
+    drift = margin*winner_increment + (1-margin)*loser_increment
+    variance = margin*(1-margin)*(winner_increment - loser_increment)**2
+    # Long enough for the chance of not having stopped to be negligible
+    max_relevant = math.ceil(10*math.log(1/risk_limit)/drift + 42*variance/drift**2) + 1000
+    cdf = relevant_stopping_cdf(margin, risk_limit, max_relevant)
+    return float((1 - cdf).sum())
+
+def super_simple_multiplier(risk_limit, inflation_rate, tolerance):
+    '''
+    Returns the super-simple sample size multiplier, as in
+    `SuperSimple.multiplier`, or NaN where it is undefined.
+    '''
+    denominator = 1/(2*inflation_rate) + tolerance*math.log(1 - 1/(2*inflation_rate))
+    if denominator <= 0:
+        return math.nan
+    return -math.log(risk_limit) / denominator
+
+def super_simple_sample_size(v_w, v_l, num_ballots, risk_limit, inflation_rate, tolerance):
+    '''
+    Returns the initial sample size of a super-simple audit, as in
+    `SuperSimple.sample_size`, or None where it is undefined.
+    '''
+    if v_w <= v_l:
+        return None
+    multiplier = super_simple_multiplier(risk_limit, inflation_rate, tolerance)
+    if math.isnan(multiplier):
+        return None
+    return math.ceil(multiplier * num_ballots / (v_w - v_l))
+
+def build_tables(directory, processes=None):
+    os.makedirs(directory, exist_ok=True)
+    grid = list(product(HALF_MARGINS, RISK_LIMITS))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        bravo = np.array(list(executor.map(expected_relevant_sample_size, *zip(*grid))))
+    # Stored as logs, where interpolation is close to linear
+    np.save(os.path.join(directory, BRAVO_TABLE), np.log(bravo).reshape(len(HALF_MARGINS), len(RISK_LIMITS)))
+
+def interpolate(table, axes, point):
+    '''
+    Multilinear interpolation in `table`, sampled at the increasing `axes`
+    (one per dimension), at `point`. Returns None outside the grid or where
+    the table is undefined.
+    '''
+    indices, weights = [], []
+    for axis, x in zip(axes, point):
+        if not axis[0] <= x <= axis[-1]:
+            return None
+        index = min(int(np.searchsorted(axis, x, side='right')) - 1, len(axis) - 2)
+        fraction = (x - axis[index]) / (axis[index + 1] - axis[index])
+        indices.append(index)
+        weights.append((1 - fraction, fraction))
+
+    value = 0.
+    for corner in product((0, 1), repeat=len(indices)):
+        weight = 1.
+        for dimension, offset in enumerate(corner):
+            weight *= weights[dimension][offset]
+        if weight:
+            value += weight * table[tuple(index + offset for index, offset in zip(indices, corner))]
+    return None if math.isnan(value) else value
+
+class SampleSizeTables:
+    def __init__(self, directory):
+        self.bravo = np.load(os.path.join(directory, BRAVO_TABLE), mmap_mode='r')
+        if self.bravo.shape != (len(HALF_MARGINS), len(RISK_LIMITS)):
+            raise ValueError(f'The sample size tables in {directory} were built for another grid.')
+        self.bravo_axes = (np.log(HALF_MARGINS), np.log(RISK_LIMITS))
+
+    def bravo_sample_size(self, v_w, v_l, num_ballots, risk_limit):
+        '''
+        Returns the expected number of ballots a BRAVO audit draws for a
+        winner with `v_w` votes and a loser with `v_l` votes among
+        `num_ballots` ballots, or None outside the tables.
+        '''
+        if v_w <= v_l:
+            return None
+        half_margin = v_w / (v_w + v_l) - 0.5
+        log_size = interpolate(self.bravo, self.bravo_axes, (math.log(half_margin), math.log(risk_limit)))
+        if log_size is None:
+            return None
+        return math.ceil(math.exp(log_size) * num_ballots / (v_w + v_l))
+
+def load_sample_size_tables(directory):
+    '''
+    Memory-maps the tables in `directory`, or returns None if they have not
+    been built.
+    '''
+    if not os.path.exists(os.path.join(directory, BRAVO_TABLE)):
+        print(f'No sample size tables in {directory}, sample sizes will be computed per request.')
+        return None
+    return SampleSizeTables(directory)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the precomputed sample size tables.')
+    parser.add_argument('directory', nargs='?', default='sample_size_tables',
+                        help='output directory (default: sample_size_tables)')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: one per core)')
+    args = parser.parse_args(argv)
+    build_tables(args.directory, args.processes)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,422 @@
+'''
+Session backends for running audits.
+
+MemorySessionStore keeps live audit objects in a dict and is only correct when
+the server runs a single worker process. SQLiteSessionStore keeps every audit
+serialized in a SQLite file shared by all workers, so any worker can resume an
+audit started by another one. In both, an exception in the body of checkout
+leaves the stored audit as it was before the checkout. Concurrent checkouts of
+one session wait for each other in MemorySessionStore, while in
+SQLiteSessionStore all but the first to finish raise SessionConflict and the
+request has to be retried.
+
+Both stores evict sessions that have been idle for longer than `idle_ttl`
+seconds, and evict the least recently used sessions once there are more than
+`max_sessions` of them or their serialized size exceeds `max_bytes`. A limit
+of None disables it.
+'''
+
+import copy
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager
+
+import numpy as np
+
+from audits.shared_objects.BaseAudit import BaseAudit
+
+EVICTION_REASONS = ('idle', 'max_sessions', 'max_bytes')
+# Version of the SQLite schema, kept in PRAGMA user_version
+SCHEMA_VERSION = 2
+
+def estimate_size(obj):
+    '''
+    Returns a rough in-memory size of `obj` in bytes: the data of NumPy
+    arrays plus sys.getsizeof of every other object reachable through
+    containers and attributes, each counted once.
+    '''
+    size = 0
+    seen = set()
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        if isinstance(item, np.ndarray):
+            size += item.nbytes
+            continue
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            stack.extend(item)
+        elif hasattr(item, '__dict__') and not isinstance(item, type):
+            stack.append(item.__dict__)
+    return size
+
+class MemorySessionStore:
+    '''
+    The size of a session is an estimate of the memory its audit takes
+    (see estimate_size), updated whenever it is checked in.
+    '''
+    def __init__(self, idle_ttl=None, max_sessions=None, max_bytes=None):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        # session_id -> [audit_type, audit, size, last_access, lock], least
+        # recently used first. The store lock guards the dict and the sizes,
+        # the lock of a session is held while it is checked out.
+        self._sessions = OrderedDict()
+        self._num_bytes = 0
+        self._evictions = dict.fromkeys(EVICTION_REASONS, 0)
+        self._lock = threading.Lock()
+        # Time requests spent waiting for the locks in checkout
+        self._lock_wait_seconds = 0.0
+        self._num_checkouts = 0
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def _touch(self, session_id):
+        entry = self._sessions[session_id]
+        entry[3] = time.time()
+        self._sessions.move_to_end(session_id)
+        return entry
+
+    def _remove(self, session_id, reason=None):
+        entry = self._sessions.pop(session_id, None)
+        if entry is None:
+            return
+        self._num_bytes -= entry[2]
+        if reason is not None:
+            self._evictions[reason] += 1
+
+    def _reap(self):
+        sessions = self._sessions
+        if self.idle_ttl is not None:
+            expired_before = time.time() - self.idle_ttl
+            while sessions and next(iter(sessions.values()))[3] < expired_before:
+                self._remove(next(iter(sessions)), 'idle')
+        while self.max_sessions is not None and len(sessions) > self.max_sessions:
+            self._remove(next(iter(sessions)), 'max_sessions')
+        while self.max_bytes is not None and sessions and self._num_bytes > self.max_bytes:
+            self._remove(next(iter(sessions)), 'max_bytes')
+
+    def reap(self):
+        '''
+        Evicts idle sessions, then least recently used sessions until the
+        store is within its limits.
+        '''
+        with self._lock:
+            self._reap()
+
+    def get(self, session_id):
+        '''
+        Returns the audit for `session_id`, or None if there is no such session.
+        '''
+        with self._lock:
+            self._reap()
+            if session_id not in self._sessions:
+                return None
+            return self._touch(session_id)[1]
+
+    def add(self, session_id, audit_type, audit):
+        size = estimate_size(audit)
+        with self._lock:
+            self._remove(session_id)
+            self._sessions[session_id] = [audit_type, audit, size, time.time(), threading.Lock()]
+            self._num_bytes += size
+            self._reap()
+
+    @contextmanager
+    def checkout(self, session_id):
+        '''
+        Yields the audit for `session_id` while holding its session lock, so
+        requests for other sessions are not blocked. If the body raises, the
+        audit is restored to its state before the checkout.
+        Raises KeyError if there is no such session.
+        '''
+        wait_start = time.perf_counter()
+        with self._lock:
+            self._reap()
+            entry = self._touch(session_id)
+        with entry[4]:
+            with self._lock:
+                self._lock_wait_seconds += time.perf_counter() - wait_start
+                self._num_checkouts += 1
+            audit = entry[1]
+            snapshot = copy.deepcopy(audit)
+            try:
+                yield audit
+            except BaseException:
+                entry[1] = snapshot
+                raise
+            finally:
+                # Audit state grows as ballots are applied, so its size is
+                # estimated again before the next eviction check
+                size = estimate_size(entry[1])
+                with self._lock:
+                    if self._sessions.get(session_id) is entry:
+                        self._num_bytes += size - entry[2]
+                        entry[2] = size
+
+    def pop(self, session_id):
+        with self._lock:
+            self._remove(session_id)
+
+    def checkout_stats(self):
+        '''
+        Returns the checkout counters of this worker process.
+        '''
+        with self._lock:
+            return {'checkouts': self._num_checkouts, 'lock_wait_seconds': self._lock_wait_seconds}
+
+    def stats(self):
+        '''
+        Returns occupancy and eviction counters for this store.
+        '''
+        with self._lock:
+            sessions_by_type = {}
+            for audit_type, *_ in self._sessions.values():
+                sessions_by_type[audit_type] = sessions_by_type.get(audit_type, 0) + 1
+            return {
+                'sessions': len(self._sessions),
+                'sessions_by_type': sessions_by_type,
+                'bytes': self._num_bytes,
+                'evictions': dict(self._evictions),
+                'checkouts': self._num_checkouts,
+                'lock_wait_seconds': self._lock_wait_seconds
+            }
+
+class SessionConflict(Exception):
+    '''
+    Raised by SQLiteSessionStore.checkout when another request changed the
+    audit since it was loaded. The request can be retried.
+    '''
+
+class SQLiteSessionStore:
+    '''
+    Audits are loaded without locking the database and written back with
+    an UPDATE that checks the version they were loaded at, so the write
+    lock is only held for that one statement. Each worker keeps its most
+    recently written audits, so it does not load an audit again as long as
+    no other worker changed it.
+    '''
+    def __init__(self, path, idle_ttl=None, max_sessions=None, max_bytes=None, reap_interval=10, cache_size=8):
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        # Reaping takes a write lock on the whole file, so each worker only
+        # does it every `reap_interval` seconds
+        self.reap_interval = reap_interval
+        self._last_reap = 0
+        # session_id -> (version, audit, state) of audits this worker wrote
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        # Time this worker's requests spent writing audits back, including
+        # waiting for the write lock, updated by all of its threads under
+        # _counters_lock
+        self._lock_wait_seconds = 0.0
+        self._num_checkouts = 0
+        self._counters_lock = threading.Lock()
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._migrate(conn)
+            conn.execute('CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)')
+            # Eviction counters are shared by all workers
+            conn.execute('''CREATE TABLE IF NOT EXISTS evictions (
+                                reason TEXT PRIMARY KEY,
+                                count INTEGER NOT NULL)''')
+            conn.executemany('INSERT OR IGNORE INTO evictions VALUES (?, 0)',
+                             [(reason,) for reason in EVICTION_REASONS])
+
+    def _migrate(self, conn):
+        '''
+        Creates the sessions table, or brings one written by an older
+        version of the server up to SCHEMA_VERSION.
+        '''
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < 1:
+                conn.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                                    session_id TEXT PRIMARY KEY,
+                                    audit_type TEXT NOT NULL,
+                                    state BLOB NOT NULL,
+                                    updated REAL NOT NULL)''')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(sessions)')]
+            # Version 1 adds the serialized size of each session
+            if version < 1 and 'size' not in columns:
+                conn.execute('ALTER TABLE sessions ADD COLUMN size INTEGER NOT NULL DEFAULT 0')
+                conn.execute('UPDATE sessions SET size = LENGTH(state)')
+            # Version 2 adds the version each session was last written at
+            if version < 2 and 'version' not in columns:
+                conn.execute('ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _connect(self):
+        # Autocommit mode, transactions are opened explicitly where needed
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _take_cached(self, session_id):
+        with self._counters_lock:
+            return self._cache.pop(session_id, None)
+
+    def _put_cached(self, session_id, version, audit, state):
+        with self._counters_lock:
+            self._cache[session_id] = (version, audit, state)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def __contains__(self, session_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT 1 FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return row is not None
+
+    def reap(self, force=False):
+        '''
+        Evicts idle sessions, then least recently used sessions until the
+        store is within its limits.
+        '''
+        now = time.time()
+        if not force and now - self._last_reap < self.reap_interval:
+            return
+        self._last_reap = now
+
+        evicted = dict.fromkeys(EVICTION_REASONS, 0)
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if self.idle_ttl is not None:
+                evicted['idle'] = conn.execute('DELETE FROM sessions WHERE updated < ?',
+                                               (now - self.idle_ttl,)).rowcount
+            if self.max_sessions is not None:
+                evicted['max_sessions'] = conn.execute('''DELETE FROM sessions WHERE session_id IN (
+                                                              SELECT session_id FROM sessions
+                                                              ORDER BY updated DESC LIMIT -1 OFFSET ?)''',
+                                                       (self.max_sessions,)).rowcount
+            if self.max_bytes is not None:
+                evicted['max_bytes'] = conn.execute('''DELETE FROM sessions WHERE session_id IN (
+                                                           SELECT session_id FROM (
+                                                               SELECT session_id, SUM(size) OVER (ORDER BY updated DESC) AS running_size
+                                                               FROM sessions)
+                                                           WHERE running_size > ?)''',
+                                                    (self.max_bytes,)).rowcount
+            conn.executemany('UPDATE evictions SET count = count + ? WHERE reason = ?',
+                             [(count, reason) for reason, count in evicted.items() if count])
+            conn.execute('COMMIT')
+
+    def get(self, session_id):
+        '''
+        Returns a read-only copy of the audit for `session_id`, or None if
+        there is no such session.
+        '''
+        self.reap()
+        with closing(self._connect()) as conn:
+            conn.execute('UPDATE sessions SET updated = ? WHERE session_id = ?', (time.time(), session_id))
+            row = conn.execute('SELECT state FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return BaseAudit.loads(row[0]) if row else None
+
+    def add(self, session_id, audit_type, audit):
+        state = audit.dumps()
+        self._take_cached(session_id)
+        with closing(self._connect()) as conn:
+            conn.execute('''INSERT OR REPLACE INTO sessions (session_id, audit_type, state, size, updated, version)
+                            VALUES (?, ?, ?, ?, ?, 0)''',
+                         (session_id, audit_type, state, len(state), time.time()))
+        self.reap()
+
+    @contextmanager
+    def checkout(self, session_id):
+        '''
+        Loads the audit for `session_id` and writes its state back once the
+        caller is done with it, unless the caller raised. Other requests are
+        not blocked in between.
+        Raises KeyError if there is no such session, and SessionConflict if
+        another request wrote the audit in between.
+        '''
+        self.reap()
+        cached = self._take_cached(session_id)
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT version FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+            if row is None:
+                raise KeyError(session_id)
+            if cached is not None and cached[0] == row[0]:
+                version, audit, state = cached
+            else:
+                row = conn.execute('SELECT version, state FROM sessions WHERE session_id = ?',
+                                   (session_id,)).fetchone()
+                if row is None:
+                    raise KeyError(session_id)
+                version, state = row
+                audit = BaseAudit.loads(state)
+
+            yield audit
+
+            new_state = audit.dumps()
+            write_start = time.perf_counter()
+            if new_state == state:
+                updated = conn.execute('UPDATE sessions SET updated = ? WHERE session_id = ? AND version = ?',
+                                       (time.time(), session_id, version)).rowcount
+            else:
+                updated = conn.execute('''UPDATE sessions SET state = ?, size = ?, updated = ?, version = version + 1
+                                          WHERE session_id = ? AND version = ?''',
+                                       (new_state, len(new_state), time.time(), session_id, version)).rowcount
+                version += 1
+            with self._counters_lock:
+                self._lock_wait_seconds += time.perf_counter() - write_start
+                self._num_checkouts += 1
+            if not updated:
+                if session_id not in self:
+                    raise KeyError(session_id)
+                raise SessionConflict(f'The audit {session_id} was changed by another request.')
+        self._put_cached(session_id, version, audit, new_state)
+
+    def pop(self, session_id):
+        with closing(self._connect()) as conn:
+            conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+
+    def checkout_stats(self):
+        '''
+        Returns the checkout counters of this worker process, without
+        reading the database.
+        '''
+        with self._counters_lock:
+            return {'checkouts': self._num_checkouts, 'lock_wait_seconds': self._lock_wait_seconds}
+
+    def stats(self):
+        '''
+        Returns occupancy and eviction counters for this store. Checkouts
+        and lock wait time are counted per worker process.
+        '''
+        with closing(self._connect()) as conn:
+            num_sessions, num_bytes = conn.execute('SELECT COUNT(*), TOTAL(size) FROM sessions').fetchone()
+            sessions_by_type = dict(conn.execute('SELECT audit_type, COUNT(*) FROM sessions GROUP BY audit_type'))
+            evictions = dict(conn.execute('SELECT reason, count FROM evictions'))
+        return {
+            'sessions': num_sessions,
+            'sessions_by_type': sessions_by_type,
+            'bytes': int(num_bytes),
+            'evictions': evictions,
+            **self.checkout_stats()
+        }
+
+def make_session_store(backend, path=None, **limits):
+    '''
+    Returns the session store for `backend` ('memory' or 'sqlite').
+    `limits` are passed on to the store (idle_ttl, max_sessions, max_bytes).
+    '''
+    if backend == 'memory':
+        return MemorySessionStore(**limits)
+    if backend == 'sqlite':
+        return SQLiteSessionStore(path, **limits)
+    raise ValueError(f'{backend} is an invalid session backend!')
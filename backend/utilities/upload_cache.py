@@ -0,0 +1,43 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+'''
+Bounded LRU cache of parsed uploads, keyed by the SHA-256 of the file
+content, so re-uploading the same file skips parsing.
+'''
+class ParsedUploadCache:
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_hash(stream, chunk_size=1 << 20):
+        '''
+        Returns the SHA-256 hex digest of a binary stream, read in chunks.
+        The stream is rewound afterwards so it can still be saved or parsed.
+        '''
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            digest.update(chunk)
+        stream.seek(0)
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)